@@ -13,6 +13,10 @@ from nrtk_explorer.library.dataset import (
 )
 from nrtk_explorer.library.debounce import debounce
 from nrtk_explorer.library.app_config import process_config
+from nrtk_explorer.library.startup_profiler import profiler
+from nrtk_explorer.library.frame_spill import FrameSpill, DEFAULT_MAX_SIZE as SPILL_MAX_SIZE
+from nrtk_explorer.library.shared_images import DEFAULT_SEGMENT_SIZE as SHARED_MEMORY_SEGMENT_SIZE
+from nrtk_explorer.library.transform_executor import TransformExecutor
 
 
 from nrtk_explorer.app.features import (
@@ -101,6 +105,48 @@ config_options = {
             "help": "Choose which application features to enable based on a preset name.",
         },
     },
+    "image_spill_dir": {
+        "flags": ["--image-spill-dir"],
+        "params": {
+            "default": None,
+            "required": False,
+            "help": "Directory keeping images evicted from memory, a temporary one when not set",
+        },
+    },
+    "image_spill_size": {
+        "flags": ["--image-spill-size"],
+        "params": {
+            "default": 0,
+            "type": int,
+            "help": "Megabytes of disk for images evicted from memory, 0 disables spilling, "
+            f"try {SPILL_MAX_SIZE // (1024 * 1024)} when decoding or transforming is slow",
+        },
+    },
+    "shared_memory_size": {
+        "flags": ["--shared-memory-size"],
+        "params": {
+            "default": SHARED_MEMORY_SEGMENT_SIZE // (1024 * 1024),
+            "type": int,
+            "help": "Megabytes of each shared memory segment passing images to inference "
+            "workers, 0 pickles the images instead",
+        },
+    },
+    "transform_workers": {
+        "flags": ["--transform-workers"],
+        "params": {
+            "default": 0,
+            "type": int,
+            "help": "Processes running transforms, 0 runs them in threads of the server process",
+        },
+    },
+    "profile_startup": {
+        "flags": ["--profile-startup"],
+        "params": {
+            "action": "store_true",
+            "default": False,
+            "help": "Print the time spent importing each module and initializing each app part",
+        },
+    },
     "session_id": {
         "flags": ["--session-id"],
         "params": {
@@ -117,6 +163,9 @@ class Engine(Applet):
         super().__init__(server)
 
         config = process_config(self.server.cli, config_options, **kwargs)
+        if config["profile_startup"]:
+            # already started by main, unless the engine is created by another entry point
+            profiler.start()
 
         self.state.input_datasets = expand_hugging_face_datasets(
             config["dataset"], not config["download"]
@@ -139,14 +188,33 @@ class Engine(Applet):
         self.state.all_datasets_options = dataset_select_options(self.state.all_datasets)
         self.state.current_dataset = self.state.all_datasets[0]
 
-        images = Images(server=self.server)
-        self._image_server = ImageServer(server=self.server, images=images)
+        spill = None
+        if config["image_spill_size"] > 0:
+            spill = FrameSpill(
+                config["image_spill_dir"], max_size=config["image_spill_size"] * 1024 * 1024
+            )
+        transform_executor = None
+        if config["transform_workers"] > 0:
+            transform_executor = TransformExecutor(config["transform_workers"])
+        with profiler.measure("Images"):
+            images = Images(
+                server=self.server,
+                spill=spill,
+                transform_executor=transform_executor,
+                shared_memory_size=config["shared_memory_size"] * 1024 * 1024,
+            )
+            self.context.image_arena = images.arena
+            self.context.image_content_hash = images.get_content_hash
+            self._image_server = ImageServer(server=self.server, images=images)
 
         self._datasets_app = None
         if self.datasets_enabled:
-            from nrtk_explorer.app.features.datasets import DatasetsApp
+            with profiler.measure("DatasetsApp"):
+                from nrtk_explorer.app.features.datasets import DatasetsApp
 
-            self._datasets_app = DatasetsApp(server=self.server.create_child_server(), **kwargs)
+                self._datasets_app = DatasetsApp(
+                    server=self.server.create_child_server(), **kwargs
+                )
         else:
             # If datasets selection is disabled, we don't have a way to tweak the sampling
             # the images in a dataset. Hence include all images
@@ -156,53 +224,61 @@ class Engine(Applet):
         self._transforms_app = None
         self.state.transform_enabled = False
         if self.transforms_enabled:
-            from nrtk_explorer.app.features.transforms import TransformsApp
+            with profiler.measure("TransformsApp"):
+                from nrtk_explorer.app.features.transforms import TransformsApp
 
-            self._transforms_app = TransformsApp(
-                server=self.server.create_child_server(), images=images, **kwargs
-            )
+                self._transforms_app = TransformsApp(
+                    server=self.server.create_child_server(), images=images, **kwargs
+                )
 
         self._images_app = None
         if self.images_enabled:
-            from nrtk_explorer.app.features.images import ImagesApp
+            with profiler.measure("ImagesApp"):
+                from nrtk_explorer.app.features.images import ImagesApp
 
-            self._images_app = ImagesApp(
-                server=self.server.create_child_server(), images=images, **kwargs
-            )
+                self._images_app = ImagesApp(
+                    server=self.server.create_child_server(), images=images, **kwargs
+                )
 
         self._inference_app = None
         if self.inference_enabled:
-            from nrtk_explorer.app.features.inference import InferenceApp
+            with profiler.measure("InferenceApp"):
+                from nrtk_explorer.app.features.inference import InferenceApp
 
-            self._inference_app = InferenceApp(server=self.server.create_child_server(), **kwargs)
+                self._inference_app = InferenceApp(
+                    server=self.server.create_child_server(), **kwargs
+                )
 
         self._embeddings_app = None
         if self.embeddings_enabled:
-            from nrtk_explorer.app.features.embeddings import EmbeddingsApp
+            with profiler.measure("EmbeddingsApp"):
+                from nrtk_explorer.app.features.embeddings import EmbeddingsApp
 
-            self._embeddings_app = EmbeddingsApp(
-                server=self.server.create_child_server(),
-                images=images,
-            )
+                self._embeddings_app = EmbeddingsApp(
+                    server=self.server.create_child_server(),
+                    images=images,
+                )
 
         self._filtering_app = None
         if self.filtering_enabled:
-            from nrtk_explorer.app.features.filtering import FilteringApp
-
-            filtering_translator = Translator()
-            filtering_translator.add_translation("categories", "annotation_categories")
-            self._filtering_app = FilteringApp(
-                server=self.server.create_child_server(translator=filtering_translator),
-            )
+            with profiler.measure("FilteringApp"):
+                from nrtk_explorer.app.features.filtering import FilteringApp
+
+                filtering_translator = Translator()
+                filtering_translator.add_translation("categories", "annotation_categories")
+                self._filtering_app = FilteringApp(
+                    server=self.server.create_child_server(translator=filtering_translator),
+                )
             self.ctrl.apply_filter.add(self.on_filter_apply)
 
         self._export_app = None
         if self.export_enabled and self.context.repository is not None:
-            from nrtk_explorer.app.features.export import ExportApp
+            with profiler.measure("ExportApp"):
+                from nrtk_explorer.app.features.export import ExportApp
 
-            self._export_app = ExportApp(
-                server=self.server.create_child_server(),
-            )
+                self._export_app = ExportApp(
+                    server=self.server.create_child_server(),
+                )
 
         # Bind instance methods to controller
         self.ctrl.on_server_reload = self._build_ui
@@ -222,7 +298,8 @@ class Engine(Applet):
 
         self.state.change("dataset_ids")(clear_hovered)
 
-        self._build_ui()
+        with profiler.measure("UI"):
+            self._build_ui()
 
     def on_server_ready(self, *args, **kwargs):
         # Bind instance methods to state change
@@ -232,7 +309,12 @@ class Engine(Applet):
         )
         self.state.change("random_sampling")(self.resample_images)
 
-        self.on_dataset_change()
+        with profiler.measure("Dataset"):
+            self.on_dataset_change()
+
+        if profiler.started:
+            profiler.stop()
+            print(profiler.report())
 
         # Capture errors emitted by wslink and display them in the UI
         self.server.protocol.log_emitter.add_event_listener("error", self.handle_errors)
@@ -307,12 +389,11 @@ class Engine(Applet):
 
     def on_filter_apply(self, filter: FilterProtocol[Iterable[int]], **kwargs):
         selected_ids = []
+        dataset = self.context.dataset
         for dataset_id in self.state.dataset_ids:
-            image_annotations_categories = [
-                annotation["category_id"]
-                for annotation in self.context.dataset.anns.values()
-                if annotation["image_id"] == int(dataset_id)
-            ]
+            image_annotations_categories = dataset.get_image_category_ids(
+                dataset.get_image_id(dataset_id)
+            )
             include = filter.evaluate(image_annotations_categories)
             if include:
                 selected_ids.append(dataset_id)
@@ -1,9 +1,10 @@
+import asyncio
+import threading
 from typing import Dict
 import numpy as np
 from trame.decorators import TrameApp, change
 from PIL import Image
 from nrtk_explorer.widgets.nrtk_explorer import ScatterPlot
-from nrtk_explorer.library import embeddings_extractor
 from nrtk_explorer.library import dimension_reducers
 from nrtk_explorer.library.dataset import get_dataset
 from nrtk_explorer.app.applet import Applet
@@ -35,16 +36,16 @@ class TransformedImages:
     def __init__(self, server):
         self.server = server
         self.transformed_features: IdToFeatures = {}
-        self.extractor = None
+        self.get_extractor = None
 
-    def set_extractor(self, extractor):
-        self.extractor = extractor
+    def set_extractor_factory(self, get_extractor):
+        self.get_extractor = get_extractor
 
     def emit_update(self):
         self.server.controller.update_transformed_images(self.transformed_features)
 
     def add_images(self, dataset_id_to_image: IdToImage):
-        features = self.extractor.extract(dataset_id_to_image.values())
+        features = self.get_extractor().extract(dataset_id_to_image.values())
 
         id_to_feature = {id: features for id, features in zip(dataset_id_to_image, features)}
 
@@ -95,6 +96,11 @@ class EmbeddingsApp(Applet):
 
         self.state.client_only("camera_position")
         self.state.feature_extraction_model = "resnet50.a1_in1k"
+        self.state.setdefault("embeddings_enabled_switch", True)
+        # built on first use, timm and the model weights take seconds to load
+        self._extractor = None
+        self._extractor_lock = threading.Lock()
+        self._points_outdated = False
 
         self.ctrl.on_server_ready.add(self.on_server_ready)
         self.transformed_images_cache = {}
@@ -104,8 +110,8 @@ class EmbeddingsApp(Applet):
         }
 
         self.transformed_images = TransformedImages(server)
+        self.transformed_images.set_extractor_factory(lambda: self.extractor)
         self.clear_points_transformations()  # init vars
-        self.on_feature_extraction_model_change()
 
         self.ctrl.hover_image.add(self.on_image_hovered)
         self.ctrl.update_transformed_images.add(self.update_transformed_points)
@@ -116,15 +122,25 @@ class EmbeddingsApp(Applet):
         self.save_embedding_params()
         self.update_points()
         self.state.change("dataset_ids")(self.update_points)
-        self.ctrl.apply_transform.add(self.clear_points_transformations)
-        self.ctrl.apply_transform.add(self.transformed_images.clear)
+        self.ctrl.transform_changed.add(self.clear_points_transformations)
+        self.ctrl.transform_changed.add(self.transformed_images.clear)
         self.state.change("transform_enabled_switch")(self.update_points_transformations_state)
+        self.state.change("embeddings_enabled_switch")(self.on_embeddings_enabled)
+
+    @property
+    def extractor(self):
+        with self._extractor_lock:
+            if self._extractor is None:
+                from nrtk_explorer.library.embeddings_extractor import EmbeddingsExtractor
+
+                self._extractor = EmbeddingsExtractor(
+                    model_name=self.state.feature_extraction_model
+                )
+            return self._extractor
 
     def on_feature_extraction_model_change(self, **kwargs):
-        self.extractor = embeddings_extractor.EmbeddingsExtractor(
-            model_name=self.state.feature_extraction_model
-        )
-        self.transformed_images.set_extractor(self.extractor)
+        with self._extractor_lock:
+            self._extractor = None
 
     def compute_points(self, fit_features, features):
         if len(features) == 0:
@@ -193,6 +209,9 @@ class EmbeddingsApp(Applet):
 
         self.save_embedding_params()
 
+        # model built off the event loop, so the UI stays responsive meanwhile
+        await asyncio.to_thread(lambda: self.extractor)
+
         with self.state:
             self.compute_source_points()
             self.update_transformed_points(self.transformed_images.transformed_features)
@@ -201,8 +220,17 @@ class EmbeddingsApp(Applet):
     def update_points(self, **kwargs):
         if hasattr(self, "_update_task"):
             self._update_task.cancel()
+        if not self.state.embeddings_enabled_switch:
+            # computed once the embeddings panel is shown
+            self._points_outdated = True
+            return
+        self._points_outdated = False
         self._update_task = asynchronous.create_task(self._update_points())
 
+    def on_embeddings_enabled(self, **kwargs):
+        if self.state.embeddings_enabled_switch and self._points_outdated:
+            self.update_points()
+
     def save_embedding_params(self):
         self.embedding_params = {
             "tab": self.state.tab,
@@ -1,5 +1,8 @@
 from pathlib import Path
 
+import numpy as np
+from PIL import Image
+
 from trame.app import get_server, asynchronous
 from trame.widgets import quasar, html
 from trame.ui.quasar import QLayout
@@ -12,6 +15,9 @@ from nrtk_explorer.library.dataset import (
 import nrtk_explorer.library.transforms as trans
 from nrtk_explorer.widgets.nrtk_explorer import ExportWidget
 
+# Images transformed together, progress is reported after each batch
+TRANSFORM_BATCH_SIZE = 16
+
 
 def recursive_rmdir(path: Path):
     if not path.is_dir():
@@ -112,8 +118,6 @@ class ExportApp(Applet):
 
         new_dataset = kwcoco.CocoDataset()
 
-        # How often to update the progress
-        PROGRESS_UPDATE_STEP = 30
         # Ensure a directory doesn't have too many files
         MAX_FILES_PER_DIRECTORY = 100
 
@@ -126,32 +130,37 @@ class ExportApp(Applet):
 
         subdir = subdir_generator(MAX_FILES_PER_DIRECTORY)
 
-        for i, image_id in enumerate(image_ids):
-            subdir_name = next(subdir)
-            destination_dir = tmp_dataset_dir / subdir_name
+        ordered_ids = list(image_ids)
+        for start in range(0, len(ordered_ids), TRANSFORM_BATCH_SIZE):
+            batch_ids = ordered_ids[start : start + TRANSFORM_BATCH_SIZE]
+            images = []
+            for image_id in batch_ids:
+                img = dataset.get_image(image_id)
+                # transforms require RGB mode
+                images.append(img.convert("RGB") if img.mode != "RGB" else img)
+
+            transformed = transform.execute_batch([np.asarray(img) for img in images])
 
-            if not Path.exists(destination_dir):
-                Path.mkdir(destination_dir, parents=True)
+            for image_id, img, transformed_array in zip(batch_ids, images, transformed):
+                subdir_name = next(subdir)
+                destination_dir = tmp_dataset_dir / subdir_name
 
-            img = dataset.get_image(image_id)
-            # transforms require RGB mode
-            img = img.convert("RGB") if img.mode != "RGB" else img
+                if not Path.exists(destination_dir):
+                    Path.mkdir(destination_dir, parents=True)
 
-            if img.format is not None:
-                img_format = img.format
-            else:
-                img_format = "PNG"
+                if img.format is not None:
+                    img_format = img.format
+                else:
+                    img_format = "PNG"
 
-            img_destination = destination_dir / f"{image_id}.{img_format.lower()}"
-            transformed_img = transform.execute(img)
-            transformed_img.save(img_destination, img_format)
+                img_destination = destination_dir / f"{image_id}.{img_format.lower()}"
+                Image.fromarray(transformed_array).save(img_destination, img_format)
 
-            new_dataset.add_image(img_destination, id=image_id)
+                new_dataset.add_image(img_destination, id=image_id)
 
-            if i % PROGRESS_UPDATE_STEP == 0:
-                with self.state:
-                    self.state.export_progress = i / len(image_ids)
-                await self.server.network_completion
+            with self.state:
+                self.state.export_progress = (start + len(batch_ids)) / len(image_ids)
+            await self.server.network_completion
 
         for cat in dataset.cats.values():
             new_dataset.add_category(**cat)
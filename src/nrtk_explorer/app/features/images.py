@@ -1,13 +1,19 @@
 import logging
+from collections import OrderedDict
 from collections.abc import MutableMapping
+from itertools import chain
+from typing import Dict, List, NamedTuple
 
 from trame.ui.quasar import QLayout
 from trame.widgets import quasar
 from trame.widgets import html
 from trame.app import get_server, asynchronous
 
+from nrtk_explorer.library.pipeline import Stage, run_pipeline
 from nrtk_explorer.library.scoring import (
-    compute_score,
+    BoxArraysCache,
+    partition,
+    score_box_arrays,
 )
 
 from nrtk_explorer.app.applet import Applet
@@ -15,6 +21,7 @@ from nrtk_explorer.app.trame_utils import ProcessingStep
 from nrtk_explorer.app.images.image_meta import update_image_meta, dataset_id_to_meta
 from nrtk_explorer.app.trame_utils import change_checker, delete_state
 from nrtk_explorer.app.images.image_ids import (
+    image_id_to_dataset_id,
     dataset_id_to_image_id,
     dataset_id_to_transformed_image_id,
     image_id_to_score_id,
@@ -32,6 +39,11 @@ from nrtk_explorer.app.ui.image_list import (
 )
 
 IMAGE_UPDATE_BATCH_SIZE = 16
+RESCORE_BATCH_SIZE = 64
+# Chunks each stage of the image update pipeline works on at the same time
+PIPELINE_CONCURRENCY = {"load": 2, "transform": 1, "infer": 1, "score": 1}
+# Transforms whose scored box arrays are kept, to restore their scores when applied again
+PREVIOUS_TRANSFORMS_KEPT = 8
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -66,6 +78,16 @@ class LazyDict(MutableMapping):
         return ((k, self[k]) for k in self._raw_dict)
 
 
+class ImageChunk(NamedTuple):
+    """Images going through the update pipeline together, filled in stage by stage."""
+
+    dataset_ids: List[str]
+    visible: bool
+    originals: Dict  # dataset id -> image
+    transformed: Dict  # dataset id -> transformed image
+    predictions: Dict  # model name -> (original, transformed) annotations
+
+
 class ImagesApp(Applet):
     def __init__(
         self,
@@ -87,7 +109,21 @@ class ImagesApp(Applet):
         )
         self.context.ground_truth_annotations = ground_truth_annotations.annotations_factory
 
-        def clear_transformed(*args, **kwargs):
+        # Threshold independent annotations of the scored images, keyed by (model, dataset id)
+        self._original_box_arrays = BoxArraysCache()
+        self._transformed_box_arrays = BoxArraysCache()
+        # transform hash -> box arrays of the images transformed by it. Only the scores
+        # are restored when returning to a transform: its images are transformed again,
+        # or read back from the spill when enabled, and its annotations recomputed
+        self._previous_transformed_box_arrays: OrderedDict[str, BoxArraysCache] = OrderedDict()
+
+        def clear_transformed(previous_hash=None, transform_hash=None, **kwargs):
+            self._previous_transformed_box_arrays[previous_hash] = self._transformed_box_arrays
+            restored = self._previous_transformed_box_arrays.pop(transform_hash, None)
+            self._transformed_box_arrays = restored or BoxArraysCache()
+            while len(self._previous_transformed_box_arrays) > PREVIOUS_TRANSFORMS_KEPT:
+                self._previous_transformed_box_arrays.popitem(last=False)
+
             if self.context.models:
                 for obj in self.context.models.values():
                     transformed_annotations = obj["transformed_annotations"]
@@ -103,9 +139,20 @@ class ImagesApp(Applet):
                     },
                 )
 
-        self.ctrl.apply_transform.add(clear_transformed)
+            # scores of the previous transform show before its images are transformed again
+            if restored is not None and self.context.models:
+                for model_name in self.context.models.keys():
+                    self._update_scores(
+                        self._transformed_box_arrays,
+                        self.state.dataset_ids,
+                        model_name,
+                        dataset_id_to_transformed_image_id,
+                    )
+
+        self.ctrl.transform_changed.add(clear_transformed)
         self.ctrl.run_transform.add(self._start_update_images)
         self.ctrl.start_update_images.add(self._start_update_images)
+        self.ctrl.rescore_images.add(self._start_rescore_images)
         self.ctrl.scroll_images.add(self.on_scroll)
         self.ctrl.hover_image.add(self.on_hover)
 
@@ -140,163 +187,249 @@ class ImagesApp(Applet):
 
     def on_server_ready(self, *args, **kwargs):
         self.state.change("current_dataset")(self._cancel_update_images)
+        self.state.change("current_dataset")(self._cancel_rescore_images)
+        self.state.change("current_dataset", "inference_models")(self._clear_box_arrays)
 
-    async def update_transformed_images(self, dataset_ids, predictions_original_images):
-        if not self.state.transform_enabled:
-            return
-
-        skip_inference = False
-
-        if not self.state.predictions_images_enabled:
-            skip_inference = True
-
-        if not self.context.models:
-            skip_inference = True
-
-        id_to_image = LazyDict()
-        for id in dataset_ids:
-            id_to_image[dataset_id_to_transformed_image_id(id)] = (
-                lambda id=id: self.images.get_transformed_image_without_cache_eviction(id)
-            )
-
-        if not skip_inference:
-            ground_truth_annotations = self.context.ground_truth_annotations.get_annotations(
-                dataset_ids
-            )
-
-            for model_name, obj in self.context.models.items():
-                predictor = obj["predictor"]
-                transformed_annotations = obj["transformed_annotations"]
-
-                with self.state:
-                    annotations = await transformed_annotations.get_annotations(
-                        predictor, id_to_image
-                    )
-                await self.server.network_completion
+    def _clear_box_arrays(self, **kwargs):
+        self._original_box_arrays.clear()
+        self._transformed_box_arrays.clear()
+        self._previous_transformed_box_arrays.clear()
 
-                scores = compute_score(
-                    self.context.dataset,
-                    ground_truth_annotations,
-                    annotations,
-                    self.state.confidence_score_threshold,
-                )
+    def _cache_ground_truth(self, ground_truth_annotations):
+        self._original_box_arrays.add(
+            self.context.dataset,
+            {
+                (GROUND_TRUTH_MODEL, dataset_id): annotations
+                for dataset_id, annotations in ground_truth_annotations.items()
+            },
+        )
 
-                for dataset_id, score in scores:
-                    score_id = image_id_to_score_id(
-                        dataset_id_to_transformed_image_id(dataset_id), model_name
-                    )
-                    self.state[score_id] = score
+    def _cache_predictions(self, box_arrays, model_name, annotations):
+        box_arrays.add(
+            self.context.dataset,
+            {
+                (model_name, image_id_to_dataset_id(image_id)): image_annotations
+                for image_id, image_annotations in annotations.items()
+            },
+        )
 
-                await self.server.network_completion
+    def _update_scores(self, box_arrays, dataset_ids, model_name, to_image_id):
+        """
+        Score cached predictions against the ground truth at the current threshold.
+        Returns the ids missing from the caches, which are not scored.
+        """
+        cached, missing = partition(
+            lambda id: (GROUND_TRUTH_MODEL, id) in self._original_box_arrays
+            and (model_name, id) in box_arrays,
+            dataset_ids,
+        )
+        dataset_ids = cached
+        score_threshold = self.state.confidence_score_threshold
+        actual = self._original_box_arrays.threshold(
+            [(GROUND_TRUTH_MODEL, id) for id in dataset_ids], score_threshold
+        )
+        predicted = box_arrays.threshold([(model_name, id) for id in dataset_ids], score_threshold)
+        scores = score_box_arrays(actual, predicted)
 
-            # sortable score value may have changed which images that are in view
-            self.server.controller.check_images_in_view()
+        # state only pushes the score keys whose value changed
+        for dataset_id, score in zip(dataset_ids, scores.tolist()):
+            self.state[image_id_to_score_id(to_image_id(dataset_id), model_name)] = score
+        return missing
 
-        if self.ctrl.transform_applied.exists():
-            self.ctrl.transform_applied(id_to_image)  # inform embeddings app
+    async def _load_stage(self, chunk: "ImageChunk"):
+        if chunk.visible:
+            # load images on state for ImageList
+            with self.state:
+                self.context.ground_truth_annotations.get_annotations(chunk.dataset_ids)
+            await self.server.network_completion
 
-        self.state.flush()
+        if not self._inference_enabled():
+            return chunk
+        originals = await self.images.load_images_async(chunk.dataset_ids)
+        return chunk._replace(originals=originals)
 
-    async def compute_predictions_original_images(self, dataset_ids):
-        if not self.state.predictions_images_enabled:
-            return
+    async def _transform_stage(self, chunk: "ImageChunk"):
+        if not self.state.transform_enabled:
+            return chunk
+        transformed = await self.images.get_transformed_images_async(chunk.dataset_ids)
+        return chunk._replace(transformed=transformed)
 
-        if not self.context.models:
-            return
+    async def _infer_stage(self, chunk: "ImageChunk"):
+        if not self._inference_enabled():
+            return chunk
 
-        image_id_to_image = LazyDict(
+        originals = LazyDict(
             {
-                dataset_id_to_image_id(
-                    id
-                ): lambda id=id: self.images.get_image_without_cache_eviction(id)
-                for id in dataset_ids
+                dataset_id_to_image_id(id): (
+                    chunk.originals[id]
+                    if id in chunk.originals
+                    else lambda id=id: self.images.get_image_without_cache_eviction(id)
+                )
+                for id in chunk.dataset_ids
             }
         )
+        transformed = {
+            dataset_id_to_transformed_image_id(id): image
+            for id, image in chunk.transformed.items()
+        }
 
-        ground_truth_annotations = self.context.ground_truth_annotations.get_annotations(
-            dataset_ids
-        )
-
-        predictions_original_images = {}
-
+        predictions = {}
         for model_name, obj in self.context.models.items():
             predictor = obj["predictor"]
-            original_annotations = obj["original_annotations"]
-
+            # always push to state because annotations update score metadata
             with self.state:
-                annotations = await original_annotations.get_annotations(
-                    predictor, image_id_to_image
-                )
+                original = await obj["original_annotations"].get_annotations(predictor, originals)
             await self.server.network_completion
 
-            predictions_original_images[model_name] = annotations
-
-            scores = compute_score(
-                self.context.dataset,
-                ground_truth_annotations,
-                annotations,
-                self.state.confidence_score_threshold,
+            if transformed:
+                with self.state:
+                    transformed_annotations = await obj["transformed_annotations"].get_annotations(
+                        predictor, transformed
+                    )
+                await self.server.network_completion
+            else:
+                transformed_annotations = {}
+            predictions[model_name] = (original, transformed_annotations)
+        return chunk._replace(predictions=predictions)
+
+    async def _score_stage(self, chunk: "ImageChunk"):
+        dataset_ids = chunk.dataset_ids
+        if chunk.predictions:
+            ground_truth_annotations = self.context.ground_truth_annotations.get_annotations(
+                dataset_ids
             )
+            self._cache_ground_truth(ground_truth_annotations)
 
-            for dataset_id, score in scores:
-                score_id = image_id_to_score_id(dataset_id_to_image_id(dataset_id), model_name)
-                self.state[score_id] = score
-
-        return predictions_original_images
-
-    async def _update_images(self, dataset_ids, visible=False):
-        if visible:
-            # load images on state for ImageList
             with self.state:
-                self.context.ground_truth_annotations.get_annotations(dataset_ids)
+                for model_name, (original, transformed) in chunk.predictions.items():
+                    self._cache_predictions(self._original_box_arrays, model_name, original)
+                    self._update_scores(
+                        self._original_box_arrays, dataset_ids, model_name, dataset_id_to_image_id
+                    )
+                    if transformed:
+                        self._cache_predictions(
+                            self._transformed_box_arrays, model_name, transformed
+                        )
+                        self._update_scores(
+                            self._transformed_box_arrays,
+                            dataset_ids,
+                            model_name,
+                            dataset_id_to_transformed_image_id,
+                        )
             await self.server.network_completion
 
-        # always push to state because compute_predictions_original_images updates score metadata
-        with self.state:
-            predictions_original_images = await self.compute_predictions_original_images(
-                dataset_ids
+            # sortable score value may have changed which images that are in view
+            self.server.controller.check_images_in_view()
+
+        if chunk.transformed and self.ctrl.transform_applied.exists():
+            # inform embeddings app
+            self.ctrl.transform_applied(
+                {
+                    dataset_id_to_transformed_image_id(id): image
+                    for id, image in chunk.transformed.items()
+                }
             )
-        await self.server.network_completion
-        # sortable score value may have changed which may have changed images that are in view
-        self.server.controller.check_images_in_view()
 
-        await self.update_transformed_images(dataset_ids, predictions_original_images)
+        self.state.flush()
+
+    def _inference_enabled(self):
+        return bool(self.state.predictions_images_enabled and self.context.models)
 
-    async def _batch_process_images(self, dataset_ids, visible=False):
+    @staticmethod
+    def _chunks(dataset_ids, visible=False):
         ids = list(dataset_ids)
         for i in range(0, len(ids), IMAGE_UPDATE_BATCH_SIZE):
-            chunk = ids[i : i + IMAGE_UPDATE_BATCH_SIZE]
-            await self._update_images(chunk, visible=visible)
+            yield ImageChunk(ids[i : i + IMAGE_UPDATE_BATCH_SIZE], visible, {}, {}, {})
 
     async def _update_all_images(self, visible_images):
         with self.state:
             self.state.updating_images = True
 
-        await self._batch_process_images(visible_images, visible=True)
-
-        other_images = set(self.state.user_selected_ids) - set(visible_images)
-        await self._batch_process_images(other_images, visible=False)
+        visible = set(visible_images)
+        other_images = [id for id in self.state.user_selected_ids if id not in visible]
+        await self._update_images(
+            chain(self._chunks(visible_images, visible=True), self._chunks(other_images))
+        )
 
         with self.state:
             self.state.updating_images = False
 
+    async def _update_images(self, chunks):
+        stages = [
+            Stage(self._load_stage, PIPELINE_CONCURRENCY["load"]),
+            Stage(self._transform_stage, PIPELINE_CONCURRENCY["transform"]),
+            Stage(self._infer_stage, PIPELINE_CONCURRENCY["infer"]),
+            Stage(self._score_stage, PIPELINE_CONCURRENCY["score"]),
+        ]
+        await run_pipeline(chunks, stages)
+
     def _cancel_update_images(self, **kwargs):
         if hasattr(self, "_update_task"):
             self._update_task.cancel()
 
     def _start_update_images(self, **kwargs):
         """
-        After updating the images visible in the image list, all other selected
-        images are updated and their scores computed. After images are scored,
-        the table sort may have changed the images that are visible, so
-        ImageList is asked to send visible image IDs again, which may trigger
-        a new _update_all_images if the set of images in view has changed.
+        Images visible in the image list are updated first, then all other
+        selected images, in chunks going through the load, transform, infer and
+        score stages of a pipeline, so one chunk is loaded or transformed while
+        the previous one is inferred. Changing the dataset cancels every stage.
+        After images are scored, the table sort may have changed the images
+        that are visible, so ImageList is asked to send visible image IDs
+        again, which may trigger a new _update_all_images if the set of images
+        in view has changed.
         """
         self._cancel_update_images()
         self._update_task = asynchronous.create_task(
             self._update_all_images(self.visible_dataset_ids)
         )
 
+    async def _rescore_all_images(self):
+        if not self.state.predictions_images_enabled or not self.context.models:
+            return
+
+        dataset_ids = list(
+            dict.fromkeys([*self.visible_dataset_ids, *self.state.user_selected_ids])
+        )
+        unscored = {}
+        for i in range(0, len(dataset_ids), RESCORE_BATCH_SIZE):
+            chunk = dataset_ids[i : i + RESCORE_BATCH_SIZE]
+            with self.state:
+                for model_name in self.context.models.keys():
+                    missing = self._update_scores(
+                        self._original_box_arrays, chunk, model_name, dataset_id_to_image_id
+                    )
+                    unscored.update(dict.fromkeys(missing))
+                    if self.state.transform_enabled:
+                        missing = self._update_scores(
+                            self._transformed_box_arrays,
+                            chunk,
+                            model_name,
+                            dataset_id_to_transformed_image_id,
+                        )
+                        unscored.update(dict.fromkeys(missing))
+            await self.server.network_completion
+
+        if unscored:
+            # evicted from the box array caches, or not predicted yet
+            await self._update_images(self._chunks(unscored))
+
+        # sortable score value may have changed which images that are in view
+        self.server.controller.check_images_in_view()
+
+    def _cancel_rescore_images(self, **kwargs):
+        if hasattr(self, "_rescore_task"):
+            self._rescore_task.cancel()
+
+    def _start_rescore_images(self, **kwargs):
+        """
+        Recompute the scores of already predicted images for a new confidence
+        score threshold, without loading, transforming or running inference.
+        Images whose annotations are not cached, evicted or still waiting on
+        predictions, go through the update pipeline to be scored.
+        """
+        self._cancel_rescore_images()
+        self._rescore_task = asynchronous.create_task(self._rescore_all_images())
+
     def on_scroll(self, visible_ids):
         self.visible_dataset_ids = visible_ids
         self._start_update_images()
@@ -1,13 +1,22 @@
 import logging
+import os
 
 from trame.widgets import quasar
 from trame.widgets import html
 from trame.app import get_server
 
-from nrtk_explorer.library.multiprocess_predictor import MultiprocessPredictor
+from nrtk_explorer.library.multiprocess_predictor import (
+    MultiprocessPredictor,
+    DEFAULT_BATCH_WINDOW,
+    DEFAULT_WARMUP_SIZE,
+)
+from nrtk_explorer.library.dataset import typical_image_size
+from nrtk_explorer.library.prediction_store import PredictionStore, DEFAULT_MAX_SIZE
 from nrtk_explorer.library.app_config import process_config
 
 from nrtk_explorer.app.applet import Applet
+from nrtk_explorer.app.images.annotations import ANNOTATION_CACHE_SIZE
+from nrtk_explorer.app.images.cache import LruCache
 from nrtk_explorer.app.images.stateful_annotations import (
     make_stateful_predictor,
 )
@@ -30,6 +39,53 @@ config_options = {
             "help": "Space separated list of inference models",
         },
     },
+    "inference_batch_window": {
+        "flags": ["--inference-batch-window"],
+        "params": {
+            "default": DEFAULT_BATCH_WINDOW,
+            "type": float,
+            "help": "Seconds a model worker waits to merge inference requests into one batch",
+        },
+    },
+    "inference_workers": {
+        "flags": ["--inference-workers"],
+        "params": {
+            "default": 1,
+            "type": int,
+            "help": "Number of worker processes per inference model",
+        },
+    },
+    "inference_threads": {
+        "flags": ["--inference-threads"],
+        "params": {
+            "default": None,
+            "type": int,
+            "help": "Torch threads of each inference worker process, "
+            "defaults to the cores divided by the inference workers",
+        },
+    },
+    "inference_letterbox": {
+        "flags": ["--inference-letterbox"],
+        "params": {
+            "action": "store_true",
+            "help": "Pad images of mixed sizes into a few shapes so inference batches fill up",
+        },
+    },
+    "prediction_cache": {
+        "flags": ["--prediction-cache"],
+        "params": {
+            "default": None,
+            "help": "SQLite file keeping predictions across restarts, disabled when not set",
+        },
+    },
+    "prediction_cache_size": {
+        "flags": ["--prediction-cache-size"],
+        "params": {
+            "default": DEFAULT_MAX_SIZE // (1024 * 1024),
+            "type": int,
+            "help": "Megabytes of predictions kept in the prediction cache",
+        },
+    },
 }
 
 
@@ -43,6 +99,13 @@ class InferenceApp(Applet):
 
         config = process_config(self.server.cli, config_options, **kwargs)
         self.state.inference_models_options = config["models"]
+        self._batch_window = config["inference_batch_window"]
+        self._num_workers = config["inference_workers"]
+        # workers of a model sharing all cores would oversubscribe them
+        self._num_threads = config["inference_threads"] or max(
+            1, (os.cpu_count() or 1) // self._num_workers
+        )
+        self._letterbox = config["inference_letterbox"]
         self.state.inference_models = [self.state.inference_models_options[0]]
         self.state.inference_multi_model = False
 
@@ -51,8 +114,18 @@ class InferenceApp(Applet):
             inference_models_obj[i + 1] = {"name": model}
 
         self.state.inference_models_obj = inference_models_obj
+        # model name -> loading, ready or error, with the load and warm-up seconds
+        self.state.inference_models_status = {}
 
         self.context.models = {}
+        self.context.setdefault("image_arena", None)
+        if config["prediction_cache"]:
+            self.context.prediction_store = PredictionStore(
+                config["prediction_cache"],
+                max_size=config["prediction_cache_size"] * 1024 * 1024,
+            )
+        else:
+            self.context.setdefault("prediction_store", None)
 
         self._ui = None
 
@@ -62,7 +135,7 @@ class InferenceApp(Applet):
 
     def on_server_ready(self, *args, **kwargs):
         self.state.change("current_dataset")(self.reset_predictor)
-        self.state.change("confidence_score_threshold")(self.start_update_images)
+        self.state.change("confidence_score_threshold")(self.rescore_images)
 
     def update_inference_models(self, models):
         if isinstance(models, str):
@@ -87,19 +160,38 @@ class InferenceApp(Applet):
 
         for model_name in models_to_remove:
             del self.context.models[model_name]
+        self.state.inference_models_status = {
+            model_name: status
+            for model_name, status in self.state.inference_models_status.items()
+            if model_name in models_set
+        }
 
         # Create any predictors that may have been added
         for model_name in models:
             if model_name not in self.context.models:
-                predictor = MultiprocessPredictor(model_name=model_name)
-                original_annotations = make_stateful_predictor(self.server, model_name)
-                transformed_annotations = make_stateful_predictor(self.server, model_name)
+                predictor = MultiprocessPredictor(
+                    model_name=model_name,
+                    batch_window=self._batch_window,
+                    arena=self.context.image_arena,
+                    num_workers=self._num_workers,
+                    num_threads=self._num_threads,
+                    letterbox=self._letterbox,
+                    warmup_size=self._warmup_size(),
+                    on_status=self.on_model_status,
+                )
+                # Identical original and transformed images share their predictions
+                by_content = LruCache(2 * ANNOTATION_CACHE_SIZE)
+                original_annotations = make_stateful_predictor(self.server, model_name, by_content)
+                transformed_annotations = make_stateful_predictor(
+                    self.server, model_name, by_content
+                )
 
                 self.context.models[model_name] = {
                     "predictor": predictor,
                     "original_annotations": original_annotations.annotations_factory,
                     "transformed_annotations": transformed_annotations.annotations_factory,
                 }
+                self.on_model_status(predictor)
 
         models_obj = {0: {"name": "ground-truth"}}
         for i, model in enumerate(models):
@@ -111,6 +203,27 @@ class InferenceApp(Applet):
 
         self.start_update_images()
 
+    def _warmup_size(self):
+        # the initial models are created before the dataset is loaded
+        if self.context.dataset is None:
+            return DEFAULT_WARMUP_SIZE
+        return typical_image_size(self.context.dataset) or DEFAULT_WARMUP_SIZE
+
+    def on_model_status(self, predictor):
+        model = self.context.models.get(predictor.model_name)
+        if model is None or model["predictor"] is not predictor:
+            return  # removed meanwhile
+        with self.state:
+            self.state.inference_models_status = {
+                **self.state.inference_models_status,
+                predictor.model_name: {
+                    "status": predictor.status.value,
+                    "message": predictor.status_message,
+                    "load_seconds": round(predictor.load_seconds, 2),
+                    "warmup_seconds": round(predictor.warmup_seconds, 2),
+                },
+            }
+
     def update_inference_multi_model(self, multi):
         if not multi:
             self.update_inference_models(self.state.inference_models[0])
@@ -122,6 +235,10 @@ class InferenceApp(Applet):
         if self.ctrl.start_update_images.exists():
             self.ctrl.start_update_images()
 
+    def rescore_images(self, *args, **kwargs):
+        if self.ctrl.rescore_images.exists():
+            self.ctrl.rescore_images()
+
     def reset_predictor(self, **kwargs):
         for obj in self.context.models.values():
             predictor = obj["predictor"]
@@ -162,6 +279,25 @@ class InferenceApp(Applet):
             classes="text-center",
         )
 
+        with html.Div(
+            v_for="(model_status, model_name) in inference_models_status",
+            key="model_name",
+            classes="row items-center q-gutter-x-sm text-caption",
+        ):
+            quasar.QSpinner(v_if="model_status.status === 'loading'", size="xs")
+            quasar.QIcon(
+                v_else=True,
+                name=("model_status.status === 'ready' ? 'check' : 'error'",),
+                color=("model_status.status === 'ready' ? 'positive' : 'negative'",),
+            )
+            html.Span("{{ model_name }}: {{ model_status.status }}")
+            html.Span(
+                "load {{ model_status.load_seconds }} s, "
+                "warm-up {{ model_status.warmup_seconds }} s",
+                v_if="model_status.status === 'ready'",
+            )
+            html.Span("{{ model_status.message }}", v_if="model_status.status === 'error'")
+
     # This is only used within when this module (file) is executed as an Standalone app.
     @property
     def ui(self):
@@ -1,3 +1,4 @@
+import logging
 from typing import Dict
 
 from nrtk_explorer.app.applet import Applet
@@ -16,6 +17,9 @@ from nrtk_explorer.library.transforms import (
     TestTransform,
 )
 
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
 
 class ParametersApp(Applet):
     def __init__(self, server):
@@ -70,7 +74,18 @@ class ParametersApp(Applet):
         if i >= len(self.context.transforms) or transform_class is None:
             return
 
-        self.context.transforms[i] = {"name": transform_name, "instance": transform_class()}
+        try:
+            # YAML perturbers are imported when first selected
+            instance = transform_class()
+        except ImportError as e:
+            logger.warning(f"Transform {transform_name} is not available: {e}")
+            del self._transform_classes[transform_name]
+            self.update_transforms_descriptions()
+            # revert the selection in the UI
+            self.update_transforms_values()
+            return
+
+        self.context.transforms[i] = {"name": transform_name, "instance": instance}
 
         self.update_transforms_values()
 
@@ -62,7 +62,7 @@ class TransformsApp(Applet):
             feature_enabled_state_key="transform_enabled",
             gui_switch_key="transform_enabled_switch",
             column_name=TRANSFORM_COLUMNS[0],
-            enabled_callback=self.on_apply_transform,
+            enabled_callback=self.on_transform_enabled,
         )
 
         self.server.controller.apply_transform.add(self.on_apply_transform)
@@ -71,9 +71,8 @@ class TransformsApp(Applet):
     def on_server_ready(self, *args, **kwargs):
         pass
 
-    def on_apply_transform(self, **kwargs):
-        # Turn on switch if user clicked lower apply button
-        self.state.transform_enabled_switch = True
+    def _set_transform(self):
+        """Returns True if the parameters changed since the last applied transform."""
         transforms = list(map(lambda t: t["instance"], self.context.transforms))
 
         for transform in transforms:
@@ -85,11 +84,32 @@ class TransformsApp(Applet):
                     )
             transform.set_parameters(params)
 
+        previous_hash = self.images.transform_hash
         chained_transform = trans.ChainedImageTransform(transforms)
-        self.images.set_transform(chained_transform)
+        if not self.images.set_transform(chained_transform):
+            return False
+        if self.ctrl.transform_changed.exists():
+            self.ctrl.transform_changed(
+                previous_hash=previous_hash, transform_hash=self.images.transform_hash
+            )
+        return True
+
+    def _run_transform(self):
         if self.ctrl.run_transform.exists():
             self.ctrl.run_transform()
 
+    def on_apply_transform(self, **kwargs):
+        # Turn on switch if user clicked lower apply button
+        self.state.transform_enabled_switch = True
+        # Applying the same parameters again has nothing to update
+        if self._set_transform():
+            self._run_transform()
+
+    def on_transform_enabled(self):
+        # Images were not transformed while disabled
+        self._set_transform()
+        self._run_transform()
+
     def settings_widget(self):
         with html.Div(classes="col"):
             self._parameters_app.transforms_ui()
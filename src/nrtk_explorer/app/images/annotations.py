@@ -5,6 +5,7 @@ from nrtk_explorer.app.images.cache import LruCache
 from nrtk_explorer.app.images.image_ids import (
     dataset_id_to_image_id,
 )
+from nrtk_explorer.library.prediction_store import content_hash
 from nrtk_explorer.library.scoring import partition
 
 ANNOTATION_CACHE_SIZE = 1000
@@ -24,11 +25,7 @@ def get_annotations_from_dataset(
 ):
     image_id = dataset_id_to_image_id(dataset_id)
     dataset = context.dataset
-    annotations = [
-        annotation
-        for annotation in dataset.anns.values()
-        if str(annotation["image_id"]) == dataset_id
-    ]
+    annotations = dataset.get_image_annotations(dataset.get_image_id(dataset_id))
     add_to_cache_callback(image_id, annotations)
     with_id = partial(delete_from_cache_callback, image_id)
     return DeleteCallbackRef(with_id, annotations)
@@ -64,10 +61,56 @@ class DetectionAnnotations:
         self,
         add_to_cache_callback,
         delete_from_cache_callback,
+        store=None,  # PredictionStore, persists predictions across restarts
+        by_content=None,  # LruCache of content hash -> predictions, shareable by image sets
+        content_hash=None,  # callable(image_id, image), hashes pixels when not given
     ):
         self.cache = LruCache(ANNOTATION_CACHE_SIZE)
         self.add_to_cache_callback = add_to_cache_callback
         self.delete_from_cache_callback = delete_from_cache_callback
+        self.store = store
+        self.by_content = by_content if by_content is not None else LruCache(ANNOTATION_CACHE_SIZE)
+        self.content_hash = content_hash
+
+    def _content_hash(self, id: str, image: Image.Image):
+        if self.content_hash is not None:
+            return self.content_hash(id, image)
+        return content_hash(image)
+
+    async def _infer(self, predictor, id_to_image: Dict[str, Image.Image]):
+        """Run the predictor once per distinct content that was not predicted before."""
+        if not id_to_image:
+            return {}
+        id_to_hash = {id: self._content_hash(id, image) for id, image in id_to_image.items()}
+
+        hash_to_predictions = {}
+        for hash in set(id_to_hash.values()):
+            predictions = self.by_content.get_item(hash)
+            if predictions is not None:
+                hash_to_predictions[hash] = predictions
+
+        missing = set(id_to_hash.values()) - hash_to_predictions.keys()
+        if self.store is not None and missing:
+            model = await predictor.get_model_key()
+            hash_to_predictions.update(self.store.get_many(model, missing))
+
+        to_detect = {
+            hash: id_to_image[id]
+            for id, hash in id_to_hash.items()
+            if hash not in hash_to_predictions
+        }
+        detected = await predictor.infer(to_detect)
+        if self.store is not None and detected:
+            self.store.put_many(model, detected)
+        hash_to_predictions.update(detected)
+
+        for hash, predictions in hash_to_predictions.items():
+            self.by_content.add_item(hash, predictions)
+        return {
+            id: hash_to_predictions[hash]
+            for id, hash in id_to_hash.items()
+            if hash in hash_to_predictions
+        }
 
     async def get_annotations(self, predictor, id_to_image: Dict[str, Image.Image]):
         hits, misses = partition(
@@ -75,7 +118,7 @@ class DetectionAnnotations:
         )
 
         to_detect = {id: id_to_image[id] for id in misses}
-        predictions = await predictor.infer(to_detect)
+        predictions = await self._infer(predictor, to_detect)
 
         for id, annotations in predictions.items():
             self.cache.add_item(
@@ -1,5 +1,9 @@
-from typing import Any, Callable, List, NamedTuple
-from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Protocol, Type
+from collections import Counter, OrderedDict
+from itertools import chain
+
+import numpy as np
+from PIL import Image
 
 Item = Any
 
@@ -8,25 +12,176 @@ class CacheItem(NamedTuple):
     item: Item
     on_add_item_callbacks: List[Callable[[str, Item], None]]
     on_clear_item_callbacks: List[Callable[[str], None]]
+    size: int  # bytes
 
 
 def noop(*args, **kwargs):
     pass
 
 
+def item_size(item: Item) -> int:
+    """Bytes held by an image, array or buffer, 0 for other items."""
+    if isinstance(item, Image.Image):
+        return item.width * item.height * len(item.getbands())
+    if isinstance(item, np.ndarray):
+        return item.nbytes
+    if isinstance(item, (bytes, bytearray, memoryview)):
+        return len(item)
+    return 0
+
+
+class EvictionPolicy(Protocol):
+    def insert(self, key: str): ...
+
+    def access(self, key: str): ...
+
+    def remove(self, key: str): ...
+
+    def victims(self) -> Iterator[str]:
+        """Keys in eviction order."""
+        ...
+
+
+class LruPolicy(EvictionPolicy):
+    """Evicts the least recently accessed key."""
+
+    def __init__(self):
+        self.keys: OrderedDict[str, None] = OrderedDict()
+
+    def insert(self, key: str):
+        self.keys[key] = None
+
+    def access(self, key: str):
+        self.keys.move_to_end(key)
+
+    def remove(self, key: str):
+        del self.keys[key]
+
+    def victims(self) -> Iterator[str]:
+        return iter(self.keys)
+
+
+class LfuPolicy(EvictionPolicy):
+    """Evicts the least frequently accessed key, the least recent one among ties."""
+
+    def __init__(self):
+        self.keys: OrderedDict[str, None] = OrderedDict()
+        self.counts: Counter = Counter()
+
+    def insert(self, key: str):
+        self.keys[key] = None
+        self.counts[key] = 1
+
+    def access(self, key: str):
+        self.keys.move_to_end(key)
+        self.counts[key] += 1
+
+    def remove(self, key: str):
+        del self.keys[key]
+        del self.counts[key]
+
+    def victims(self) -> Iterator[str]:
+        return iter(sorted(self.keys, key=self.counts.__getitem__))
+
+
+class TwoQueuePolicy(EvictionPolicy):
+    """
+    Scan resistant 2Q: keys accessed once wait in a FIFO and are evicted first,
+    keys accessed again move to an LRU. Recently evicted keys are remembered so
+    a key coming back soon after its eviction goes straight to the LRU.
+    """
+
+    def __init__(self, fifo_fraction=0.25, ghost_size=1000):
+        self.fifo_fraction = fifo_fraction
+        self.ghost_size = ghost_size
+        self.fifo: OrderedDict[str, None] = OrderedDict()
+        self.lru: OrderedDict[str, None] = OrderedDict()
+        self.ghosts: OrderedDict[str, None] = OrderedDict()
+
+    def insert(self, key: str):
+        if key in self.ghosts:
+            del self.ghosts[key]
+            self.lru[key] = None
+        else:
+            self.fifo[key] = None
+
+    def access(self, key: str):
+        if key in self.fifo:
+            del self.fifo[key]
+            self.lru[key] = None
+        else:
+            self.lru.move_to_end(key)
+
+    def remove(self, key: str):
+        if key in self.fifo:
+            del self.fifo[key]
+            self.ghosts[key] = None
+            if len(self.ghosts) > self.ghost_size:
+                self.ghosts.popitem(last=False)
+        else:
+            del self.lru[key]
+
+    def victims(self) -> Iterator[str]:
+        total = len(self.fifo) + len(self.lru)
+        if len(self.fifo) > self.fifo_fraction * total:
+            return chain(self.fifo, self.lru)
+        return chain(self.lru, self.fifo)
+
+
+EVICTION_POLICIES: Dict[str, Type[EvictionPolicy]] = {
+    "lru": LruPolicy,
+    "lfu": LfuPolicy,
+    "2q": TwoQueuePolicy,
+}
+
+
 class LruCache:
     """
-    Least recently accessed item is removed when the cache is full.
+    Items are removed when the cache holds more than max_size items or
+    max_bytes bytes, as sized by the sizer. The eviction policy picks which:
+    least recently accessed ("lru"), least frequently accessed ("lfu"), or
+    "2q", which keeps items accessed more than once over items seen in a scan.
     Per item callbacks are called when an item is added or cleared.
     Useful for side effects like updating the trame state.
+    on_evict is called with the key and the item of each item evicted for room,
+    for example to move it to a slower tier.
     """
 
-    def __init__(self, max_size: int):
-        self.cache: OrderedDict[str, CacheItem] = OrderedDict()
+    def __init__(
+        self,
+        max_size: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        sizer: Callable[[Item], int] = item_size,
+        policy: str = "lru",
+        on_evict: Callable[[str, Item], None] = noop,
+    ):
+        self.cache: Dict[str, CacheItem] = {}
         self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.sizer = sizer
+        self.policy: EvictionPolicy = EVICTION_POLICIES[policy]()
+        self.on_evict = on_evict
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _over_budget(self, extra_items=0, extra_bytes=0):
+        return (self.max_size is not None and len(self.cache) + extra_items > self.max_size) or (
+            self.max_bytes is not None and self.bytes + extra_bytes > self.max_bytes
+        )
 
     def _cache_full(self):
-        return len(self.cache) >= self.max_size
+        return self._over_budget(extra_items=1)
+
+    def _evict(self, keep: str):
+        """Evict items over the budget, except the item that was just added."""
+        while self._over_budget() and len(self.cache) > 1:
+            victim = next(key for key in self.policy.victims() if key != keep)
+            item = self.cache[victim].item
+            self._clear_item(victim)
+            self.evictions += 1
+            self.on_evict(victim, item)
 
     def add_item(
         self,
@@ -40,15 +195,12 @@ class LruCache:
         Runs on_add_item callback if callback does not exist in current item callbacks list or item is new
         """
         cache_item = self.cache.get(key)
-        if cache_item and cache_item.item != item:
+        # by identity, equality of arrays is elementwise
+        if cache_item and cache_item.item is not item:
             # stale cached item, clear it
             self._clear_item(key)
             cache_item = None
 
-        if self._cache_full():
-            oldest = next(iter(self.cache))
-            self._clear_item(oldest)
-
         if cache_item:
             # Update callbacks list only if they are not already present
             if on_add_item not in cache_item.on_add_item_callbacks:
@@ -56,28 +208,33 @@ class LruCache:
                 on_add_item(key, item)
             if on_clear_item not in cache_item.on_clear_item_callbacks:
                 cache_item.on_clear_item_callbacks.append(on_clear_item)
+            self.policy.access(key)
         else:
             # Create a new CacheItem and add it to the cache
             cache_item = CacheItem(
                 item=item,
                 on_add_item_callbacks=[on_add_item],
                 on_clear_item_callbacks=[on_clear_item],
+                size=self.sizer(item),
             )
             self.cache[key] = cache_item
+            self.bytes += cache_item.size
+            self.policy.insert(key)
             on_add_item(key, item)
-
-        self.cache.move_to_end(key)
+            self._evict(keep=key)
 
     def add_if_room(self, key: str, item: Item, **kwargs):
         """Does not remove items from cache, only adds."""
-        if not self._cache_full():
+        if key in self.cache or not self._over_budget(1, self.sizer(item)):
             self.add_item(key, item, **kwargs)
 
     def get_item(self, key: str):
         """Retrieve an item from the cache."""
         if key in self.cache:
-            self.cache.move_to_end(key)
+            self.hits += 1
+            self.policy.access(key)
             return self.cache[key].item
+        self.misses += 1
         return None
 
     def _clear_item(self, key: str):
@@ -85,9 +242,21 @@ class LruCache:
         if key in self.cache:
             for callback in self.cache[key].on_clear_item_callbacks:
                 callback(key)
+            self.bytes -= self.cache[key].size
+            self.policy.remove(key)
             del self.cache[key]
 
     def clear(self):
         """Clear the cache."""
         for key in list(self.cache.keys()):
             self._clear_item(key)
+
+    def stats(self):
+        """Counters for monitoring the cache."""
+        return {
+            "items": len(self.cache),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -1,10 +1,18 @@
 from aiohttp import web
+import asyncio
 import io
+import json
+import math
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, NamedTuple, Optional
+import xxhash
 from PIL import Image
 from trame.decorators import TrameApp, controller
 from functools import partial
 from nrtk_explorer.app.trame_utils import change_checker, delete_state
 from nrtk_explorer.app.images.images import Images
+from nrtk_explorer.library.dataset import fit_image
 from nrtk_explorer.app.images.image_ids import (
     dataset_id_to_image_id,
     dataset_id_to_transformed_image_id,
@@ -12,10 +20,27 @@ from nrtk_explorer.app.images.image_ids import (
 
 ORIGINAL_IMAGE_ENDPOINT = "original-image"
 TRANSFORM_IMAGE_ENDPOINT = "transform-image"
+SPRITE_ENDPOINT = "image-sprite"
+# Variant of the sprite endpoint for original images, otherwise it is a transform hash
+ORIGINAL_VARIANT = "original"
 
 
 COMPATIBLE_FORMATS = {"JPG", "JPEG", "PNG", "GIF", "WEBP"}
 
+# Threads decoding, transforming and encoding images for the endpoints.
+# PIL releases the GIL while it works, and the event loop stays responsive.
+IMAGE_WORKERS = 4
+# Seconds between checks that the client still waits for its image
+DISCONNECT_POLL_INTERVAL = 0.1
+ENCODED_CACHE_SIZE = 256 * 1024 * 1024  # bytes
+# URLs identify the image content, so browsers never need to revalidate
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Bounds of the ?max= thumbnail size query parameter, in pixels
+MIN_THUMBNAIL_SIZE = 16
+MAX_THUMBNAIL_SIZE = 4096
+SPRITE_THUMBNAIL_SIZE = 128
+MAX_SPRITE_IMAGES = 64
+
 
 def is_browser_compatible_image(format):
     # Check if the image format is compatible with web browsers
@@ -24,49 +49,328 @@ def is_browser_compatible_image(format):
     return format.upper() in COMPATIBLE_FORMATS
 
 
-def ensure_browser_compatible_format(image: Image.Image):
+def ensure_browser_compatible_format(image: Image.Image, webp=False):
     if is_browser_compatible_image(image.format):
         return image.format
-    return "JPEG"
+    return "WEBP" if webp else "JPEG"
+
+
+def compose_sprite(id_to_image: Dict[str, Image.Image], max_size: int):
+    """
+    Tile the images, scaled to fit in max_size squares, into one sprite sheet.
+    Returns the sheet and the (x, y, width, height) of each image in it.
+    """
+    columns = max(1, math.ceil(math.sqrt(len(id_to_image))))
+    rows = max(1, math.ceil(len(id_to_image) / columns))
+    sprite = Image.new("RGB", (columns * max_size, rows * max_size))
+    layout = {}
+    for i, (id, image) in enumerate(id_to_image.items()):
+        image = fit_image(image, max_size)
+        x, y = (i % columns) * max_size, (i // columns) * max_size
+        sprite.paste(image.convert("RGB") if image.mode != "RGB" else image, (x, y))
+        layout[id] = (x, y, image.width, image.height)
+    return sprite, layout
+
 
+def encode_sprite(id_to_image: Dict[str, Image.Image], max_size: int, webp=False):
+    sprite, layout = compose_sprite(id_to_image, max_size)
+    body, content_type = encode_image(sprite, webp=webp)
+    return body, content_type, json.dumps(layout)
 
-def make_response(image: Image.Image):
-    format = ensure_browser_compatible_format(image)
+
+def encode_image(image: Image.Image, max_size=None, webp=False):
+    """Encode in the format of the image file, or WebP when the browser accepts it."""
+    if max_size is not None:
+        image = fit_image(image, max_size)
+    format = ensure_browser_compatible_format(image, webp)
     bytes_io = io.BytesIO()
     image.save(bytes_io, format=format)
-    bytes_io.seek(0)
-    return web.Response(body=bytes_io.read(), content_type=f"image/{format.lower()}")
+    return bytes_io.getvalue(), f"image/{format.lower()}"
+
+
+class SingleFlight:
+    """
+    Concurrent calls with the same key share one computation.
+    The computation is cancelled once no caller waits for it anymore.
+    """
+
+    def __init__(self):
+        self._calls: dict = {}  # key -> [task, number of waiting callers]
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def run(self, key, coroutine_function):
+        call = self._calls.get(key)
+        if call is None:
+            call = [asyncio.ensure_future(coroutine_function()), 0]
+            self._calls[key] = call
+            call[0].add_done_callback(lambda _: self._forget(key, call))
+        call[1] += 1
+        try:
+            return await asyncio.shield(call[0])
+        finally:
+            call[1] -= 1
+            if call[1] == 0 and not call[0].done():
+                call[0].cancel()
+                self._forget(key, call)
+
+    def _forget(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+
+def is_client_connected(request: web.Request):
+    return request.transport is not None and not request.transport.is_closing()
+
+
+async def while_connected(request: web.Request, awaitable):
+    """Await unless the client disconnects first, then cancel the awaitable."""
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if not is_client_connected(request):
+                raise asyncio.CancelledError()
+    finally:
+        task.cancel()
+
+
+class ImageEncoder:
+    """Loads, transforms and encodes images for the endpoints in a bounded thread pool."""
+
+    def __init__(self, images: Images, max_workers=IMAGE_WORKERS):
+        self.images = images
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._in_flight = SingleFlight()
+
+    async def _encode(self, image: Image.Image, max_size, webp):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, encode_image, image, max_size, webp)
+
+    async def original_source(self, dataset_id: str):
+        """Encoded original as stored by the dataset, None when it has to be decoded."""
+        dataset = self.images.server.context.dataset
+        loop = asyncio.get_running_loop()
+        source = await loop.run_in_executor(
+            self.executor, dataset.get_image_source, int(dataset_id)
+        )
+        if source is None or not is_browser_compatible_image(source.format):
+            return None
+        return source
+
+    async def encode_original(self, dataset_id: str, max_size=None, webp=False):
+        async def load_and_encode():
+            if max_size is None:
+                image = await self.images.get_image_async(dataset_id, self.executor)
+            else:
+                image = await self.images.get_thumbnail_async(dataset_id, max_size, self.executor)
+            return await self._encode(image, max_size, webp)
+
+        key = ("original", dataset_id, max_size, webp)
+        return await self._in_flight.run(key, load_and_encode)
+
+    async def encode_transformed(self, dataset_id: str, max_size=None, webp=False):
+        async def transform_and_encode():
+            # transforms depend on the resolution, so transform full size and then scale down
+            image = await self.images.get_transformed_image_async(dataset_id, self.executor)
+            return await self._encode(image, max_size, webp)
+
+        key = ("transformed", dataset_id, self.images.transform_hash, max_size, webp)
+        return await self._in_flight.run(key, transform_and_encode)
+
+    async def encode_sprite(self, dataset_ids, transformed: bool, max_size: int, webp=False):
+        async def load_and_encode():
+            if transformed:
+                loads = [
+                    self.images.get_transformed_image_async(id, self.executor)
+                    for id in dataset_ids
+                ]
+            else:
+                loads = [
+                    self.images.get_thumbnail_async(id, max_size, self.executor)
+                    for id in dataset_ids
+                ]
+            id_to_image = dict(zip(dataset_ids, await asyncio.gather(*loads)))
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self.executor, encode_sprite, id_to_image, max_size, webp
+            )
+
+        transform = self.images.transform_hash if transformed else None
+        key = ("sprite", tuple(dataset_ids), transform, max_size, webp)
+        return await self._in_flight.run(key, load_and_encode)
+
+
+class EncodedImage(NamedTuple):
+    body: bytes
+    content_type: str
+    etag: str
+    sprite_layout: Optional[str] = None  # JSON of the image rectangles of a sprite sheet
+
 
+def make_encoded_image(body: bytes, content_type: str, sprite_layout: Optional[str] = None):
+    digest = xxhash.xxh3_128(body)
+    if sprite_layout is not None:
+        digest.update(sprite_layout.encode())
+    return EncodedImage(body, content_type, f'"{digest.hexdigest()}"', sprite_layout)
 
-async def original_image_endpoint(images: Images, state_id_to_dataset_id, request: web.Request):
-    dataset_id = state_id_to_dataset_id[request.match_info["id"]]
-    image = images.get_image(dataset_id)
-    return make_response(image)
 
+class EncodedImageCache:
+    """Least recently used encoded images are removed past max_size bytes."""
 
-async def transform_image_endpoint(images: Images, state_id_to_dataset_id, request: web.Request):
-    dataset_id = state_id_to_dataset_id[request.match_info["id"]]
-    image = images.get_transformed_image(dataset_id)
-    return make_response(image)
+    def __init__(self, max_size: int = ENCODED_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self._items: OrderedDict[tuple, EncodedImage] = OrderedDict()
+
+    def get(self, key: tuple):
+        encoded = self._items.get(key)
+        if encoded is not None:
+            self._items.move_to_end(key)
+        return encoded
+
+    def add(self, key: tuple, encoded: EncodedImage):
+        previous = self._items.pop(key, None)
+        if previous is not None:
+            self.size -= len(previous.body)
+        self._items[key] = encoded
+        self.size += len(encoded.body)
+        while self.size > self.max_size and len(self._items) > 1:
+            _, evicted = self._items.popitem(last=False)
+            self.size -= len(evicted.body)
+
+    def __len__(self):
+        return len(self._items)
+
+
+def parse_image_query(request: web.Request):
+    """Thumbnail size from the ?max= parameter and whether the browser accepts WebP."""
+    max_size = None
+    if "max" in request.query:
+        try:
+            max_size = min(max(int(request.query["max"]), MIN_THUMBNAIL_SIZE), MAX_THUMBNAIL_SIZE)
+        except ValueError:
+            raise web.HTTPBadRequest(reason="max should be an integer")
+    webp = "image/webp" in request.headers.get("Accept", "")
+    return max_size, webp
+
+
+def etag_matches(if_none_match: str, etag: str):
+    """Whether an If-None-Match header lists the entity tag, weak tags match too."""
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag == "*" or tag.removeprefix("W/") == etag for tag in tags)
+
+
+def make_response(request: web.Request, encoded: EncodedImage):
+    headers = {
+        "ETag": encoded.etag,
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL,
+        "Vary": "Accept",
+    }
+    if encoded.sprite_layout is not None:
+        headers["X-Sprite-Layout"] = encoded.sprite_layout
+    if etag_matches(request.headers.get("If-None-Match", ""), encoded.etag):
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=encoded.body, content_type=encoded.content_type, headers=headers)
+
+
+async def original_image_endpoint(image_server: "ImageServer", request: web.Request):
+    dataset_key = request.match_info["dataset"]
+    dataset_id = request.match_info["id"]
+    max_size, webp = parse_image_query(request)
+    key = (ORIGINAL_IMAGE_ENDPOINT, dataset_key, dataset_id, max_size, webp)
+    encoded = image_server.encoded_images.get(key)
+    if encoded is None:
+        if dataset_key != image_server.dataset_key:
+            raise web.HTTPNotFound()
+        if max_size is None:
+            # Send the file as it is, without decoding and encoding it again
+            source = await while_connected(
+                request, image_server.encoder.original_source(dataset_id)
+            )
+            if source is not None:
+                content_type = f"image/{source.format.lower()}"
+                if source.path is not None:
+                    headers = {
+                        "Cache-Control": IMMUTABLE_CACHE_CONTROL,
+                        "Content-Type": content_type,
+                    }
+                    return web.FileResponse(source.path, headers=headers)
+                encoded = make_encoded_image(source.data, content_type)
+        if encoded is None:
+            encode = image_server.encoder.encode_original(dataset_id, max_size, webp)
+            encoded = make_encoded_image(*await while_connected(request, encode))
+        image_server.encoded_images.add(key, encoded)
+    return make_response(request, encoded)
+
+
+async def transform_image_endpoint(image_server: "ImageServer", request: web.Request):
+    dataset_key = request.match_info["dataset"]
+    transform_key = request.match_info["transform"]
+    dataset_id = request.match_info["id"]
+    max_size, webp = parse_image_query(request)
+    key = (TRANSFORM_IMAGE_ENDPOINT, dataset_key, transform_key, dataset_id, max_size, webp)
+    encoded = image_server.encoded_images.get(key)
+    if encoded is None:
+        images = image_server.images
+        if dataset_key != image_server.dataset_key or transform_key != images.transform_hash:
+            raise web.HTTPNotFound()
+        encode = image_server.encoder.encode_transformed(dataset_id, max_size, webp)
+        encoded = make_encoded_image(*await while_connected(request, encode))
+        if transform_key != images.transform_hash:
+            raise web.HTTPNotFound()  # transform changed meanwhile, the URL is stale
+        image_server.encoded_images.add(key, encoded)
+    return make_response(request, encoded)
+
+
+async def sprite_endpoint(image_server: "ImageServer", request: web.Request):
+    """
+    Sprite sheet of the thumbnails of the dataset ids in the ?ids= comma separated list.
+    The X-Sprite-Layout header maps each id to its (x, y, width, height) in the sheet.
+    """
+    dataset_key = request.match_info["dataset"]
+    variant = request.match_info["variant"]
+    dataset_ids = [id for id in request.query.get("ids", "").split(",") if id]
+    if not dataset_ids or len(dataset_ids) > MAX_SPRITE_IMAGES:
+        raise web.HTTPBadRequest(reason=f"ids should list 1 to {MAX_SPRITE_IMAGES} dataset ids")
+    max_size, webp = parse_image_query(request)
+    max_size = max_size or SPRITE_THUMBNAIL_SIZE
+    key = (SPRITE_ENDPOINT, dataset_key, variant, tuple(dataset_ids), max_size, webp)
+    encoded = image_server.encoded_images.get(key)
+    if encoded is None:
+        images = image_server.images
+        transformed = variant != ORIGINAL_VARIANT
+        if dataset_key != image_server.dataset_key or (
+            transformed and variant != images.transform_hash
+        ):
+            raise web.HTTPNotFound()
+        encode = image_server.encoder.encode_sprite(dataset_ids, transformed, max_size, webp)
+        encoded = make_encoded_image(*await while_connected(request, encode))
+        if transformed and variant != images.transform_hash:
+            raise web.HTTPNotFound()  # transform changed meanwhile, the URL is stale
+        image_server.encoded_images.add(key, encoded)
+    return make_response(request, encoded)
 
 
 @TrameApp()
 class ImageServer:
+    """
+    Serves dataset images under URLs derived from their content: the dataset,
+    the image id and, for transformed images, the hash of the transform chain.
+    """
+
     def __init__(self, server, images: Images):
         self.server = server
         self.images = images
-        self._id_counter = 0
-        self._state_id_to_dataset_id = {}
-        self._transform_keys = set()
+        self.encoder = ImageEncoder(images)
+        self.encoded_images = EncodedImageCache()
 
-        self._endpoint_handler = partial(
-            original_image_endpoint, images, self._state_id_to_dataset_id
-        )
-        self._transform_endpoint_handler = partial(
-            transform_image_endpoint,
-            images,
-            self._state_id_to_dataset_id,
-        )
+        self._endpoint_handler = partial(original_image_endpoint, self)
+        self._transform_endpoint_handler = partial(transform_image_endpoint, self)
+        self._sprite_endpoint_handler = partial(sprite_endpoint, self)
 
         self.url_prefix = (
             f"/api/{self.server.context.session}" if self.server.context.session else ""
@@ -74,53 +378,56 @@ class ImageServer:
 
         change_checker(self.server.state, "dataset_ids")(self.on_dataset_ids_change)
 
+    @property
+    def dataset_key(self):
+        return xxhash.xxh3_64_hexdigest(str(self.server.state.current_dataset).encode())
+
     @controller.add("on_server_bind")
     def app_available(self, wslink_server, **kwargs):
         """Add our custom REST endpoints to the trame server."""
         image_routes = [
-            web.get(f"/{ORIGINAL_IMAGE_ENDPOINT}/{{id}}", self._endpoint_handler),
-            web.get(f"/{TRANSFORM_IMAGE_ENDPOINT}/{{id}}", self._transform_endpoint_handler),
+            web.get(f"/{ORIGINAL_IMAGE_ENDPOINT}/{{dataset}}/{{id}}", self._endpoint_handler),
+            web.get(
+                f"/{TRANSFORM_IMAGE_ENDPOINT}/{{dataset}}/{{transform}}/{{id}}",
+                self._transform_endpoint_handler,
+            ),
+            web.get(f"/{SPRITE_ENDPOINT}/{{dataset}}/{{variant}}", self._sprite_endpoint_handler),
         ]
         wslink_server.app.add_routes(image_routes)
 
+    def sprite_url(self, dataset_ids, transformed=False, max_size=SPRITE_THUMBNAIL_SIZE):
+        variant = self.images.transform_hash if transformed else ORIGINAL_VARIANT
+        ids = ",".join(str(id) for id in dataset_ids)
+        return (
+            f"{self.url_prefix}/{SPRITE_ENDPOINT}/{self.dataset_key}/{variant}"
+            f"?ids={ids}&max={max_size}"
+        )
+
+    def _set_transform_urls(self, dataset_ids):
+        dataset_key = self.dataset_key
+        transform_key = self.images.transform_hash
+        for id in dataset_ids:
+            self.server.state[dataset_id_to_transformed_image_id(id)] = (
+                f"{self.url_prefix}/{TRANSFORM_IMAGE_ENDPOINT}/{dataset_key}/{transform_key}/{id}"
+            )
+
     def on_dataset_ids_change(self, old_ids, new_ids):
         if old_ids is not None:
             to_clean = set(old_ids) - set(new_ids)
             for id in to_clean:
                 delete_state(self.server.state, dataset_id_to_image_id(id))
                 delete_state(self.server.state, dataset_id_to_transformed_image_id(id))
-                keys_to_delete = [k for k, v in self._state_id_to_dataset_id.items() if v == id]
-                for key in keys_to_delete:
-                    del self._state_id_to_dataset_id[key]
-                    if key in self._transform_keys:
-                        self._transform_keys.remove(key)
-
-        to_add = set(new_ids) - set(old_ids) if old_ids is not None else new_ids
-        for id in to_add:
-            # Original
-            self._id_counter += 1
-            orig_key = str(self._id_counter)
-            self._state_id_to_dataset_id[orig_key] = id
-            self.server.state[dataset_id_to_image_id(id)] = (
-                f"{self.url_prefix}/{ORIGINAL_IMAGE_ENDPOINT}/{orig_key}"
-            )
 
-            # Transform
-            self._id_counter += 1
-            trans_key = str(self._id_counter)
-            self._state_id_to_dataset_id[trans_key] = id
-            self._transform_keys.add(trans_key)
-            self.server.state[dataset_id_to_transformed_image_id(id)] = (
-                f"{self.url_prefix}/{TRANSFORM_IMAGE_ENDPOINT}/{trans_key}"
+        # Ids kept from a previous dataset get the URL of the current one,
+        # unchanged URLs are not sent again.
+        dataset_key = self.dataset_key
+        for id in new_ids:
+            self.server.state[dataset_id_to_image_id(id)] = (
+                f"{self.url_prefix}/{ORIGINAL_IMAGE_ENDPOINT}/{dataset_key}/{id}"
             )
+        self._set_transform_urls(new_ids)
 
-    @controller.add("apply_transform")
+    @controller.add("run_transform")
     def refresh_transform_images(self, **kwargs):
-        for id in self.server.state.dataset_ids:
-            self._id_counter += 1
-            trans_key = str(self._id_counter)
-            self._state_id_to_dataset_id[trans_key] = id
-            self._transform_keys.add(trans_key)
-            self.server.state[dataset_id_to_transformed_image_id(id)] = (
-                f"{self.url_prefix}/{TRANSFORM_IMAGE_ENDPOINT}/{trans_key}"
-            )
+        # Reapplying a transform keeps its URLs, the browser reuses the fetched images
+        self._set_transform_urls(self.server.state.dataset_ids)
@@ -1,46 +1,125 @@
+import asyncio
+import threading
+from functools import partial
+from typing import AsyncIterator, Dict, Optional, Sequence, Tuple
+
+import numpy as np
 import psutil
 from PIL import Image
 from trame.decorators import TrameApp, change
 from nrtk_explorer.app.images.image_ids import (
     dataset_id_to_image_id,
     dataset_id_to_transformed_image_id,
+    image_id_to_dataset_id,
+    is_transformed,
 )
 from nrtk_explorer.app.images.cache import LruCache
+from nrtk_explorer.library.frame_spill import FrameSpill
+from nrtk_explorer.library.prediction_store import content_hash
+from nrtk_explorer.library.shared_images import DEFAULT_SEGMENT_SIZE, SharedImageArena
+from nrtk_explorer.library.transform_executor import (
+    TransformExecutor,
+    serialize_transform,
+    transform_steps,
+)
+from nrtk_explorer.library.transforms import chain_prefix_hashes, transform_hash
 
-IMAGE_CACHE_SIZE_DEFAULT = 50
 AVALIBLE_MEMORY_TO_TAKE_FACTOR = 0.4
+# 2q keeps images the user looks at while metrics are computed over the whole dataset
+IMAGE_CACHE_POLICY = "2q"
+ORIGINAL_TRANSFORM_HASH = transform_hash(None)
+
+
+def image_cache_bytes():
+    """Budget of each of the original and transformed image caches."""
+    system_memory = psutil.virtual_memory().available
+    return round(system_memory * AVALIBLE_MEMORY_TO_TAKE_FACTOR) // 2
+
+
+def transform_memo_bytes():
+    """Budget of the outputs of the first steps of transform chains."""
+    return image_cache_bytes() // 2
 
 
 @TrameApp()
 class Images:
-    def __init__(self, server):
+    def __init__(
+        self,
+        server,
+        spill: Optional[FrameSpill] = None,
+        transform_executor: Optional[TransformExecutor] = None,
+        shared_memory_size: int = DEFAULT_SEGMENT_SIZE,
+    ):
         self.server = server
-        self.original_images = LruCache(IMAGE_CACHE_SIZE_DEFAULT)
-        self.transformed_images = LruCache(IMAGE_CACHE_SIZE_DEFAULT)
-        self._should_ajust_cache_size = [True, True]
+        # Images evicted from memory are written here instead of being decoded or transformed again
+        self.spill = spill
+        cache_bytes = image_cache_bytes()
+        self.original_images = LruCache(
+            max_bytes=cache_bytes, policy=IMAGE_CACHE_POLICY, on_evict=self._spill_original
+        )
+        self.transformed_images = LruCache(
+            max_bytes=cache_bytes, policy=IMAGE_CACHE_POLICY, on_evict=self._spill_transformed
+        )
+        # outputs of chain prefixes, so changing step k of a chain reruns steps k onwards
+        self.transform_memo = LruCache(max_bytes=transform_memo_bytes())
+        self._transform_memo_lock = threading.Lock()  # transforms run in executor threads
+        # bumped when the dataset changes, loads and transforms started before do not cache
+        self._dataset_generation = 0
         self._transform = None
+        self.transform_hash = ORIGINAL_TRANSFORM_HASH
+        # Transforms heavy perturbers in other processes when set
+        self.transform_executor = transform_executor
+        # transformed image id -> task transforming it with the current transform
+        self._transform_tasks: Dict[str, asyncio.Future] = {}
+        # Frames shared with predictor workers live as long as their cached images,
+        # images are pickled to the workers without it
+        self.arena: Optional[SharedImageArena] = None
+        if shared_memory_size > 0:
+            self.arena = SharedImageArena(segment_size=shared_memory_size)
+        # image id -> hash of its pixels, computed once when the image is loaded
+        self._original_hashes: dict[str, str] = {}
+        self._transformed_hashes: dict[str, str] = {}
 
-    def _ajust_cache_size(self, image_example: Image.Image):
-        img_size = len(image_example.tobytes())
-        system_memory = psutil.virtual_memory().available
-        mem_for_cache = round(system_memory * AVALIBLE_MEMORY_TO_TAKE_FACTOR)
-        images_that_fit = max(min(mem_for_cache // img_size, 500), 50)
-        cache_size = images_that_fit // 2
-        return LruCache(cache_size)
+    def _frame_key(self, dataset_id: str, transform_key: str):
+        """Key of the image of a dataset id, transformed by the transform with the given hash."""
+        return f"{self.server.state.current_dataset}:{transform_key}:{dataset_id}"
 
-    def _load_image(self, dataset_id: str):
-        img = self.server.context.dataset.get_image(int(dataset_id))
-        img.load()  # Avoid OSError(24, 'Too many open files')
+    def _spill_original(self, image_id: str, image: Image.Image):
+        if self.spill is not None:
+            key = self._frame_key(image_id_to_dataset_id(image_id), ORIGINAL_TRANSFORM_HASH)
+            self.spill.put(key, image)
 
-        if self._should_ajust_cache_size[0]:
-            self._should_ajust_cache_size[0] = False
-            self.original_images = self._ajust_cache_size(
-                img
-            )  # assuming images in dataset are similar size
+    def _spill_transformed(self, image_id: str, image: Image.Image):
+        if self.spill is not None:
+            key = self._frame_key(image_id_to_dataset_id(image_id), self.transform_hash)
+            self.spill.put(key, image)
 
+    def _read_spilled(self, dataset_id: str, transform_key: str):
+        if self.spill is None:
+            return None
+        return self.spill.get(self._frame_key(dataset_id, transform_key))
+
+    def _read_image(self, dataset_id: str):
+        """Decode an image, touches no cache so it can run in an executor."""
+        spilled = self._read_spilled(dataset_id, ORIGINAL_TRANSFORM_HASH)
+        if spilled is not None:
+            return spilled
+        img = self.server.context.dataset.get_image(int(dataset_id))
+        img.load()  # Avoid OSError(24, 'Too many open files')
         # transforms and base64 encoding require RGB mode
         return img.convert("RGB") if img.mode != "RGB" else img
 
+    def _read_thumbnail(self, dataset_id: str, max_size: int):
+        img = self.server.context.dataset.get_thumbnail(int(dataset_id), max_size)
+        return img.convert("RGB") if img.mode != "RGB" else img
+
+    def _on_image_loaded(self, dataset_id: str, img: Image.Image):
+        self._original_hashes[dataset_id_to_image_id(dataset_id)] = content_hash(img)
+        return img
+
+    def _load_image(self, dataset_id: str):
+        return self._on_image_loaded(dataset_id, self._read_image(dataset_id))
+
     def get_image(self, dataset_id: str, **kwargs):
         """For cache side effects pass on_add_item and on_clear_item callbacks as kwargs"""
         image_id = dataset_id_to_image_id(dataset_id)
@@ -62,19 +141,113 @@ class Images:
         self.original_images.add_if_room(image_id, image)
         return image
 
-    def _load_transformed_image(self, dataset_id: str):
-        original = self.get_image_without_cache_eviction(dataset_id)
-        transformed = self._transform.execute(original)
+    def _memoized_prefix(self, dataset_id: str, prefixes: Sequence[str], original: Image.Image):
+        """Output of the longest memoized chain prefix and the index of the next step."""
+        with self._transform_memo_lock:
+            for i in reversed(range(len(prefixes) - 1)):
+                memoized = self.transform_memo.get_item(self._frame_key(dataset_id, prefixes[i]))
+                if memoized is not None:
+                    return memoized, i + 1
+        return np.asarray(original), 0
+
+    def _memoize(
+        self,
+        dataset_id: str,
+        prefixes: Sequence[str],
+        step: int,
+        output,
+        generation: Optional[int] = None,
+    ):
+        # the last step output is cached as the transformed image
+        if step < len(prefixes) - 1:
+            with self._transform_memo_lock:
+                if generation is None or generation == self._dataset_generation:
+                    key = self._frame_key(dataset_id, prefixes[step])
+                    self.transform_memo.add_item(key, output)
+
+    def _execute_transform(
+        self, transform, dataset_ids: Sequence[str], originals, generation: Optional[int] = None
+    ):
+        """
+        Run the steps of a chain not memoized yet for each image, one batch
+        per step, and memoize the outputs of all steps but the last one.
+        """
+        steps = transform_steps(transform)
+        prefixes = chain_prefix_hashes(steps)
+        outputs, starts = [], []
+        for dataset_id, original in zip(dataset_ids, originals):
+            output, start = self._memoized_prefix(dataset_id, prefixes, original)
+            outputs.append(output)
+            starts.append(start)
+        for i, step in enumerate(steps):
+            indices = [index for index, start in enumerate(starts) if start <= i]
+            if not indices:
+                continue
+            results = step.execute_batch([outputs[index] for index in indices])
+            for index, result in zip(indices, results):
+                outputs[index] = result
+                self._memoize(dataset_ids[index], prefixes, i, result, generation)
+        return outputs
+
+    @staticmethod
+    def _to_transformed_image(original: Image.Image, output) -> Image.Image:
+        transformed = Image.fromarray(output)
         # So pixel-wise annotation similarity score works
         if original.size != transformed.size:
             transformed = transformed.resize(original.size)
+        return transformed
+
+    def _apply_transform_batch(
+        self, transform, dataset_ids: Sequence[str], originals, generation: Optional[int] = None
+    ):
+        """
+        Transform images, safe to run in an executor. Outputs are not memoized
+        if the dataset changed since the generation.
+        """
+        outputs = self._execute_transform(transform, dataset_ids, originals, generation)
+        return [
+            self._to_transformed_image(original, output)
+            for original, output in zip(originals, outputs)
+        ]
+
+    async def _apply_transform_in_process(
+        self,
+        transform_executor: TransformExecutor,
+        transform,
+        dataset_id: str,
+        original,
+        generation: Optional[int] = None,
+    ):
+        """Run the steps of the chain not memoized yet in the transform executor."""
+        steps = transform_steps(transform)
+        prefixes = chain_prefix_hashes(steps)
+        output, start = self._memoized_prefix(dataset_id, prefixes, original)
+        specs = serialize_transform(transform)[start:]
+        if specs:
+            # the outputs of the first steps are memoized too
+            outputs = await transform_executor.submit(specs, output, with_prefixes=True)
+            for step, step_output in enumerate(outputs, start):
+                self._memoize(dataset_id, prefixes, step, step_output, generation)
+            output = outputs[-1]
+        return self._to_transformed_image(original, output)
 
-        if self._should_ajust_cache_size[1]:
-            self._should_ajust_cache_size[1] = False
-            self.transformed_images = self._ajust_cache_size(
-                transformed
-            )  # assuming images in dataset are similar size
+    def _apply_transform(
+        self, transform, dataset_id: str, original: Image.Image, generation: Optional[int] = None
+    ):
+        return self._apply_transform_batch(transform, [dataset_id], [original], generation)[0]
 
+    def _load_transformed_image(self, dataset_id: str):
+        spilled = self._read_spilled(dataset_id, self.transform_hash)
+        if spilled is not None:
+            return self._on_transformed_loaded(dataset_id, spilled)
+        original = self.get_image_without_cache_eviction(dataset_id)
+        transformed = self._apply_transform(self._transform, dataset_id, original)
+        return self._on_transformed_loaded(dataset_id, transformed)
+
+    def _on_transformed_loaded(self, dataset_id: str, transformed: Image.Image):
+        self._transformed_hashes[dataset_id_to_transformed_image_id(dataset_id)] = content_hash(
+            transformed
+        )
         return transformed
 
     def _get_transformed_image(self, dataset_id: str, **kwargs):
@@ -94,13 +267,271 @@ class Images:
         self.transformed_images.add_if_room(image_id, image)
         return image
 
+    def get_transformed_images_without_cache_eviction(self, dataset_ids: Sequence[str]):
+        """
+        Like get_transformed_image_without_cache_eviction, but images missing
+        from the caches are transformed together, one batch per chain step.
+        """
+        id_to_image, missing = self._split_cached_transformed(dataset_ids)
+        originals = [self.get_image_without_cache_eviction(dataset_id) for dataset_id in missing]
+        transformed_images = self._apply_transform_batch(self._transform, missing, originals)
+        id_to_image.update(zip(missing, transformed_images))
+        return self._add_transformed_if_room(dataset_ids, id_to_image)
+
+    def _split_cached_transformed(self, dataset_ids: Sequence[str]):
+        """Transformed images found in the cache or the spill, and ids of the others."""
+        id_to_image = {}
+        missing = []
+        for dataset_id in dataset_ids:
+            image = self.transformed_images.get_item(
+                dataset_id_to_transformed_image_id(dataset_id)
+            ) or self._read_spilled(dataset_id, self.transform_hash)
+            if image is None:
+                missing.append(dataset_id)
+            else:
+                id_to_image[dataset_id] = image
+        return id_to_image, missing
+
+    def _add_transformed_if_room(self, dataset_ids: Sequence[str], id_to_image):
+        for dataset_id in dataset_ids:
+            image_id = dataset_id_to_transformed_image_id(dataset_id)
+            if image_id not in self._transformed_hashes:
+                self._on_transformed_loaded(dataset_id, id_to_image[dataset_id])
+            self.transformed_images.add_if_room(image_id, id_to_image[dataset_id])
+        return {dataset_id: id_to_image[dataset_id] for dataset_id in dataset_ids}
+
+    async def get_transformed_images_async(self, dataset_ids: Sequence[str], executor=None):
+        """
+        Like get_transformed_images_without_cache_eviction, but decodes and
+        transforms in the executor, or in the transform executor if set.
+        Images already being transformed are waited on, not transformed again.
+        """
+        if self.transform_executor is not None:
+            return {
+                dataset_id: image
+                async for dataset_id, image in self.transform_images_async(dataset_ids, executor)
+            }
+        id_to_image, missing = self._split_cached_transformed(dataset_ids)
+        generation, transform_key = self._dataset_generation, self.transform_hash
+        tasks = self._batch_transform_tasks(missing, executor)
+        # a cancelled caller does not cancel the transforms others may wait on
+        transformed_images = await asyncio.gather(*(asyncio.shield(task) for task in tasks))
+        id_to_image.update(zip(missing, transformed_images))
+        if not self._is_current(generation, transform_key):
+            return id_to_image  # dataset or transform changed meanwhile, do not cache
+        return self._add_transformed_if_room(dataset_ids, id_to_image)
+
+    def _batch_transform_tasks(self, dataset_ids: Sequence[str], executor=None):
+        """Transform task of each image, the images not in flight are transformed in one batch."""
+        image_ids = [dataset_id_to_transformed_image_id(dataset_id) for dataset_id in dataset_ids]
+        new_ids = [
+            dataset_id
+            for dataset_id, image_id in dict(zip(dataset_ids, image_ids)).items()
+            if image_id not in self._transform_tasks
+        ]
+        if new_ids:
+            batch = asyncio.ensure_future(self._transform_batch_async(new_ids, executor))
+            for dataset_id in new_ids:
+                self._add_transform_task(dataset_id, self._batch_item(batch, dataset_id))
+        return [self._transform_tasks[image_id] for image_id in image_ids]
+
+    async def _transform_batch_async(self, dataset_ids: Sequence[str], executor=None):
+        transform, generation = self._transform, self._dataset_generation
+        originals = await self.load_images_async(dataset_ids, executor)
+        loop = asyncio.get_running_loop()
+        transformed_images = await loop.run_in_executor(
+            executor,
+            self._apply_transform_batch,
+            transform,
+            dataset_ids,
+            list(originals.values()),
+            generation,
+        )
+        return dict(zip(dataset_ids, transformed_images))
+
+    @staticmethod
+    async def _batch_item(batch: asyncio.Future, dataset_id: str):
+        return (await batch)[dataset_id]
+
+    async def get_image_async(self, dataset_id: str, executor=None, evict=True):
+        """Like get_image, but decodes in the executor instead of blocking the event loop."""
+        image_id = dataset_id_to_image_id(dataset_id)
+        image = self.original_images.get_item(image_id)
+        if image is None:
+            generation = self._dataset_generation
+            loop = asyncio.get_running_loop()
+            image = await loop.run_in_executor(executor, self._read_image, dataset_id)
+            if not self._is_current(generation):
+                return image  # dataset changed meanwhile, do not cache the stale image
+            # another request may have loaded it meanwhile
+            image = self.original_images.get_item(image_id) or self._on_image_loaded(
+                dataset_id, image
+            )
+        if evict:
+            self.original_images.add_item(image_id, image)
+        else:
+            self.original_images.add_if_room(image_id, image)
+        return image
+
+    async def load_images_async(self, dataset_ids: Sequence[str], executor=None):
+        """Original images without cache eviction, decoded concurrently in the executor."""
+        images = await asyncio.gather(
+            *(
+                self.get_image_async(dataset_id, executor, evict=False)
+                for dataset_id in dataset_ids
+            )
+        )
+        return dict(zip(dataset_ids, images))
+
+    async def get_thumbnail_async(self, dataset_id: str, max_size: int, executor=None):
+        """
+        Original image, possibly larger than max_size. Images missing from the
+        cache are decoded at a reduced scale in the executor and not cached.
+        """
+        image = self.original_images.get_item(dataset_id_to_image_id(dataset_id))
+        if image is None:
+            loop = asyncio.get_running_loop()
+            image = await loop.run_in_executor(
+                executor, self._read_thumbnail, dataset_id, max_size
+            )
+        return image
+
+    async def _transform_async(self, dataset_id: str, executor=None):
+        loop = asyncio.get_running_loop()
+        transform, transform_key = self._transform, self.transform_hash
+        generation = self._dataset_generation
+        original = await self.get_image_async(dataset_id, executor, evict=False)
+        transform_executor = self.transform_executor
+        if transform_executor is not None:
+            image = await self._apply_transform_in_process(
+                transform_executor, transform, dataset_id, original, generation
+            )
+        else:
+            image = await loop.run_in_executor(
+                executor, self._apply_transform, transform, dataset_id, original, generation
+            )
+        if not self._is_current(generation, transform_key):
+            return image  # dataset or transform changed meanwhile, do not cache the stale image
+        image_id = dataset_id_to_transformed_image_id(dataset_id)
+        return self.transformed_images.get_item(image_id) or self._on_transformed_loaded(
+            dataset_id, image
+        )
+
+    async def get_transformed_image_async(self, dataset_id: str, executor=None, evict=True):
+        """
+        Like get_transformed_image, but decodes and transforms in the executor,
+        or in the transform executor if set. Concurrent calls for the same
+        image share one transform.
+        """
+        image_id = dataset_id_to_transformed_image_id(dataset_id)
+        image = self.transformed_images.get_item(image_id)
+        if image is None:
+            image = self._read_spilled(dataset_id, self.transform_hash)
+            if image is not None:
+                image = self._on_transformed_loaded(dataset_id, image)
+        if image is None:
+            generation, transform_key = self._dataset_generation, self.transform_hash
+            task = self._transform_tasks.get(image_id) or self._add_transform_task(
+                dataset_id, self._transform_async(dataset_id, executor)
+            )
+            # a cancelled caller does not cancel the transform others may wait on
+            image = await asyncio.shield(task)
+            if not self._is_current(generation, transform_key):
+                return image
+        if evict:
+            self.transformed_images.add_item(image_id, image)
+        else:
+            self.transformed_images.add_if_room(image_id, image)
+        return image
+
+    def _is_current(self, generation: int, transform_key: Optional[str] = None):
+        """Whether work started at the dataset generation, with the transform, can be cached."""
+        if generation != self._dataset_generation:
+            return False
+        return transform_key is None or transform_key == self.transform_hash
+
+    def _add_transform_task(self, dataset_id: str, transform):
+        image_id = dataset_id_to_transformed_image_id(dataset_id)
+        task = asyncio.ensure_future(transform)
+        self._transform_tasks[image_id] = task
+        task.add_done_callback(partial(self._forget_transform_task, image_id))
+        return task
+
+    def _forget_transform_task(self, image_id: str, task: asyncio.Future):
+        if self._transform_tasks.get(image_id) is task:
+            del self._transform_tasks[image_id]
+
+    async def transform_images_async(
+        self, dataset_ids: Sequence[str], executor=None
+    ) -> AsyncIterator[Tuple[str, Image.Image]]:
+        """
+        Transformed images without cache eviction, all transformed
+        concurrently and yielded in the order of dataset_ids as they finish.
+        """
+        tasks = [
+            asyncio.ensure_future(
+                self.get_transformed_image_async(dataset_id, executor, evict=False)
+            )
+            for dataset_id in dataset_ids
+        ]
+        try:
+            for dataset_id, task in zip(dataset_ids, tasks):
+                yield dataset_id, await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def get_content_hash(self, image_id: str, image: Image.Image):
+        """Hash of the pixels of a loaded image, identical images hash the same."""
+        hashes = self._transformed_hashes if is_transformed(image_id) else self._original_hashes
+        if image_id not in hashes:
+            hashes[image_id] = content_hash(image)
+        return hashes[image_id]
+
     @change("current_dataset")
     def clear_all(self, **kwargs):
         self.original_images.clear()
         self.transformed_images.clear()
-        self._should_ajust_cache_size[0] = True
-        self._should_ajust_cache_size[1] = True
+        self._original_hashes.clear()
+        self._transformed_hashes.clear()
+        self._transform_tasks.clear()
+        with self._transform_memo_lock:
+            self._dataset_generation += 1
+            self.transform_memo.clear()
+        # available memory may have changed since the last dataset
+        cache_bytes = image_cache_bytes()
+        self.original_images.max_bytes = cache_bytes
+        self.transformed_images.max_bytes = cache_bytes
+        self.transform_memo.max_bytes = transform_memo_bytes()
+        if self.arena is not None:
+            self.arena.clear()
+
+    def cache_stats(self):
+        return {
+            "original": self.original_images.stats(),
+            "transformed": self.transformed_images.stats(),
+            "transform_memo": self.transform_memo.stats(),
+        }
+
+    @property
+    def transform(self):
+        return self._transform
 
     def set_transform(self, transform):
+        """
+        Returns False when the transform has the same types and parameters as
+        the current one, keeping the transformed images.
+        """
+        new_hash = transform_hash(transform)
         self._transform = transform
+        if new_hash == self.transform_hash:
+            return False
+        if self.spill is not None:
+            # so returning to this transform does not run it again
+            for image_id, cache_item in self.transformed_images.cache.items():
+                self._spill_transformed(image_id, cache_item.item)
+        self.transform_hash = new_hash
         self.transformed_images.clear()
+        self._transformed_hashes.clear()
+        self._transform_tasks.clear()
+        return True
@@ -58,9 +58,14 @@ def make_stateful_annotations(server, model_name):
     return StatefulAnnotations(partial(GroundTruthAnnotations, server.context), server, model_name)
 
 
-def make_stateful_predictor(server, model_name):
+def make_stateful_predictor(server, model_name, by_content=None):
     return StatefulAnnotations(
-        DetectionAnnotations,
+        partial(
+            DetectionAnnotations,
+            store=server.context.prediction_store,
+            by_content=by_content,
+            content_hash=server.context.image_content_hash,
+        ),
         server,
         model_name,
         add_to_cache_callback=partial(
@@ -1,7 +1,15 @@
-from nrtk_explorer.app.core import Engine
+import sys
+
+from nrtk_explorer.library.startup_profiler import profiler
 
 
 def main(server=None, **kwargs):
+    if "--profile-startup" in sys.argv:
+        # before the app modules are imported, to time their imports
+        profiler.start()
+
+    from nrtk_explorer.app.core import Engine
+
     engine = Engine(server)
     engine.server.start(**kwargs)
 
@@ -7,6 +7,8 @@ from nrtk_explorer.app.images.image_ids import get_image_state_keys
 from nrtk_explorer.widgets.nrtk_explorer import ScoreTable
 
 CSS_FILE = Path(__file__).with_name("image_list.css")
+# Pixels of the longest side of the images shown in the list, maximized images are full size
+THUMBNAIL_SIZE = 320
 
 COLUMNS = [
     {"name": "id", "label": "Dataset ID", "field": "id", "align": "left", "sortable": True},
@@ -145,11 +147,17 @@ class MaximizableImageWithSpinner(html.Div):
         maximized_model_value=None,
         maximized_update_model_value=None,
         maximized_container_selector=None,
+        thumbnail_size=THUMBNAIL_SIZE,
         **kwargs,
     ):
         super().__init__(
             **kwargs,
         )
+        # Annotations are drawn in the pixel coordinates of the loaded image,
+        # so thumbnails are only used while annotations are hidden.
+        thumbnail_src = (
+            f"{show_annotations} || !{src[0]} ? {src[0]} : {src[0]} + '?max={thumbnail_size}'",
+        )
         with self:
             with quasar.QDialog(
                 full_width=True,
@@ -173,7 +181,7 @@ class MaximizableImageWithSpinner(html.Div):
             ImageWithSpinner(
                 style=style,
                 identifier=identifier,
-                src=src,
+                src=thumbnail_src,
                 annotations=annotations,
                 models=models,
                 color_by=color_by,
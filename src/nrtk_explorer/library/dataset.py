@@ -5,31 +5,105 @@ Example:
     dataset = get_dataset("path/to/dataset.json")
 """
 
-from typing import Sequence as SequenceType, Union
+from typing import NamedTuple, Optional, Sequence as SequenceType, Union
 from abc import ABC, abstractmethod
+import io
 import os
+from collections import defaultdict
 from functools import lru_cache
 from pathlib import Path
+from statistics import median
 from PIL import Image
 import kwcoco
 import zipfile
-from datasets import (
-    load_dataset,
-    get_dataset_infos,
-    Sequence as SequenceDataset,
-    ClassLabel,
-    Image as DatasetImage,
-)
+
+# The datasets package takes about a second to import, it is only imported
+# once a Hugging Face dataset is used.
 
 HF_ROWS_TO_TAKE_STREAMING = 300
+EXIF_ORIENTATION = 274
+
+
+class ImageSource(NamedTuple):
+    """Encoded image as stored by the dataset, either a file on disk or bytes."""
+
+    format: str
+    path: Optional[str] = None
+    data: Optional[bytes] = None
+
+
+def _sniff_image(file) -> Optional[str]:
+    """Format of an encoded image read from its header, None when EXIF rotates it."""
+    with Image.open(file) as image:
+        if image.getexif().get(EXIF_ORIENTATION, 1) != 1:
+            return None
+        return image.format
+
+
+def _split_zip_path(path: Path):
+    """(zip file, member) when path goes through a zip archive, None otherwise."""
+    for parent in path.parents:
+        if parent.is_file() and zipfile.is_zipfile(parent):
+            return parent, path.relative_to(parent).as_posix()
+    return None
+
+
+def _read_zip_member(path: Path) -> Optional[bytes]:
+    zip_member = _split_zip_path(path)
+    if zip_member is None:
+        return None
+    archive, member = zip_member
+    with zipfile.ZipFile(archive) as zip_file:
+        return zip_file.read(member)
+
+
+def fit_image(image: Image.Image, max_size: int) -> Image.Image:
+    """Scale the image down to fit in a max_size square, keeping its aspect ratio."""
+    if max(image.size) <= max_size:
+        return image
+    scale = max_size / max(image.size)
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    return image.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0)
 
 
 class BaseDataset(ABC):
+    imgs: dict
+    anns: dict
+    gid_to_aids: dict
+
     @abstractmethod
     def get_image(self, id: int):
         """Get the image given an image id."""
         pass
 
+    def get_thumbnail(self, id: int, max_size: int):
+        """Get the image scaled down to fit in a max_size square."""
+        return fit_image(self.get_image(id), max_size)
+
+    def get_image_source(self, id: int) -> Optional[ImageSource]:
+        """Get the encoded image without decoding it, None when not available."""
+        return None
+
+    def get_image_id(self, dataset_id: str):
+        """
+        Get the image id from its str(), as dataset ids are kept in the state.
+        Ids may be ints or strs, depending on the dataset.
+        """
+        ids_by_str = getattr(self, "_image_ids_by_str", {})
+        if dataset_id not in ids_by_str:
+            # built on first use, and again when images were added
+            ids_by_str = {str(id): id for id in self.imgs.keys()}
+            self._image_ids_by_str = ids_by_str
+        return ids_by_str.get(dataset_id, dataset_id)
+
+    def get_image_annotations(self, id) -> list[dict]:
+        """Get the annotations of an image without scanning all annotations."""
+        return [self.anns[ann_id] for ann_id in self.gid_to_aids.get(id, ())]
+
+    def get_image_category_ids(self, id) -> list:
+        """Get the category id of each annotation of an image."""
+        return [annotation["category_id"] for annotation in self.get_image_annotations(id)]
+
 
 class CategoryIndex:
     def build_cat_index(self):
@@ -37,11 +111,47 @@ class CategoryIndex:
         self.name_to_cat = {cat["name"]: cat for cat in self.cats.values()}
 
 
+class AnnotationIndex:
+    def build_ann_index(self):
+        # follows kwcoco.index.gid_to_aids and kwcoco.index.cid_to_gids
+        self.gid_to_aids: dict = defaultdict(set)
+        self.cid_to_gids: dict = defaultdict(set)
+        for annotation in self.anns.values():
+            self.gid_to_aids[annotation["image_id"]].add(annotation["id"])
+            self.cid_to_gids[annotation["category_id"]].add(annotation["image_id"])
+
+
 class CocoDataset(kwcoco.CocoDataset, BaseDataset):
+    @property
+    def cid_to_gids(self):
+        # kwcoco builds the index on load and keeps it in sync on add/remove
+        return self.index.cid_to_gids
+
     def get_image(self, id: int):
-        image_fpath = self.get_image_fpath(id)
+        image_fpath = Path(self.get_image_fpath(id))
+        if not image_fpath.exists():
+            data = _read_zip_member(image_fpath)
+            if data is not None:
+                return Image.open(io.BytesIO(data))
         return Image.open(image_fpath)
 
+    def get_image_source(self, id: int):
+        image_fpath = Path(self.get_image_fpath(id))
+        if image_fpath.is_file():
+            format = _sniff_image(image_fpath)
+            return ImageSource(format, path=str(image_fpath)) if format else None
+        data = _read_zip_member(image_fpath)
+        if data is None:
+            return None
+        format = _sniff_image(io.BytesIO(data))
+        return ImageSource(format, data=data) if format else None
+
+    def get_thumbnail(self, id: int, max_size: int):
+        image = self.get_image(id)
+        # JPEGs decode straight at a reduced scale, much faster than a full decode
+        image.draft("RGB", (max_size, max_size))
+        return fit_image(image, max_size)
+
 
 def is_coco_dataset(path: str):
     # Note: this check is expensive and duplicates loading
@@ -90,6 +200,8 @@ def expand_hugging_face_datasets(dataset_identifiers: SequenceType[str], streami
         if is_coco_dataset(identifier):
             expanded_identifiers.append(identifier)
         else:
+            from datasets import get_dataset_infos
+
             infos = get_dataset_infos(identifier)
             for config_name, info in infos.items():
                 for split_name in info.splits:
@@ -104,14 +216,17 @@ def find_column_name(features, column_names):
     return next((key for key in column_names if key in features), None)
 
 
-class HuggingFaceDataset(BaseDataset, CategoryIndex):
+class HuggingFaceDataset(BaseDataset, CategoryIndex, AnnotationIndex):
     """Interface for Hugging Face datasets with a similar API to CocoDataset."""
 
     def __init__(self, identifier: str):
+        from datasets import load_dataset
+
         self.imgs: dict[str, dict] = {}
         self.anns: dict[str, dict] = {}
         self.cats: dict[str, dict] = {}
         self._id_to_row_idx: dict[str, int] = {}
+        self._undecoded = None  # image column with encoded bytes, for get_image_source
 
         repo, config, split, streaming = identifier.split("@")
         self._streaming = streaming == "streaming"
@@ -120,8 +235,11 @@ class HuggingFaceDataset(BaseDataset, CategoryIndex):
             self._dataset = self._dataset.take(HF_ROWS_TO_TAKE_STREAMING)
         self._load_data()
         self.build_cat_index()
+        self.build_ann_index()
 
     def _load_data(self):
+        from datasets import ClassLabel, Image as DatasetImage, Sequence as SequenceDataset
+
         image_key = find_column_name(self._dataset.features, ["image", "img"])
         self._image_key = image_key
         # transforms and base64 encoding require RGB mode
@@ -235,6 +353,41 @@ class HuggingFaceDataset(BaseDataset, CategoryIndex):
             row_idx = self._id_to_row_idx[id]
             return self._dataset[row_idx][self._image_key]
 
+    def get_image_source(self, id):
+        from datasets import Image as DatasetImage
+
+        if self._streaming or not isinstance(
+            self._dataset.features.get(self._image_key), DatasetImage
+        ):
+            return None
+        if self._undecoded is None:
+            self._undecoded = self._dataset.cast_column(
+                self._image_key, DatasetImage(decode=False)
+            )
+        encoded = self._undecoded[self._id_to_row_idx[id]][self._image_key]
+        data = encoded.get("bytes")
+        if data is None:
+            path = encoded.get("path")
+            if not path or not os.path.isfile(path):
+                return None
+            format = _sniff_image(path)
+            return ImageSource(format, path=path) if format else None
+        format = _sniff_image(io.BytesIO(data))
+        return ImageSource(format, data=data) if format else None
+
+
+def typical_image_size(dataset) -> Optional[tuple[int, int]]:
+    """Median (width, height) of the images, None when the dataset does not list sizes."""
+    sizes = [
+        (image["width"], image["height"])
+        for image in dataset.imgs.values()
+        if image.get("width") and image.get("height")
+    ]
+    if not sizes:
+        return None
+    widths, heights = zip(*sizes)
+    return int(median(widths)), int(median(heights))
+
 
 @lru_cache
 def get_dataset(identifier: str):
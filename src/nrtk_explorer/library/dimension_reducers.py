@@ -1,7 +1,5 @@
 import hashlib
 
-from sklearn.decomposition import PCA
-
 
 class DimReducerManager:
     def __init__(self):
@@ -53,6 +51,8 @@ class DimReducer:
 
 class PCAReducer(DimReducer):
     def __init__(self, dims=3, whiten=False, solver="auto"):
+        from sklearn.decomposition import PCA
+
         self._dims = dims
         self._whiten = whiten
         self._solver = solver
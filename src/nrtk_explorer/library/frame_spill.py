@@ -0,0 +1,185 @@
+"""
+Module to keep decoded frames on disk once they no longer fit in memory.
+
+Frames are written as raw RGB uint8 .npy files in a scratch directory and
+copied back from a memory map on a hit, which is much cheaper than decoding an
+image or running an expensive perturber again.
+
+Example:
+    spill = FrameSpill(max_size=2 * 1024**3)
+    spill.put("dataset:transform:1", image)  # when evicted from memory
+    image = spill.get("dataset:transform:1")  # None when not spilled
+"""
+
+import atexit
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+import xxhash
+from PIL import Image
+
+DEFAULT_MAX_SIZE = 2 * 1024 * 1024 * 1024  # bytes
+SUFFIX = ".npy"
+
+
+def _to_rgb_array(image: Image.Image) -> np.ndarray:
+    image = image.convert("RGB") if image.mode != "RGB" else image
+    return np.asarray(image, dtype=np.uint8)
+
+
+class FrameSpill:
+    """
+    Disk quota bounded store of RGB frames, least recently used files are removed first.
+
+    Files are named by a hash of their key, so a directory passed in is reused
+    across restarts. A temporary directory is created and removed otherwise.
+    Frames are written by a background thread, so put() does not block on disk.
+    """
+
+    def __init__(self, directory: Optional[str] = None, max_size: int = DEFAULT_MAX_SIZE):
+        self._owns_directory = directory is None
+        self.directory = Path(directory or tempfile.mkdtemp(prefix="nrtk-explorer-frames-"))
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # file name -> bytes, least recently used first
+        self._files: OrderedDict[str, int] = OrderedDict()
+        # file name -> frame queued for writing
+        self._pending: Dict[str, np.ndarray] = {}
+        self._size = 0
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="frame-spill")
+        self._index_directory()
+        atexit.register(self.close)
+
+    def _index_directory(self):
+        for partial in self.directory.glob("*.partial"):
+            partial.unlink(missing_ok=True)
+        files = sorted(self.directory.glob(f"*{SUFFIX}"), key=lambda path: path.stat().st_mtime)
+        for path in files:
+            size = path.stat().st_size
+            self._files[path.stem] = size
+            self._size += size
+        with self._lock:
+            self._evict()
+
+    @staticmethod
+    def _name(key: str) -> str:
+        return xxhash.xxh3_128_hexdigest(key.encode())
+
+    def _path(self, name: str) -> Path:
+        return self.directory / f"{name}{SUFFIX}"
+
+    @property
+    def size(self) -> int:
+        """Bytes of frames on disk."""
+        return self._size
+
+    def __contains__(self, key: str):
+        name = self._name(key)
+        return name in self._files or name in self._pending
+
+    def put(self, key: str, image: Image.Image):
+        """Queue the frame for writing, frames already on disk are only marked as used."""
+        name = self._name(key)
+        with self._lock:
+            if name in self._pending:
+                return
+            if name in self._files:
+                self._files.move_to_end(name)
+                return
+        array = _to_rgb_array(image)
+        if array.nbytes > self.max_size:
+            return
+        with self._lock:
+            self._pending[name] = array
+        self._writer.submit(self._write, name, array)
+
+    def _write(self, name: str, array: np.ndarray):
+        path = self._path(name)
+        # written under a temporary name, so readers never map a partial file
+        partial = path.with_suffix(".partial")
+        try:
+            with open(partial, "wb") as file:
+                np.save(file, array)
+            os.replace(partial, path)
+        except OSError:
+            with self._lock:
+                self._pending.pop(name, None)
+            return
+        with self._lock:
+            if self._pending.pop(name, None) is None:
+                # cleared meanwhile
+                path.unlink(missing_ok=True)
+                return
+            self._files[name] = path.stat().st_size
+            self._size += self._files[name]
+            self._evict()
+
+    def flush(self):
+        """Wait for queued frames to be written."""
+        self._writer.submit(lambda: None).result()
+
+    def _evict(self):
+        while self._size > self.max_size and self._files:
+            name, size = self._files.popitem(last=False)
+            self._size -= size
+            try:
+                self._path(name).unlink(missing_ok=True)
+            except OSError:
+                pass  # still mapped on platforms that forbid it
+
+    def get(self, key: str) -> Optional[Image.Image]:
+        """Spilled frame copied from disk, or None."""
+        name = self._name(key)
+        with self._lock:
+            array = self._pending.get(name)
+            spilled = array is not None or name in self._files
+            if name in self._files:
+                self._files.move_to_end(name)
+            if spilled:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if array is not None:
+            return Image.fromarray(array)
+        if not spilled:
+            return None
+        try:
+            frame = np.load(self._path(name), mmap_mode="r")
+        except (OSError, ValueError):
+            with self._lock:
+                size = self._files.pop(name, None)
+                if size is not None:
+                    self._size -= size
+            return None
+        return Image.fromarray(frame)
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+            for name in self._files:
+                self._path(name).unlink(missing_ok=True)
+            self._files.clear()
+            self._size = 0
+
+    def stats(self):
+        return {
+            "files": len(self._files),
+            "bytes": self._size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def close(self):
+        self._writer.shutdown(wait=True, cancel_futures=True)
+        if self._owns_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
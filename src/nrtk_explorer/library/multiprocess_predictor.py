@@ -4,28 +4,197 @@ import signal
 import threading
 import logging
 import queue
+import time
 import uuid
+from collections import Counter
 from enum import Enum
-from .predictor import Predictor
+from typing import Callable, NamedTuple, Optional, Tuple
+from PIL import Image
+from .prediction_store import model_key
+from .shared_images import read_shared_images
+
+# Seconds the worker waits for more INFER requests to merge into one batch
+DEFAULT_BATCH_WINDOW = 0.01
+# Stop merging INFER requests once a batch holds this many images
+DEFAULT_MAX_BATCH_IMAGES = 64
+# (width, height) of the synthetic image a worker warms its model up with, typical of COCO
+DEFAULT_WARMUP_SIZE = (640, 480)
+# Request id of the message each worker sends once its first model is loaded and warmed up
+READY_REQUEST_ID = "READY"
+
+logger = logging.getLogger(__name__)
 
 
 class Command(Enum):
     SET_MODEL = "SET_MODEL"
     INFER = "INFER"
     RESET = "RESET"
-
-
-def _child_worker(request_queue, result_queue, model_name, force_cpu):
-    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ignore Ctrl+C in child
-    logger = logging.getLogger(__name__)
-    predictor = Predictor(model_name=model_name, force_cpu=force_cpu)
-
-    while True:
+    STATS = "STATS"
+    MODEL_INFO = "MODEL_INFO"
+
+
+def _is_infer(msg):
+    return msg is not None and Command(msg["command"]) == Command.INFER
+
+
+def _drain_infer_requests(request_queue, first_msg, batch_window, max_batch_images):
+    """
+    Collect INFER requests arriving within batch_window seconds of first_msg.
+    Returns the batch and the first non INFER message read, which must be
+    handled next to keep the command order.
+    """
+    batch = [first_msg]
+    image_count = len(first_msg["payload"]["images"])
+    deadline = time.monotonic() + batch_window
+    while image_count < max_batch_images:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
         try:
-            msg = request_queue.get()
-        except (EOFError, KeyboardInterrupt):
-            logger.debug("Worker: Exiting on interrupt or queue EOF.")
+            msg = request_queue.get(timeout=remaining)
+        except queue.Empty:
             break
+        if not _is_infer(msg):
+            return batch, msg
+        batch.append(msg)
+        image_count += len(msg["payload"]["images"])
+    return batch, None
+
+
+def _merge_infer_payloads(batch):
+    """Images of all the requests, keyed by (request index, image id) to avoid collisions."""
+    return {
+        (i, image_id): image
+        for i, msg in enumerate(batch)
+        for image_id, image in msg["payload"]["images"].items()
+    }
+
+
+def _split_predictions(batch, predictions):
+    """Predictions of the merged images for each request id."""
+    results = {msg["req_id"]: {} for msg in batch}
+    for (i, image_id), image_predictions in predictions.items():
+        results[batch[i]["req_id"]][image_id] = image_predictions
+    return results
+
+
+class ModelStatus(Enum):
+    LOADING = "loading"
+    READY = "ready"
+    ERROR = "error"
+
+
+class _Readiness:
+    """
+    Status of a model from the READY messages of the workers of its pool.
+    Each model load of the pool is a new generation.
+    """
+
+    def __init__(self, num_workers: int, loop: asyncio.AbstractEventLoop, generation: int = 0):
+        self.generation = generation
+        self.status = ModelStatus.LOADING
+        self.message: Optional[str] = None
+        self.load_seconds = 0.0  # of the slowest worker
+        self.warmup_seconds = 0.0
+        self._remaining = num_workers
+        # resolved once every worker is ready, or one failed
+        self.future: asyncio.Future = loop.create_future()
+
+    def worker_ready(self, response):
+        """Returns True if the status changed."""
+        if self.status != ModelStatus.LOADING:
+            return False
+        if response.get("status") != "OK":
+            self.status = ModelStatus.ERROR
+            self.message = response.get("message")
+            self.future.set_result(None)
+            return True
+        result = response.get("result", {})
+        self.load_seconds = max(self.load_seconds, result.get("load_seconds", 0.0))
+        self.warmup_seconds = max(self.warmup_seconds, result.get("warmup_seconds", 0.0))
+        self._remaining -= 1
+        if self._remaining > 0:
+            return False
+        self.status = ModelStatus.READY
+        self.future.set_result(None)
+        return True
+
+
+def _load_predictor(Predictor, model_name, force_cpu, letterbox, warmup_size):
+    """Predictor and the load and warm-up seconds, the first forward pass is the slowest."""
+    start = time.perf_counter()
+    predictor = Predictor(model_name=model_name, force_cpu=force_cpu, letterbox=letterbox)
+    loaded = time.perf_counter()
+    if warmup_size is not None:
+        predictor.eval({"warmup": Image.new("RGB", tuple(warmup_size))})
+    timings = {"load_seconds": loaded - start, "warmup_seconds": time.perf_counter() - loaded}
+    return predictor, timings
+
+
+class _Worker(NamedTuple):
+    proc: multiprocessing.Process
+    request_queue: multiprocessing.Queue
+
+
+def _merge_stats(results):
+    """Sum the batch size histograms of the workers of a pool."""
+    stats: dict = {"images_per_batch": Counter(), "requests_per_batch": Counter()}
+    for result in results:
+        for key, histogram in stats.items():
+            histogram.update(result.get(key, {}))
+    return {key: dict(histogram) for key, histogram in stats.items()}
+
+
+def _child_worker(
+    request_queue,
+    result_queue,
+    model_name,
+    force_cpu,
+    batch_window=DEFAULT_BATCH_WINDOW,
+    max_batch_images=DEFAULT_MAX_BATCH_IMAGES,
+    num_threads=None,
+    letterbox=False,
+    warmup_size=DEFAULT_WARMUP_SIZE,
+    generation=0,
+    Predictor=None,
+):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ignore Ctrl+C in child
+    # torch and transformers are only imported by the workers running the model
+    if Predictor is None:
+        from .predictor import Predictor
+
+    if num_threads is not None:
+        import torch
+
+        # Workers of a pool split the cores instead of each using all of them
+        torch.set_num_threads(num_threads)
+    try:
+        predictor, timings = _load_predictor(
+            Predictor, model_name, force_cpu, letterbox, warmup_size
+        )
+    except Exception as e:
+        logger.exception("Failed to load model.")
+        ready = {"status": "ERROR", "message": str(e)}
+        # kept running, a SET_MODEL may load another model
+        predictor = None
+    else:
+        ready = {"status": "OK", "result": timings}
+    # a SET_MODEL sent meanwhile starts a later generation
+    result_queue.put((READY_REQUEST_ID, {**ready, "generation": generation}))
+    # Achieved batch sizes, in images and in merged requests
+    images_per_batch: Counter = Counter()
+    requests_per_batch: Counter = Counter()
+
+    next_msg = None
+    while True:
+        if next_msg is not None:
+            msg, next_msg = next_msg, None
+        else:
+            try:
+                msg = request_queue.get()
+            except (EOFError, KeyboardInterrupt):
+                logger.debug("Worker: Exiting on interrupt or queue EOF.")
+                break
         if msg is None:  # Exit signal
             logger.debug("Worker: Received EXIT command. Shutting down.")
             break
@@ -34,21 +203,57 @@ def _child_worker(request_queue, result_queue, model_name, force_cpu):
         req_id = msg["req_id"]
         payload = msg.get("payload", {})
 
-        if command == Command.SET_MODEL:
+        if command == Command.INFER:
+            batch, next_msg = _drain_infer_requests(
+                request_queue, msg, batch_window, max_batch_images
+            )
             try:
-                predictor = Predictor(
-                    model_name=payload["model_name"], force_cpu=payload["force_cpu"]
-                )
-                result_queue.put((req_id, {"status": "OK"}))
+                images = read_shared_images(_merge_infer_payloads(batch))
+                predictions = predictor.eval(images)
+                images_per_batch[len(images)] += 1
+                requests_per_batch[len(batch)] += 1
+                for batch_req_id, result in _split_predictions(batch, predictions).items():
+                    result_queue.put((batch_req_id, {"status": "OK", "result": result}))
             except Exception as e:
-                logger.exception("Failed to set model.")
-                result_queue.put((req_id, {"status": "ERROR", "message": str(e)}))
-        elif command == Command.INFER:
+                logger.exception("Inference failed.")
+                for batch_msg in batch:
+                    result_queue.put((batch_msg["req_id"], {"status": "ERROR", "message": str(e)}))
+            del batch
+        elif command == Command.STATS:
+            result_queue.put(
+                (
+                    req_id,
+                    {
+                        "status": "OK",
+                        "result": {
+                            "images_per_batch": dict(images_per_batch),
+                            "requests_per_batch": dict(requests_per_batch),
+                        },
+                    },
+                )
+            )
+        elif command == Command.MODEL_INFO:
+            result_queue.put(
+                (
+                    req_id,
+                    {
+                        "status": "OK",
+                        "result": {
+                            "model_name": model_name,
+                            "revision": predictor.revision if predictor else None,
+                        },
+                    },
+                )
+            )
+        elif command == Command.SET_MODEL:
             try:
-                predictions = predictor.eval(payload["images"])
-                result_queue.put((req_id, {"status": "OK", "result": predictions}))
+                model_name = payload["model_name"]
+                predictor, timings = _load_predictor(
+                    Predictor, model_name, payload["force_cpu"], letterbox, warmup_size
+                )
+                result_queue.put((req_id, {"status": "OK", "result": timings}))
             except Exception as e:
-                logger.exception("Inference failed.")
+                logger.exception("Failed to set model.")
                 result_queue.put((req_id, {"status": "ERROR", "message": str(e)}))
         elif command == Command.RESET:
             try:
@@ -67,17 +272,56 @@ def _child_worker(request_queue, result_queue, model_name, force_cpu):
 
 
 class MultiprocessPredictor:
-    def __init__(self, model_name="facebook/detr-resnet-50", force_cpu=False):
+    """
+    Runs a Predictor in a pool of num_workers spawned processes.
+
+    INFER requests go to the worker with the fewest images still waiting on a
+    response, other commands are sent to every worker.
+
+    Workers load the model in the background and warm it up on a synthetic
+    image of warmup_size. INFER requests wait until every worker is ready,
+    on_status is called on the event loop when the status changes.
+    """
+
+    def __init__(
+        self,
+        model_name="facebook/detr-resnet-50",
+        force_cpu=False,
+        batch_window=DEFAULT_BATCH_WINDOW,
+        max_batch_images=DEFAULT_MAX_BATCH_IMAGES,
+        arena=None,
+        num_workers=1,
+        num_threads: Optional[int] = None,
+        letterbox=False,
+        warmup_size: Optional[Tuple[int, int]] = DEFAULT_WARMUP_SIZE,
+        on_status: Optional[Callable[["MultiprocessPredictor"], None]] = None,
+        predictor_class=None,
+    ):
         self._lock = threading.Lock()
         self.model_name = model_name
         self.force_cpu = force_cpu
-        self._proc = None
-        self._request_queue = None
+        self.batch_window = batch_window
+        self.max_batch_images = max_batch_images
+        # Optional SharedImageArena, images are pickled through the queue without it
+        self.arena = arena
+        self.num_workers = max(1, num_workers)
+        # torch threads of each worker, None keeps the torch default
+        self.num_threads = num_threads
+        # Predictor pads mixed size images into a few shapes so batches fill up
+        self.letterbox = letterbox
+        self.warmup_size = warmup_size
+        self.on_status = on_status
+        # Predictor run by the workers, nrtk_explorer.library.predictor.Predictor when None
+        self.predictor_class = predictor_class
+        self._workers: list[_Worker] = []
+        self._outstanding: list[int] = []  # images waiting on a response, per worker
         self._result_queue = None
-        self._pending_futures = {}
+        self._pending_futures: dict = {}
+        self._model_key: Optional[str] = None
         self._result_thread = None
 
         self.loop = asyncio.get_event_loop()
+        self._readiness = _Readiness(self.num_workers, self.loop)
 
         self._start_process()
 
@@ -89,22 +333,33 @@ class MultiprocessPredictor:
 
     def _start_process(self):
         with self._lock:
-            if self._proc is not None and self._proc.is_alive():
+            if any(worker.proc.is_alive() for worker in self._workers):
                 self.shutdown()
             multiprocessing.set_start_method("spawn", force=True)
-            self._request_queue = multiprocessing.Queue()
             self._result_queue = multiprocessing.Queue()
-            self._proc = multiprocessing.Process(
-                target=_child_worker,
-                args=(
-                    self._request_queue,
-                    self._result_queue,
-                    self.model_name,
-                    self.force_cpu,
-                ),
-                daemon=True,
-            )
-            self._proc.start()
+            self._workers = []
+            for _ in range(self.num_workers):
+                request_queue = multiprocessing.Queue()
+                proc = multiprocessing.Process(
+                    target=_child_worker,
+                    args=(
+                        request_queue,
+                        self._result_queue,
+                        self.model_name,
+                        self.force_cpu,
+                        self.batch_window,
+                        self.max_batch_images,
+                        self.num_threads,
+                        self.letterbox,
+                        self.warmup_size,
+                        self._readiness.generation,
+                        self.predictor_class,
+                    ),
+                    daemon=True,
+                )
+                proc.start()
+                self._workers.append(_Worker(proc, request_queue))
+            self._outstanding = [0] * self.num_workers
 
     def _result_listener(self):
         while True:
@@ -115,36 +370,93 @@ class MultiprocessPredictor:
             if result is None:
                 break
             r_id, payload = result
+            if r_id == READY_REQUEST_ID:
+                self.loop.call_soon_threadsafe(self._on_ready_message, payload)
+                continue
             with self._lock:
                 future = self._pending_futures.pop(r_id, None)
             if future and not future.done():
                 self.loop.call_soon_threadsafe(future.set_result, payload)
 
-    async def _submit_request(self, command, payload):
+    def _on_ready_message(self, response):
+        readiness = self._readiness
+        if response.get("generation") == readiness.generation:
+            self._on_worker_ready(readiness, response)
+        # else the model was set again while the workers were starting
+
+    def _on_worker_ready(self, readiness: _Readiness, response):
+        if readiness is not self._readiness or not readiness.worker_ready(response):
+            return  # a model set meanwhile, or other workers still loading
+        if readiness.status == ModelStatus.READY:
+            logger.info(
+                f"Model {self.model_name} loaded in {readiness.load_seconds:.2f} s, "
+                f"warmed up in {readiness.warmup_seconds:.2f} s"
+            )
+        else:
+            logger.error(f"Model {self.model_name} failed to load: {readiness.message}")
+        if self.on_status is not None:
+            self.on_status(self)
+
+    @property
+    def status(self) -> ModelStatus:
+        return self._readiness.status
+
+    @property
+    def status_message(self) -> Optional[str]:
+        return self._readiness.message
+
+    @property
+    def load_seconds(self) -> float:
+        return self._readiness.load_seconds
+
+    @property
+    def warmup_seconds(self) -> float:
+        return self._readiness.warmup_seconds
+
+    async def wait_ready(self):
+        """Wait for the model to be loaded and warmed up, raises if it failed to load."""
+        readiness = self._readiness
+        await asyncio.shield(readiness.future)
+        if readiness.status == ModelStatus.ERROR:
+            raise RuntimeError(f"Model {self.model_name} failed to load: {readiness.message}")
+
+    def _least_loaded_worker(self):
+        with self._lock:
+            return min(range(len(self._workers)), key=lambda i: self._outstanding[i])
+
+    async def _submit_to_worker(self, worker_index, command, payload, work=0):
         future = self.loop.create_future()
         req_id = str(uuid.uuid4())
+        request_queue = self._workers[worker_index].request_queue
 
         def cleanup(_):
             with self._lock:
                 self._pending_futures.pop(req_id, None)
                 # Remove the request if it's still in the queue. Probably got canceled.
                 stashed_requests = []
-                while not self._request_queue.empty():
+                while not request_queue.empty():
                     try:
-                        req = self._request_queue.get_nowait()
+                        req = request_queue.get_nowait()
                         if req["req_id"] != req_id:
                             stashed_requests.append(req)
                     except queue.Empty:
                         break
                 for req in stashed_requests:
-                    self._request_queue.put(req)
+                    request_queue.put(req)
 
-        future.add_done_callback(cleanup)
+        def on_done(f):
+            with self._lock:
+                self._outstanding[worker_index] -= work
+            if f.cancelled():
+                cleanup(f)
 
         with self._lock:
             self._pending_futures[req_id] = future
+            self._outstanding[worker_index] += work
 
-        self._request_queue.put(
+        future.add_done_callback(on_done)
+
+        request_queue.put(
             {
                 "command": command.value,
                 "req_id": req_id,
@@ -152,19 +464,81 @@ class MultiprocessPredictor:
             }
         )
 
-        try:
-            r = await future
-            return r
-        except asyncio.CancelledError:
-            cleanup(None)
-            raise
+        return await future
+
+    async def _submit_to_workers(self, command, payload):
+        """Response of each worker."""
+        return await asyncio.gather(
+            *(self._submit_to_worker(i, command, payload) for i in range(len(self._workers)))
+        )
+
+    async def _submit_request(self, command, payload):
+        if command == Command.INFER:
+            worker_index = self._least_loaded_worker()
+            return await self._submit_to_worker(
+                worker_index, command, payload, work=len(payload["images"])
+            )
+
+        responses = await self._submit_to_workers(command, payload)
+        errors = [response for response in responses if response.get("status") != "OK"]
+        if errors:
+            return errors[0]
+        if command == Command.STATS:
+            return {
+                "status": "OK",
+                "result": _merge_stats(response["result"] for response in responses),
+            }
+        return responses[0]
 
     async def infer(self, images):
         if not images:
             return {}
-        resp = await self._submit_request(Command.INFER, {"images": images})
+        # queued here rather than behind the model load in the workers
+        await self.wait_ready()
+        if self.arena is None:
+            resp = await self._submit_request(Command.INFER, {"images": images})
+            return resp.get("result")
+
+        handles = {id: self.arena.share(id, image) for id, image in images.items()}
+        # images not fitting in shared memory are pickled
+        payload = {id: handles[id] or image for id, image in images.items()}
+        try:
+            resp = await self._submit_request(Command.INFER, {"images": payload})
+        finally:
+            for handle in handles.values():
+                if handle is not None:
+                    self.arena.release(handle)
         return resp.get("result")
 
+    def queue_depth(self):
+        """Requests sent to the workers that have not been answered yet."""
+        with self._lock:
+            return len(self._pending_futures)
+
+    async def get_stats(self):
+        """Queue depth, outstanding images per worker and the achieved batch size histograms."""
+        resp = await self._submit_request(Command.STATS, {})
+        with self._lock:
+            outstanding = list(self._outstanding)
+        return {
+            "status": self.status.value,
+            "load_seconds": self.load_seconds,
+            "warmup_seconds": self.warmup_seconds,
+            "queue_depth": self.queue_depth(),
+            "outstanding_images": outstanding,
+            **resp.get("result", {}),
+        }
+
+    async def get_model_key(self):
+        """Model name and revision the workers loaded, identifies their predictions."""
+        if self._model_key is None:
+            resp = await self._submit_request(Command.MODEL_INFO, {})
+            result = resp.get("result", {})
+            key = model_key(result["model_name"], result["revision"])
+            # Letterboxed inputs give different predictions
+            self._model_key = f"{key}+letterbox" if self.letterbox else key
+        return self._model_key
+
     def _run_coro(self, coro):
         if self.loop.is_running():
             return asyncio.ensure_future(coro)
@@ -175,11 +549,22 @@ class MultiprocessPredictor:
         with self._lock:
             self.model_name = model_name
             self.force_cpu = force_cpu
+            self._model_key = None
+        # INFER requests wait for the new model, every worker answers once it is loaded
+        readiness = self._readiness = _Readiness(
+            self.num_workers, self.loop, self._readiness.generation + 1
+        )
+        if self.on_status is not None:
+            self.on_status(self)
 
         async def _async_set():
-            return await self._submit_request(
+            response = await self._submit_to_workers(
                 Command.SET_MODEL, {"model_name": self.model_name, "force_cpu": self.force_cpu}
             )
+            for worker_response in response:
+                self._on_worker_ready(readiness, worker_response)
+            errors = [r for r in response if r.get("status") != "OK"]
+            return errors[0] if errors else response[0]
 
         return self._run_coro(_async_set())
 
@@ -193,12 +578,13 @@ class MultiprocessPredictor:
         async def _async_shutdown():
             with self._lock:
                 try:
-                    self._request_queue.put(None)
+                    for worker in self._workers:
+                        worker.request_queue.put(None)
                     self._result_queue.put(None)  # Signal the listener thread to exit.
                 except Exception:
                     logging.warning("Could not send exit message to worker.")
-            if self._proc:
-                self._proc.join()
+            for worker in self._workers:
+                worker.proc.join()
             if self._result_thread:
                 self._result_thread.join()
 
@@ -0,0 +1,85 @@
+"""
+Module to run items through a sequence of async stages concurrently.
+
+Stages are connected by bounded queues, so while one stage works on an item
+the previous stage already works on the next one, and a slow stage holds back
+the stages feeding it instead of letting work pile up. Items leave each stage
+in the order they entered it, even when the stage works on several at once.
+
+Example:
+    await run_pipeline(
+        chunks,
+        [Stage(load, concurrency=2), Stage(transform), Stage(infer), Stage(score)],
+    )
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Iterable, NamedTuple, Sequence
+
+DEFAULT_QUEUE_SIZE = 1  # items waiting in front of a stage
+
+
+class Stage(NamedTuple):
+    # output of the function is the input of the next stage
+    function: Callable[[Any], Awaitable[Any]]
+    # items the stage works on at the same time
+    concurrency: int = 1
+    queue_size: int = DEFAULT_QUEUE_SIZE
+
+
+_DONE = object()
+
+
+class _Order:
+    """Items a stage took from its queue and passed on, in the order they came."""
+
+    def __init__(self):
+        self.taken = 0
+        self.released = 0
+        self.turn = asyncio.Condition()
+
+
+async def run_pipeline(items: Iterable, stages: Sequence[Stage]):
+    """
+    Run each item through all stages. Cancelling the pipeline, or an error in
+    a stage, cancels the work in every stage.
+    """
+    queues: list[asyncio.Queue] = [asyncio.Queue(stage.queue_size) for stage in stages]
+
+    async def feed():
+        for item in items:
+            await queues[0].put(item)
+        for _ in range(stages[0].concurrency):
+            await queues[0].put(_DONE)
+
+    async def work(index: int, order: "_Order"):
+        stage = stages[index]
+        while True:
+            item = await queues[index].get()
+            if item is _DONE:
+                return
+            position = order.taken
+            order.taken += 1
+            result = await stage.function(item)
+            if index + 1 < len(stages):
+                # a later item done first waits, so the next stage gets them in order
+                async with order.turn:
+                    await order.turn.wait_for(lambda: order.released == position)
+                    await queues[index + 1].put(result)
+                    order.released += 1
+                    order.turn.notify_all()
+
+    async def run_stage(index: int):
+        order = _Order()
+        await asyncio.gather(*(work(index, order) for _ in range(stages[index].concurrency)))
+        if index + 1 < len(stages):
+            for _ in range(stages[index + 1].concurrency):
+                await queues[index + 1].put(_DONE)
+
+    tasks = [asyncio.ensure_future(feed())]
+    tasks += [asyncio.ensure_future(run_stage(index)) for index in range(len(stages))]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,149 @@
+"""
+Module to persist model predictions across server restarts.
+
+Predictions are stored in SQLite, keyed by the model (name and revision) and a
+hash of the exact pixels that were sent to it, so a restarted server does not
+run inference again on images it has already seen.
+
+Example:
+    store = PredictionStore("predictions.sqlite")
+    key = content_hash(image)
+    store.put_many("facebook/detr-resnet-50@abc123", {key: predictions})
+    store.get_many("facebook/detr-resnet-50@abc123", [key])
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, Sequence
+
+import xxhash
+from PIL import ExifTags, Image
+
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024  # bytes
+# Evict down to this fraction of the max size, so eviction does not run on every insert
+EVICT_TO_FRACTION = 0.9
+
+Predictions = Sequence[dict]
+
+
+def content_hash(image: Image.Image) -> str:
+    """
+    Hash of the pixels, the mode, the size and the EXIF orientation of an image,
+    as the orientation is applied before inference.
+    """
+    digest = xxhash.xxh3_128()
+    digest.update(f"{image.mode}:{image.size[0]}x{image.size[1]}".encode())
+    orientation = image.getexif().get(ExifTags.Base.Orientation, 1)
+    if orientation != 1:
+        # upright images keep the hashes they had before the orientation was hashed
+        digest.update(f":orientation={orientation}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def model_key(model_name: str, revision=None) -> str:
+    return f"{model_name}@{revision}" if revision else model_name
+
+
+class PredictionStore:
+    """
+    Size bounded SQLite store of predictions.
+    Least recently read or written entries are evicted past max_size bytes.
+    """
+
+    def __init__(self, path: str, max_size: int = DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS predictions (
+                    model TEXT NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    predictions TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (model, content_hash)
+                )""")
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)"
+            )
+        self._size = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM predictions"
+        ).fetchone()[0]
+
+    @property
+    def size(self) -> int:
+        """Bytes of stored predictions."""
+        return self._size
+
+    def get_many(self, model: str, hashes: Iterable[str]) -> Dict[str, Predictions]:
+        """Stored predictions of the given content hashes, missing hashes are left out."""
+        hashes = list(hashes)
+        if not hashes:
+            return {}
+        placeholders = ",".join("?" * len(hashes))
+        with self._lock, self._connection:
+            rows = self._connection.execute(
+                f"SELECT content_hash, predictions FROM predictions "
+                f"WHERE model = ? AND content_hash IN ({placeholders})",
+                [model, *hashes],
+            ).fetchall()
+            self._connection.execute(
+                f"UPDATE predictions SET last_used = ? "
+                f"WHERE model = ? AND content_hash IN ({placeholders})",
+                [time.time(), model, *hashes],
+            )
+        return {content_hash: json.loads(predictions) for content_hash, predictions in rows}
+
+    def put_many(self, model: str, hash_to_predictions: Dict[str, Predictions]):
+        if not hash_to_predictions:
+            return
+        now = time.time()
+        rows = [
+            (model, content_hash, serialized, len(serialized), now)
+            for content_hash, serialized in (
+                (content_hash, json.dumps(predictions))
+                for content_hash, predictions in hash_to_predictions.items()
+            )
+        ]
+        with self._lock, self._connection:
+            replaced = self._connection.execute(
+                f"SELECT COALESCE(SUM(size), 0) FROM predictions "
+                f"WHERE model = ? AND content_hash IN ({','.join('?' * len(rows))})",
+                [model, *hash_to_predictions.keys()],
+            ).fetchone()[0]
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self._size += sum(row[3] for row in rows) - replaced
+            if self._size > self.max_size:
+                self._evict(int(self.max_size * EVICT_TO_FRACTION))
+
+    def _evict(self, target_size: int):
+        to_free = self._size - target_size
+        freed = 0
+        evicted = []
+        for model, content_hash, size in self._connection.execute(
+            "SELECT model, content_hash, size FROM predictions ORDER BY last_used"
+        ):
+            if freed >= to_free:
+                break
+            evicted.append((model, content_hash))
+            freed += size
+        self._connection.executemany(
+            "DELETE FROM predictions WHERE model = ? AND content_hash = ?", evicted
+        )
+        self._size -= freed
+
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM predictions")
+            self._size = 0
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -4,6 +4,7 @@ import torch
 import transformers
 from transformers.pipelines import Pipeline
 from typing import Optional, Sequence, Dict, NamedTuple
+from PIL import Image as PILImage, ImageOps
 from PIL.Image import Image
 import math
 
@@ -17,6 +18,73 @@ class ImageWithId(NamedTuple):
 
 STARTING_BATCH_SIZE = 32
 
+# Letterbox shapes: the short side is the model's shortest edge and the long
+# side exceeds it by a multiple of this, so batches of similar images fill up.
+LETTERBOX_MULTIPLE = 128
+DEFAULT_SHORTEST_EDGE = 800
+DEFAULT_LONGEST_EDGE = 1333
+
+
+class Letterbox(NamedTuple):
+    image: Image
+    scale: float
+    size: tuple[int, int]  # of the image before letterboxing
+
+
+def oriented_size(image: Image) -> tuple[int, int]:
+    """Size of the image once its EXIF orientation is applied."""
+    size = image.size
+    exif_data = image.getexif()
+    orientation = exif_data.get(274, None)
+    # Swap dimensions if the orientation implies a 90° rotation
+    if orientation in [5, 6, 7, 8]:
+        size = (size[1], size[0])
+    return size
+
+
+def letterbox_shape(
+    size: tuple[int, int],
+    shortest_edge: int = DEFAULT_SHORTEST_EDGE,
+    longest_edge: int = DEFAULT_LONGEST_EDGE,
+    multiple: int = LETTERBOX_MULTIPLE,
+) -> tuple[int, int]:
+    """Canonical (width, height) an image of the given size is padded into."""
+    width, height = size
+    short, long = sorted(size)
+    max_extra = max(0, longest_edge - shortest_edge) // multiple * multiple
+    extra = math.ceil((shortest_edge * long / short - shortest_edge) / multiple) * multiple
+    long_side = shortest_edge + min(extra, max_extra)
+    return (long_side, shortest_edge) if width >= height else (shortest_edge, long_side)
+
+
+def letterbox(image: Image, shape: tuple[int, int]) -> Letterbox:
+    """Scale the image to fit the shape and pad it at the bottom and right."""
+    image = ImageOps.exif_transpose(image)
+    scale = min(shape[0] / image.width, shape[1] / image.height)
+    resized = image.convert("RGB").resize(
+        (max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+        PILImage.Resampling.BILINEAR,
+    )
+    canvas = PILImage.new("RGB", shape)
+    canvas.paste(resized, (0, 0))
+    return Letterbox(canvas, scale, image.size)
+
+
+def unletterbox_predictions(predictions: Sequence[dict], box: Letterbox) -> list[dict]:
+    """Map the boxes predicted on a letterboxed image back to the original image."""
+    width, height = box.size
+    limits = {"xmin": width, "xmax": width, "ymin": height, "ymax": height}
+    return [
+        {
+            **prediction,
+            "box": {
+                key: min(max(round(value / box.scale), 0), limits[key])
+                for key, value in prediction["box"].items()
+            },
+        }
+        for prediction in predictions
+    ]
+
 
 class Predictor:
 
@@ -25,8 +93,11 @@ class Predictor:
         model_name: str = "facebook/detr-resnet-50",
         task: Optional[str] = None,
         force_cpu: bool = False,
+        letterbox: bool = False,
     ):
         self.task = task
+        # Pad images into a few canonical shapes instead of batching by exact size
+        self.letterbox = letterbox
         self.device = "cuda" if torch.cuda.is_available() and not force_cpu else "cpu"
         self.pipeline = model_name
         self.reset()
@@ -56,6 +127,18 @@ class Predictor:
         # Do not display warnings
         transformers.utils.logging.set_verbosity_error()
 
+    @property
+    def revision(self) -> Optional[str]:
+        """Commit hash of the loaded model weights, None when unknown"""
+        return getattr(self._pipeline.model.config, "_commit_hash", None)
+
+    def _letterbox_edges(self) -> tuple[int, int]:
+        size = getattr(self._pipeline.image_processor, "size", None) or {}
+        return (
+            size.get("shortest_edge", DEFAULT_SHORTEST_EDGE),
+            size.get("longest_edge", DEFAULT_LONGEST_EDGE),
+        )
+
     def reset(self):
         self.batch_size = STARTING_BATCH_SIZE
 
@@ -70,16 +153,19 @@ class Predictor:
 
         images_with_ids = [ImageWithId(id, img) for id, img in images.items()]
 
+        letterboxes: dict[str, Letterbox] = {}
+        if self.letterbox:
+            edges = self._letterbox_edges()
+            for image in images_with_ids:
+                shape = letterbox_shape(oriented_size(image.image), *edges)
+                letterboxes[image.id] = letterbox(image.image, shape)
+            images_with_ids = [ImageWithId(id, box.image) for id, box in letterboxes.items()]
+
         # Some models require all the images in a batch to be the same size,
         # otherwise crash or UB.
         batches: dict = {}
         for image in images_with_ids:
-            size = image.image.size
-            exif_data = image.image.getexif()
-            orientation = exif_data.get(274, None)
-            # Swap dimensions if the orientation implies a 90° rotation
-            if orientation in [5, 6, 7, 8]:
-                size = (size[1], size[0])
+            size = oriented_size(image.image)
             batches.setdefault(size, [])
             batches[size].append(image)
 
@@ -101,6 +187,11 @@ class Predictor:
                     for batch in predictions_in_baches
                     for image_id, predictions in batch
                 }
+                if letterboxes:
+                    return {
+                        image_id: unletterbox_predictions(predictions, letterboxes[image_id])
+                        for image_id, predictions in predictions_by_image_id.items()
+                    }
                 return predictions_by_image_id
 
             except RuntimeError as e:
@@ -1,9 +1,8 @@
-from typing import List, Dict, Tuple
-from smqtk_image_io.bbox import AxisAlignedBoundingBox
-from .scoring_utils import (
-    ClassAgnosticPixelwiseIoUScorer,
-)
+from collections import OrderedDict
+from typing import Dict, Hashable, List, NamedTuple, Sequence
+import numpy as np
 from .annotations import get_cat_id
+from .scoring_utils import box_union_iou
 
 
 # Example usage:
@@ -31,173 +30,301 @@ def keys_to_dataset_ids(image_dict):
     return {image_id_to_dataset_id(key): value for key, value in image_dict.items()}
 
 
-def get_label(dataset, annotation):
-    if annotation["category_id"] is not None:
-        return dataset.cats[annotation["category_id"]]["name"]
-    return annotation["label"]
-
-
 def get_score(annotation):
     return 1.0 if "score" not in annotation else annotation["score"]
 
 
-def normalize_annotation(dataset, image_id, annotation):
-    """Normalize a single annotation."""
-    category_id = get_cat_id(dataset, annotation)
-    annotation = {
-        **annotation,
-        "category_id": category_id,
-        "image_id": image_id,
-        "score": get_score(annotation),
-        "bbox": annotation.get("bbox", annotation.get("box", None)),
-    }
-    annotation["label"] = get_label(dataset, annotation)
-    annotation[annotation["label"]] = annotation["score"]
-    return annotation
+NO_CATEGORY = -1
 
+# Images kept by a BoxArraysCache, the least recently used are dropped first
+BOX_ARRAYS_CACHE_SIZE = 10000
 
-def normalize_annotations(dataset, image_id, annotations):
-    """Ensure category_id, bbox, label, score, [label]:score."""
-    return [normalize_annotation(dataset, image_id, annotation) for annotation in annotations]
+# Images with more boxes are scored one by one instead of padded into a batch
+MAX_BATCHED_BOXES = 64
 
 
-def predictions_to_annotations(dataset, ids, predictions):
-    return [
-        normalize_annotations(dataset, id, image_predictions)
-        for id, image_predictions in zip(ids, predictions)
-    ]
+def get_box(annotation):
+    """Box as x_1, y_1, x_2, y_2 from a COCO bbox or a transformers pipeline box."""
+    bbox = annotation.get("bbox", annotation.get("box", None))
+    if bbox is None:
+        return (np.nan, np.nan, np.nan, np.nan)
+    if "xmin" in bbox:
+        return (bbox["xmin"], bbox["ymin"], bbox["xmax"], bbox["ymax"])
+    return (bbox[0], bbox[1], bbox[0] + bbox[2], bbox[1] + bbox[3])
+
 
+class BoxArrays(NamedTuple):
+    """Annotations of a chunk of images flattened into parallel arrays.
 
-def get_category_similarity_score(actual: List[Dict], predicted: List[Dict]) -> float:
+    The annotations of image i are the rows offsets[i]:offsets[i + 1].
     """
-    Calculate matching score between actual and predicted category annotations.
 
-    Args:
-        actual: List of actual annotation dictionaries with category_id
-        predicted: List of predicted annotation dictionaries with category_id
+    boxes: np.ndarray  # (N, 4) x_1, y_1, x_2, y_2, NaN when the annotation has no box
+    category_ids: np.ndarray  # (N,) NO_CATEGORY when the label is not in the dataset
+    scores: np.ndarray  # (N,)
+    offsets: np.ndarray  # (images + 1,)
+
+    @property
+    def image_count(self):
+        return len(self.offsets) - 1
+
+    @property
+    def counts(self):
+        return np.diff(self.offsets)
+
+    @property
+    def image_index(self):
+        """Image of each row."""
+        return np.repeat(np.arange(self.image_count), self.counts)
+
+
+def to_box_arrays(dataset, images_annotations: Sequence[List[dict]]) -> BoxArrays:
+    annotations = [annotation for image in images_annotations for annotation in image]
+    category_ids = [get_cat_id(dataset, annotation) for annotation in annotations]
+    return BoxArrays(
+        boxes=np.array([get_box(a) for a in annotations], dtype=np.float64).reshape(-1, 4),
+        category_ids=np.array(
+            [NO_CATEGORY if cat_id is None else cat_id for cat_id in category_ids],
+            dtype=np.int64,
+        ),
+        scores=np.array([get_score(a) for a in annotations], dtype=np.float64),
+        offsets=np.concatenate(
+            ([0], np.cumsum([len(image) for image in images_annotations]))
+        ).astype(np.int64),
+    )
 
-    Returns:
-        float: Matching score between 0.0 and 1.0
-    """
-    actual_cat_ids = set([annotation["category_id"] for annotation in actual])
-    predicted_cat_ids = set([annotation["category_id"] for annotation in predicted])
 
-    matching_cat_ids = sum(
-        1 for cat_id in predicted_cat_ids if cat_id in actual_cat_ids and cat_id is not None
+def threshold_box_arrays(arrays: BoxArrays, score_threshold) -> BoxArrays:
+    """Drop annotations scoring below the threshold."""
+    keep = arrays.scores >= score_threshold
+    counts = np.bincount(arrays.image_index[keep], minlength=arrays.image_count)
+    return BoxArrays(
+        boxes=arrays.boxes[keep],
+        category_ids=arrays.category_ids[keep],
+        scores=arrays.scores[keep],
+        offsets=np.concatenate(([0], np.cumsum(counts))).astype(np.int64),
     )
 
-    total_cat_ids = len(actual_cat_ids.union(predicted_cat_ids))
-    return matching_cat_ids / total_cat_ids if total_cat_ids > 0 else 0.0
 
+def concat_box_arrays(images: Sequence[tuple]) -> BoxArrays:
+    """Stack the (boxes, category ids, scores) of single images into chunk arrays."""
+    if len(images) == 0:
+        return to_box_arrays(None, [])
+    boxes, category_ids, scores = zip(*images)
+    return BoxArrays(
+        boxes=np.concatenate(boxes),
+        category_ids=np.concatenate(category_ids),
+        scores=np.concatenate(scores),
+        offsets=np.concatenate(
+            ([0], np.cumsum([len(image_scores) for image_scores in scores]))
+        ).astype(np.int64),
+    )
 
-ImagePredictions = List[Dict]
 
+def select_box_arrays(arrays: BoxArrays, indices: Sequence[int]) -> BoxArrays:
+    """Box arrays of some of the images of a chunk."""
+    return concat_box_arrays(
+        [
+            (arrays.boxes[start:end], arrays.category_ids[start:end], arrays.scores[start:end])
+            for start, end in zip(arrays.offsets[indices], arrays.offsets[np.add(indices, 1)])
+        ]
+    )
 
-def compute_category_similarity_scores(
-    actual: List[ImagePredictions], predicted: List[ImagePredictions], ids: List[str]
-) -> List[Tuple[str, float]]:
-    """
-    Calculate matching scores between actual and predicted category annotations.
 
-    Args:
-        actual: List of actual annotations
-        predicted: List of predicted annotations
-        ids: List of image IDs
+def sort_by_score(arrays: BoxArrays) -> BoxArrays:
+    """Order the annotations of each image by descending score."""
+    order = np.lexsort((-arrays.scores, arrays.image_index))
+    return BoxArrays(
+        boxes=arrays.boxes[order],
+        category_ids=arrays.category_ids[order],
+        scores=arrays.scores[order],
+        offsets=arrays.offsets,
+    )
+
 
-    Returns:
-        List of tuples containing (image_id, matching_score)
+class BoxArraysCache:
     """
+    Box arrays of single images, independent of the score threshold.
 
-    return [
-        (id, get_category_similarity_score(actual, predicted))
-        for actual, predicted, id in zip(actual, predicted, ids)
-    ]
+    Annotations are kept sorted by descending score, so applying a threshold
+    keeps a prefix of each image and rescoring does not touch the raw annotations.
+    Past max_size images, the least recently added or thresholded are dropped.
+    """
 
+    def __init__(self, max_size: int = BOX_ARRAYS_CACHE_SIZE):
+        self.max_size = max_size
+        self._arrays: OrderedDict[Hashable, BoxArrays] = OrderedDict()
 
-def get_aabb(annotation):
-    bbox = annotation["bbox"]
-    if "xmin" in bbox:
-        return AxisAlignedBoundingBox(
-            [bbox["xmin"], bbox["ymin"]],
-            [bbox["xmax"], bbox["ymax"]],
-        )
-    return AxisAlignedBoundingBox(
-        [bbox[0], bbox[1]],
-        [bbox[0] + bbox[2], bbox[1] + bbox[3]],
+    def add(self, dataset, key_to_annotations: Dict[Hashable, List[dict]]):
+        for key, annotations in key_to_annotations.items():
+            self._arrays[key] = sort_by_score(to_box_arrays(dataset, [annotations]))
+            self._arrays.move_to_end(key)
+        while len(self._arrays) > self.max_size:
+            self._arrays.popitem(last=False)
+
+    def __contains__(self, key: Hashable):
+        return key in self._arrays
+
+    def threshold(self, keys: Sequence[Hashable], score_threshold) -> BoxArrays:
+        """Box arrays of the images with the annotations scoring below the threshold cut."""
+        images = []
+        for key in keys:
+            image = self._arrays[key]
+            self._arrays.move_to_end(key)
+            count = np.searchsorted(-image.scores, -score_threshold, side="right")
+            images.append((image.boxes[:count], image.category_ids[:count], image.scores[:count]))
+        return concat_box_arrays(images)
+
+    def clear(self):
+        self._arrays.clear()
+
+
+def category_similarity_scores(actual: BoxArrays, predicted: BoxArrays) -> np.ndarray:
+    """
+    Per image, the ratio of categories present in both actual and predicted
+    annotations to the categories present in either.
+    """
+    actual_pairs = np.unique(np.stack((actual.image_index, actual.category_ids), axis=1), axis=0)
+    predicted_pairs = np.unique(
+        np.stack((predicted.image_index, predicted.category_ids), axis=1), axis=0
+    )
+    pairs, counts = np.unique(
+        np.concatenate((actual_pairs, predicted_pairs)), axis=0, return_counts=True
     )
+    matching = (counts == 2) & (pairs[:, 1] != NO_CATEGORY)
+
+    image_count = actual.image_count
+    matching_count = np.bincount(pairs[matching, 0], minlength=image_count)
+    total_count = np.bincount(pairs[:, 0], minlength=image_count)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(total_count > 0, matching_count / total_count, 0.0)
 
 
-def to_nrtk_score_shape(annotation):
+def _pad_boxes(arrays: BoxArrays, max_boxes: int):
+    """(images, max_boxes, 4) pixel bounds plus a mask of the rows holding a box."""
+    padded = np.zeros((arrays.image_count, max_boxes, 4))
+    valid = np.zeros((arrays.image_count, max_boxes), dtype=bool)
+    image_index = arrays.image_index
+    position = np.arange(len(image_index)) - arrays.offsets[image_index]
+    has_box = ~np.isnan(arrays.boxes).any(axis=1)
+    padded[image_index[has_box], position[has_box]] = _pixel_bounds(arrays.boxes[has_box])
+    valid[image_index[has_box], position[has_box]] = True
+    return padded, valid
+
+
+def _cell_coverage(edges: np.ndarray, low: np.ndarray, high: np.ndarray, valid: np.ndarray):
+    """Which cells between consecutive edges each box spans, (images, boxes, cells)."""
     return (
-        get_aabb(annotation),
-        annotation,
+        (low[:, :, None] <= edges[:, None, :-1])
+        & (edges[:, None, 1:] <= high[:, :, None])
+        & valid[:, :, None]
     )
 
 
-def compute_score(dataset, actual, predicted, score_threshold):
-    """Compute score for image ids."""
+def box_iou_scores(actual: BoxArrays, predicted: BoxArrays) -> np.ndarray:
+    """
+    Per image IoU of the areas covered by the actual and the predicted boxes.
+
+    Images are batched with the images of similar box count, so a dense image
+    does not pad the whole chunk. Images with more than MAX_BATCHED_BOXES boxes
+    are scored alone with box_union_iou.
+    """
+    box_counts = np.maximum(actual.counts, predicted.counts)
+    groups: Dict[int, List[int]] = {}
+    scores = np.empty(actual.image_count)
+    for index, count in enumerate(box_counts.tolist()):
+        if count > MAX_BATCHED_BOXES:
+            start, end = actual.offsets[index], actual.offsets[index + 1]
+            predicted_start, predicted_end = predicted.offsets[index], predicted.offsets[index + 1]
+            scores[index] = box_union_iou(
+                _pixel_bounds(actual.boxes[start:end]),
+                _pixel_bounds(predicted.boxes[predicted_start:predicted_end]),
+            )
+        else:
+            # padded to at most twice their box count
+            groups.setdefault(count.bit_length(), []).append(index)
+    for indices in groups.values():
+        scores[indices] = _batched_box_iou_scores(
+            select_box_arrays(actual, indices), select_box_arrays(predicted, indices)
+        )
+    return scores
 
-    actual = keys_to_dataset_ids(actual)
-    predicted = keys_to_dataset_ids(predicted)
-    ids = list(actual.keys())
 
-    pairs = [(actual[key], predicted[key], key) for key in ids]
-    # remove scores below threshold
-    pairs = [
-        (
-            [anno for anno in actual_annos if anno.get("score", 1.0) >= score_threshold],
-            [anno for anno in predicted_annos if anno.get("score", 1.0) >= score_threshold],
-            key,
+def _pixel_bounds(boxes: np.ndarray) -> np.ndarray:
+    # Truncate and clamp like the pixel masks of ClassAgnosticPixelwiseIoUScorer
+    return np.clip(np.trunc(boxes), 0, None)
+
+
+def _batched_box_iou_scores(actual: BoxArrays, predicted: BoxArrays) -> np.ndarray:
+    """
+    All the box edges of an image split it into a grid of cells that are either
+    fully inside or fully outside each box, so the covered areas are exact sums
+    of cell areas. The grids of every image in the chunk are stacked and padded,
+    and covered cells are counted with a batched matrix product.
+    """
+    max_boxes = max(int(actual.counts.max(initial=0)), int(predicted.counts.max(initial=0)), 1)
+    actual_boxes, actual_valid = _pad_boxes(actual, max_boxes)
+    predicted_boxes, predicted_valid = _pad_boxes(predicted, max_boxes)
+
+    # Padding rows add edges at 0, which only split cells further
+    image_count = actual.image_count
+    xs = np.concatenate((actual_boxes[..., 0::2], predicted_boxes[..., 0::2]), axis=1)
+    ys = np.concatenate((actual_boxes[..., 1::2], predicted_boxes[..., 1::2]), axis=1)
+    xs = np.sort(xs.reshape(image_count, -1), axis=1)
+    ys = np.sort(ys.reshape(image_count, -1), axis=1)
+    cell_areas = np.diff(ys)[:, :, None] * np.diff(xs)[:, None, :]
+
+    def covered(boxes, valid):
+        cover_x = _cell_coverage(xs, boxes[..., 0], boxes[..., 2], valid)
+        cover_y = _cell_coverage(ys, boxes[..., 1], boxes[..., 3], valid)
+        # (images, y cells, boxes) @ (images, boxes, x cells) counts the boxes over each cell
+        counts = np.matmul(
+            cover_y.transpose(0, 2, 1).astype(np.float32), cover_x.astype(np.float32)
         )
-        for actual_annos, predicted_annos, key in pairs
-    ]
+        return counts > 0
 
-    # separate images with no predictions in actual argument
-    # as score function expects at least one prediction
-    def is_empty(prediction_pair):
-        actual_predictions = prediction_pair[0]
-        return len(actual_predictions) == 0
+    actual_covered = covered(actual_boxes, actual_valid)
+    predicted_covered = covered(predicted_boxes, predicted_valid)
 
-    no_annotations, has_annotations = partition(is_empty, pairs)
+    intersection = (cell_areas * (actual_covered & predicted_covered)).sum(axis=(1, 2))
+    union = (cell_areas * (actual_covered | predicted_covered)).sum(axis=(1, 2))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return intersection / union
 
-    both_images_no_annotation, one_has_annotation = partition(
-        lambda pair: len(pair[1]) == 0, no_annotations
-    )
-    scores = []
-    for _, __, id in both_images_no_annotation:
-        scores.append((id, 1.0))
-    for _, __, id in one_has_annotation:
-        scores.append((id, 0.0))
 
-    if len(has_annotations) == 0:
+def score_box_arrays(actual: BoxArrays, predicted: BoxArrays) -> np.ndarray:
+    """Score each image of a chunk, annotations should already be thresholded."""
+    # Images without actual annotations score 1 only if nothing was predicted either
+    scores = np.where(predicted.counts == 0, 1.0, 0.0)
+    has_annotations = actual.counts > 0
+    if not has_annotations.any():
         return scores
 
-    actual, predicted, ids = zip(*has_annotations)
+    def missing_box(arrays):
+        rows_missing_box = np.isnan(arrays.boxes).any(axis=1)
+        return (rows_missing_box & has_annotations[arrays.image_index]).any()
 
-    actual = predictions_to_annotations(dataset, ids, actual)
-    predicted = predictions_to_annotations(dataset, ids, predicted)
+    if missing_box(actual) or missing_box(predicted):
+        annotated_scores = category_similarity_scores(actual, predicted)
+    else:
+        annotated_scores = box_iou_scores(actual, predicted)
 
-    all_annotations_have_bbox = all(
-        annotation["bbox"] is not None
-        for annotation_list in actual + predicted
-        for annotation in annotation_list
-    )
+    return np.where(has_annotations, annotated_scores, scores)
 
-    if not all_annotations_have_bbox:
-        s = compute_category_similarity_scores(actual, predicted, ids)
-        return scores + s
 
-    actual_converted = [
-        [to_nrtk_score_shape(annotation) for annotation in img_annotations]
-        for img_annotations in actual
-    ]
-    predicted_converted = [
-        [to_nrtk_score_shape(annotation) for annotation in img_annotations]
-        for img_annotations in predicted
-    ]
+def compute_score(dataset, actual, predicted, score_threshold):
+    """Compute score for image ids."""
+
+    actual = keys_to_dataset_ids(actual)
+    predicted = keys_to_dataset_ids(predicted)
+    ids = list(actual.keys())
 
-    score_output = ClassAgnosticPixelwiseIoUScorer().score(actual_converted, predicted_converted)
-    for id, score in zip(ids, score_output):
-        scores.append((id, score))
+    actual_arrays = threshold_box_arrays(
+        to_box_arrays(dataset, [actual[id] for id in ids]), score_threshold
+    )
+    predicted_arrays = threshold_box_arrays(
+        to_box_arrays(dataset, [predicted[id] for id in ids]), score_threshold
+    )
 
-    return scores
+    scores = score_box_arrays(actual_arrays, predicted_arrays)
+    return list(zip(ids, scores.tolist()))
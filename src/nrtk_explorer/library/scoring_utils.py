@@ -75,11 +75,11 @@ class ClassAgnosticPixelwiseIoUScorer(ScoreDetections):
             width, height = 1, 1
             for act_bbox, _ in act:
                 width = max(width, act_bbox.max_vertex[0])
-                height = max(width, act_bbox.max_vertex[1])
+                height = max(height, act_bbox.max_vertex[1])
 
             for pred_bbox, _ in pred:
                 width = max(width, pred_bbox.max_vertex[0])
-                height = max(width, pred_bbox.max_vertex[1])
+                height = max(height, pred_bbox.max_vertex[1])
 
             width = int(width) + 1
             height = int(height) + 1
@@ -111,3 +111,84 @@ class ClassAgnosticPixelwiseIoUScorer(ScoreDetections):
             ious.append(np.sum(intersection) / np.sum(union))
 
         return ious
+
+
+def _boxes_to_array(
+    detections: Sequence[tuple[AxisAlignedBoundingBox, dict[Hashable, Any]]],
+) -> np.ndarray:
+    """Pixel bounds of the boxes as an (N, 4) int array of x_1, y_1, x_2, y_2.
+
+    Coordinates are truncated the same way the rasterizing scorer slices its masks
+    and clamped at the image origin.
+    """
+    boxes = np.zeros((len(detections), 4), dtype=np.int64)
+    for i, (bbox, _) in enumerate(detections):
+        x_1, y_1 = bbox.min_vertex
+        x_2, y_2 = bbox.max_vertex
+        boxes[i] = (int(x_1), int(y_1), int(x_2), int(y_2))
+    return np.clip(boxes, 0, None)
+
+
+def _rasterize_compressed(boxes: np.ndarray, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+    """Mark the cells of the compressed grid covered by any of the boxes."""
+    covered = np.zeros((len(ys) - 1, len(xs) - 1), dtype=bool)
+    x_1 = np.searchsorted(xs, boxes[:, 0])
+    x_2 = np.searchsorted(xs, boxes[:, 2])
+    y_1 = np.searchsorted(ys, boxes[:, 1])
+    y_2 = np.searchsorted(ys, boxes[:, 3])
+    for box_x_1, box_y_1, box_x_2, box_y_2 in zip(x_1, y_1, x_2, y_2):
+        # fmt: off
+        covered[box_y_1:box_y_2, box_x_1:box_x_2] = True
+        # fmt: on
+    return covered
+
+
+def box_union_iou(actual: np.ndarray, predicted: np.ndarray) -> float:
+    """IoU between the areas covered by two sets of (x_1, y_1, x_2, y_2) boxes.
+
+    Uses coordinate compression: the box edges split the plane into a grid whose
+    cells are either fully covered by a box or not at all, so the union and
+    intersection areas are exact sums of cell areas. Memory grows with the number
+    of boxes rather than with the image resolution.
+    """
+    all_boxes = np.concatenate((actual, predicted))
+    xs = np.unique(all_boxes[:, [0, 2]])
+    ys = np.unique(all_boxes[:, [1, 3]])
+    if len(xs) < 2 or len(ys) < 2:
+        return float("nan")
+
+    cell_areas = np.outer(np.diff(ys), np.diff(xs))
+    actual_covered = _rasterize_compressed(actual, xs, ys)
+    predicted_covered = _rasterize_compressed(predicted, xs, ys)
+
+    intersection = cell_areas[actual_covered & predicted_covered].sum()
+    union = cell_areas[actual_covered | predicted_covered].sum()
+    if union == 0:
+        return float("nan")
+    return float(intersection / union)
+
+
+class ClassAgnosticBoxUnionIoUScorer(ScoreDetections):
+    """Computes the same scores as `ClassAgnosticPixelwiseIoUScorer` without pixel masks.
+
+    The covered areas of the actual and predicted boxes are measured analytically
+    with coordinate compression, so large frames do not allocate image sized masks.
+    """
+
+    @override
+    def score(
+        self,
+        actual: Sequence[Sequence[tuple[AxisAlignedBoundingBox, dict[Hashable, Any]]]],
+        predicted: Sequence[Sequence[tuple[AxisAlignedBoundingBox, dict[Hashable, float]]]],
+    ) -> Sequence[float]:
+        """Computes box union IoU scores and returns sequence of float values equal to the length of the input data."""
+        if len(actual) != len(predicted):
+            raise ValueError("Size mismatch between actual and predicted data")
+        for actual_det in actual:
+            if len(actual_det) < 1:
+                raise ValueError("Actual bounding boxes must have detections and can't be empty.")
+
+        return [
+            box_union_iou(_boxes_to_array(act), _boxes_to_array(pred))
+            for act, pred in zip(actual, predicted, strict=False)
+        ]
@@ -0,0 +1,272 @@
+"""
+Module to send decoded images to worker processes through shared memory.
+
+The parent process copies the pixels of an image once into a shared memory
+arena, and only a small handle is pickled for each worker that reads it.
+
+Example:
+    arena = SharedImageArena()
+    handle = arena.share("img_1", image)  # in the parent
+    image = read_shared_images({"img_1": handle})["img_1"]  # in a worker
+    arena.release(handle)
+"""
+
+import collections
+import itertools
+import shutil
+import threading
+import weakref
+from multiprocessing.shared_memory import SharedMemory
+from typing import Deque, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from PIL import ExifTags, Image, ImageOps
+
+# Docker gives containers 64 MiB of /dev/shm by default
+DEFAULT_SEGMENT_SIZE = 32 * 1024 * 1024  # bytes
+ALIGNMENT = 64  # bytes
+SHARED_MEMORY_DIR = "/dev/shm"
+
+
+class SharedImageHandle(NamedTuple):
+    name: str  # shared memory segment
+    shape: Tuple[int, ...]
+    offset: int
+
+
+class _Segment:
+    """Shared memory block with first fit allocation of its free ranges."""
+
+    def __init__(self, size: int):
+        self.shm = SharedMemory(create=True, size=size)
+        self.size = size
+        self.free: List[Tuple[int, int]] = [(0, size)]  # (offset, size) sorted by offset
+
+    def allocate(self, nbytes: int) -> Optional[int]:
+        for i, (offset, size) in enumerate(self.free):
+            if size >= nbytes:
+                if size == nbytes:
+                    del self.free[i]
+                else:
+                    self.free[i] = (offset + nbytes, size - nbytes)
+                return offset
+        return None
+
+    def deallocate(self, offset: int, nbytes: int):
+        self.free.append((offset, nbytes))
+        self.free.sort()
+        merged = [self.free[0]]
+        for block_offset, block_size in self.free[1:]:
+            last_offset, last_size = merged[-1]
+            if last_offset + last_size == block_offset:
+                merged[-1] = (last_offset, last_size + block_size)
+            else:
+                merged.append((block_offset, block_size))
+        self.free = merged
+
+    def is_empty(self):
+        return self.free == [(0, self.size)]
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class _Block(NamedTuple):
+    segment: _Segment
+    handle: SharedImageHandle
+    nbytes: int
+
+
+def _close_segments(segments: List[_Segment]):
+    for segment in segments:
+        segment.close()
+    segments.clear()
+
+
+def _shared_memory_free() -> Optional[int]:
+    """Free bytes of the file system backing shared memory, None when unknown."""
+    try:
+        return shutil.disk_usage(SHARED_MEMORY_DIR).free
+    except OSError:
+        return None
+
+
+def _aligned(nbytes: int):
+    return (nbytes + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _to_rgb_array(image: Image.Image) -> np.ndarray:
+    # workers only get the pixels, so apply the EXIF orientation they would lose
+    if image.getexif().get(ExifTags.Base.Orientation, 1) != 1:
+        image = ImageOps.exif_transpose(image)
+    # transforms and inference expect RGB mode
+    image = image.convert("RGB") if image.mode != "RGB" else image
+    return np.asarray(image, dtype=np.uint8)
+
+
+class SharedImageArena:
+    """
+    Reference counted RGB frames in shared memory.
+
+    An image shared under a key stays published while its PIL image is alive,
+    which for Images means while it is held by one of its LRU caches. Sharing
+    the same image again, for example for the next model, reuses the frame.
+    Each share() holds a reference until the matching release(), so a frame
+    read by a worker is never overwritten, even if it was evicted meanwhile.
+    When shared memory is full, share() returns None and the image should be
+    sent to the worker as it is.
+    """
+
+    def __init__(self, segment_size: int = DEFAULT_SEGMENT_SIZE):
+        self.segment_size = segment_size
+        self._lock = threading.Lock()
+        self._segments: List[_Segment] = []
+        self._blocks: Dict[SharedImageHandle, _Block] = {}
+        self._refs: Dict[SharedImageHandle, int] = {}
+        # key -> (handle, weak reference to the source image, publication token)
+        self._published: Dict[str, Tuple[SharedImageHandle, weakref.ref, int]] = {}
+        self._tokens = itertools.count()
+        # (key, token) of collected images, unpublished once the lock is free
+        self._unpublished: Deque[Tuple[str, int]] = collections.deque()
+        # unlink the segments at exit without keeping the arena alive
+        weakref.finalize(self, _close_segments, self._segments)
+
+    def _allocate(self, nbytes: int) -> Optional[Tuple[_Segment, int]]:
+        for segment in self._segments:
+            offset = segment.allocate(nbytes)
+            if offset is not None:
+                return segment, offset
+        size = max(self.segment_size, nbytes)
+        free = _shared_memory_free()
+        if free is not None and size > free:
+            size = nbytes  # a segment for this image only
+        if free is not None and size > free:
+            # writing past the free space would crash with SIGBUS
+            return None
+        try:
+            segment = _Segment(size)
+        except OSError:
+            return None
+        self._segments.append(segment)
+        offset = segment.allocate(nbytes)
+        assert offset is not None
+        return segment, offset
+
+    def _decref(self, handle: SharedImageHandle):
+        self._refs[handle] -= 1
+        if self._refs[handle] > 0:
+            return
+        del self._refs[handle]
+        block = self._blocks.pop(handle)
+        block.segment.deallocate(handle.offset, block.nbytes)
+        # give memory back, but keep one segment around for the next images
+        if block.segment.is_empty() and len(self._segments) > 1:
+            self._segments.remove(block.segment)
+            block.segment.close()
+
+    def _unpublish(self, key: str, token: int):
+        # a GC finalizer, it may run while this thread holds the lock, so never wait for it
+        self._unpublished.append((key, token))
+        if self._lock.acquire(blocking=False):
+            try:
+                self._drain_unpublished()
+            finally:
+                self._lock.release()
+
+    def _drain_unpublished(self):
+        """Unpublish the frames of collected images, with the lock held."""
+        while self._unpublished:
+            key, token = self._unpublished.popleft()
+            published = self._published.get(key)
+            if published is not None and published[2] == token:
+                del self._published[key]
+                self._decref(published[0])
+
+    def share(self, key: str, image: Image.Image) -> Optional[SharedImageHandle]:
+        """
+        Handle to the pixels of the image, call release() once the worker is done.
+        None when the image does not fit in shared memory.
+        """
+        with self._lock:
+            self._drain_unpublished()
+            published = self._published.get(key)
+            if published is not None and published[1]() is image:
+                handle = published[0]
+                self._refs[handle] += 1
+                return handle
+
+        array = _to_rgb_array(image)
+        with self._lock:
+            nbytes = _aligned(array.nbytes)
+            allocation = self._allocate(nbytes)
+            if allocation is None:
+                return None
+            segment, offset = allocation
+            handle = SharedImageHandle(segment.shm.name, array.shape, offset)
+            shared = np.ndarray(array.shape, dtype=np.uint8, buffer=segment.shm.buf, offset=offset)
+            shared[:] = array
+            del shared
+            self._blocks[handle] = _Block(segment, handle, nbytes)
+            # one reference for the caller, one while the image is published
+            self._refs[handle] = 2
+
+            previous = self._published.pop(key, None)
+            if previous is not None:
+                self._decref(previous[0])
+            token = next(self._tokens)
+            self._published[key] = (handle, weakref.ref(image), token)
+
+        weakref.finalize(image, self._unpublish, key, token)
+        return handle
+
+    def release(self, handle: SharedImageHandle):
+        with self._lock:
+            self._drain_unpublished()
+            if handle in self._refs:
+                self._decref(handle)
+
+    def clear(self):
+        """Stop reusing published frames, frames still in use are freed on release."""
+        with self._lock:
+            self._unpublished.clear()
+            for handle, _, _ in self._published.values():
+                self._decref(handle)
+            self._published.clear()
+
+    def close(self):
+        with self._lock:
+            _close_segments(self._segments)
+            self._blocks.clear()
+            self._refs.clear()
+            self._published.clear()
+            self._unpublished.clear()
+
+
+def read_shared_images(images: Dict) -> Dict:
+    """
+    Copy shared frames into PIL images in a worker process.
+    Values that are not SharedImageHandles are returned as they are.
+    """
+    segments: Dict[str, SharedMemory] = {}
+    result = {}
+    try:
+        for key, value in images.items():
+            if not isinstance(value, SharedImageHandle):
+                result[key] = value
+                continue
+            if value.name not in segments:
+                try:
+                    # Spawned workers share the resource tracker of the parent, which owns the segment
+                    segments[value.name] = SharedMemory(name=value.name)
+                except FileNotFoundError:
+                    # Freed after the request was cancelled, nobody waits for this image
+                    continue
+            shm = segments[value.name]
+            shared = np.ndarray(value.shape, dtype=np.uint8, buffer=shm.buf, offset=value.offset)
+            result[key] = Image.fromarray(shared.copy())
+            del shared  # segments can not close while views exist
+    finally:
+        for shm in segments.values():
+            shm.close()
+    return result
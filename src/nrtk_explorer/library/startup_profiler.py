@@ -0,0 +1,133 @@
+"""
+Module to measure where the time to start the app goes.
+
+Modules imported after start() are timed by wrapping their loaders, the
+initialization of the app parts by measure().
+
+Example:
+    profiler.start()
+    from nrtk_explorer.app.core import Engine
+    with profiler.measure("Engine"):
+        engine = Engine()
+    print(profiler.report())
+"""
+
+import importlib.abc
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+MODULES_REPORTED = 30
+
+
+class _TimingLoader(importlib.abc.Loader):
+    def __init__(self, profiler: "StartupProfiler", name: str, loader):
+        self._profiler = profiler
+        self._name = name
+        self._loader = loader
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        # the module only ever sees its own loader
+        module.__loader__ = self._loader
+        module.__spec__.loader = self._loader
+        self._profiler._time_import(self._name, self._loader, module)
+
+
+class _ImportTimer(importlib.abc.MetaPathFinder):
+    def __init__(self, profiler: "StartupProfiler"):
+        self._profiler = profiler
+
+    def find_spec(self, name, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is None:
+                continue
+            if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+                spec.loader = _TimingLoader(self._profiler, name, spec.loader)
+            return spec
+        return None
+
+
+class StartupProfiler:
+    """Import time of each module and time of named steps, disabled until started."""
+
+    def __init__(self):
+        self.started = False
+        self.start_time = 0.0
+        # module -> (self seconds, cumulative seconds)
+        self.imports: Dict[str, Tuple[float, float]] = {}
+        # step name -> seconds
+        self.steps: Dict[str, float] = {}
+        self._finder = _ImportTimer(self)
+        self._local = threading.local()
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        self.start_time = time.perf_counter()
+        sys.meta_path.insert(0, self._finder)
+
+    def stop(self):
+        if self._finder in sys.meta_path:
+            sys.meta_path.remove(self._finder)
+
+    def _time_import(self, name: str, loader, module):
+        # seconds spent importing nested modules, by import depth
+        stack: List[float] = self._local.__dict__.setdefault("stack", [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            loader.exec_module(module)
+        finally:
+            cumulative = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += cumulative
+            self.imports[name] = (cumulative - nested, cumulative)
+
+    @contextmanager
+    def measure(self, name: str):
+        if not self.started:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps[name] = self.steps.get(name, 0.0) + time.perf_counter() - start
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start_time
+
+    def report(self, modules=MODULES_REPORTED) -> str:
+        from tabulate import tabulate
+
+        slowest = sorted(self.imports.items(), key=lambda item: item[1][1], reverse=True)
+        imports = tabulate(
+            [(name, f"{own:.3f}", f"{cumulative:.3f}") for name, (own, cumulative) in slowest][
+                :modules
+            ],
+            headers=["module", "self (s)", "cumulative (s)"],
+        )
+        steps = tabulate(
+            [(name, f"{seconds:.3f}") for name, seconds in self.steps.items()],
+            headers=["initialization", "seconds"],
+        )
+        return (
+            f"Startup took {self.elapsed():.3f} s, {len(self.imports)} modules imported\n\n"
+            f"{steps}\n\n{imports}"
+        )
+
+
+profiler = StartupProfiler()
@@ -0,0 +1,144 @@
+"""
+Module to run CPU heavy image transforms on a pool of processes.
+
+Transforms are sent to workers as serialized specs, each worker rebuilds the
+transform instances of a spec once and reuses them for the next images.
+
+Example:
+    executor = TransformExecutor(max_workers=4)
+    specs = serialize_transform(chain)
+    [transformed] = await executor.submit(specs, array)
+"""
+
+import asyncio
+import importlib
+import json
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from . import serialization_helpers
+from .transforms import ChainedImageTransform, ImageTransform
+from .yaml_transforms import MetaYamlPerturber, generate_transforms
+
+# Transform instances kept by each worker, keyed by their spec
+WORKER_TRANSFORMS_KEPT = 8
+
+# (kind, name, parameters), kind is "yaml" for transforms of the YAML definition
+TransformSpec = Tuple[str, str, Dict[str, Any]]
+
+
+def transform_steps(transform) -> List[ImageTransform]:
+    if isinstance(transform, ChainedImageTransform):
+        return list(transform.transforms)
+    return [transform]
+
+
+def serialize_transform(transform) -> List[TransformSpec]:
+    """Specs of the steps of a transform, picklable and independent of the instances."""
+    specs = []
+    for step in transform_steps(transform):
+        cls = type(step)
+        if isinstance(cls, MetaYamlPerturber):
+            specs.append(("yaml", cls.__name__, step.get_parameters()))
+        else:
+            specs.append(("class", f"{cls.__module__}.{cls.__qualname__}", step.get_parameters()))
+    return specs
+
+
+def _build_step(spec: TransformSpec, yaml_transforms: Callable[[], Dict[str, Any]]):
+    kind, name, parameters = spec
+    if kind == "yaml":
+        cls = yaml_transforms()[name]
+    else:
+        module_name, _, class_name = name.rpartition(".")
+        cls = getattr(importlib.import_module(module_name), class_name)
+    step = cls()
+    # get_parameters serializes some values, deserialize them like TransformsApp does
+    parameters = dict(parameters)
+    for key, value in cls.get_parameters_description().items():
+        if "deserialize_func" in value and key in parameters:
+            parameters[key] = getattr(serialization_helpers, value["deserialize_func"])(
+                parameters[key]
+            )
+    step.set_parameters(parameters)
+    return step
+
+
+# Worker process state
+_yaml_transforms: Dict[str, Any] = {}
+_steps: "OrderedDict[str, ImageTransform]" = OrderedDict()
+
+
+def _worker_yaml_transforms():
+    # perturber modules are slow to import, only workers running them pay for it
+    if not _yaml_transforms:
+        _yaml_transforms.update(generate_transforms())
+    return _yaml_transforms
+
+
+def _worker_step(spec: TransformSpec) -> ImageTransform:
+    key = json.dumps(spec, sort_keys=True, default=repr)
+    step = _steps.get(key)
+    if step is None:
+        step = _build_step(spec, _worker_yaml_transforms)
+        _steps[key] = step
+        if len(_steps) > WORKER_TRANSFORMS_KEPT:
+            _steps.popitem(last=False)
+    else:
+        _steps.move_to_end(key)
+    return step
+
+
+def _execute_steps(
+    specs: Sequence[TransformSpec], array: np.ndarray, with_prefixes: bool
+) -> List[np.ndarray]:
+    """
+    The transformed image, preceded by the output of each other step when
+    with_prefixes, as outputs are pickled back to the parent.
+    """
+    outputs = []
+    for spec in specs:
+        array = _worker_step(spec).execute_batch([array])[0]
+        if with_prefixes:
+            outputs.append(array)
+    return outputs if with_prefixes else [array]
+
+
+class TransformExecutor:
+    """
+    Pool of spawned processes running transforms one image per task, so
+    images of a chunk are transformed in parallel. The pool starts on first use.
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._pool
+
+    def submit(
+        self, specs: Sequence[TransformSpec], array: np.ndarray, with_prefixes=False
+    ) -> "asyncio.Future":
+        """
+        Future of the outputs of specs applied to array: the output of the last
+        step, or of each step when with_prefixes.
+        """
+        future = self._get_pool().submit(
+            _execute_steps, list(specs), np.asarray(array), with_prefixes
+        )
+        return asyncio.wrap_future(future)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -1,8 +1,23 @@
-from typing import TypeVar, Generic, Dict, TypedDict, Literal, Union, Any, Sequence, Optional
+from typing import (
+    TypeVar,
+    Generic,
+    Dict,
+    TypedDict,
+    Literal,
+    Union,
+    Any,
+    Sequence,
+    Optional,
+    Callable,
+)
 
 import abc
+import json
 
-from PIL import ImageFilter, ImageOps
+import numpy as np
+import xxhash
+
+from PIL import Image as ImageModule
 from PIL.Image import Image
 
 T = TypeVar("T")
@@ -12,6 +27,9 @@ ParameterType = Literal["string", "integer", "float", "boolean"]
 ParameterValue = Union[str, int, float]
 ParameterOptions = Sequence[ParameterValue]
 
+# uint8 images, either a (N, H, W, C) stack or a sequence of (H, W, C) arrays of any sizes
+ImageArrays = Union[np.ndarray, Sequence[np.ndarray]]
+
 
 # If we target python>=3.11 we should use NotRequired instead of Optional
 class ParameterDescription(TypedDict):
@@ -41,7 +59,37 @@ class Transform(abc.ABC, Generic[T, S]):
 
 
 class ImageTransform(Transform[Image, Image]):
-    pass
+    def execute_batch(self, inputs: ImageArrays, *input_args: Any) -> ImageArrays:
+        """
+        Transform many images at once, returns arrays in the order of the inputs.
+        Transforms overriding it return a stack for a stacked input, this
+        fallback returns a list.
+        """
+        return [
+            np.asarray(self.execute(ImageModule.fromarray(np.asarray(input)), *input_args))
+            for input in inputs
+        ]
+
+
+def _map_stacks(inputs: ImageArrays, function: Callable[[np.ndarray], np.ndarray]) -> ImageArrays:
+    """Apply a function of (N, H, W, C) stacks to a stack, or to each array of a sequence."""
+    if isinstance(inputs, np.ndarray):
+        return function(inputs)
+    return [function(np.asarray(input)[np.newaxis])[0] for input in inputs]
+
+
+def _map_images(inputs: ImageArrays, function: Callable[[np.ndarray], np.ndarray]) -> ImageArrays:
+    """Apply a function of (H, W, C) arrays to each image of a stack or of a sequence."""
+    outputs = [function(np.asarray(input)) for input in inputs]
+    if isinstance(inputs, np.ndarray):
+        return np.stack(outputs)
+    return outputs
+
+
+def _execute_as_batch(transform: ImageTransform, input: Image, *input_args: Any) -> Image:
+    """Single image execute of transforms implemented by execute_batch, so both agree."""
+    stack = np.asarray(input)[np.newaxis]
+    return ImageModule.fromarray(transform.execute_batch(stack, *input_args)[0])
 
 
 class ChainedImageTransform(ImageTransform):
@@ -56,6 +104,14 @@ class ChainedImageTransform(ImageTransform):
 
         return output
 
+    def execute_batch(self, inputs: ImageArrays, *input_args: Any) -> ImageArrays:
+        outputs = inputs
+
+        for transform in self.transforms:
+            outputs = transform.execute_batch(outputs, *input_args)
+
+        return outputs
+
     def get_parameters(self) -> Dict[str, Any]:
         raise NotImplementedError(
             "Set/Get parameters on the individual transforms making up the ChainedImageTransform"
@@ -73,6 +129,29 @@ class ChainedImageTransform(ImageTransform):
         )
 
 
+def _transform_signature(transform: Optional[Transform]):
+    if transform is None:
+        return None
+    if isinstance(transform, ChainedImageTransform):
+        return [_transform_signature(t) for t in transform.transforms]
+    cls = type(transform)
+    return [f"{cls.__module__}.{cls.__qualname__}", transform.get_parameters()]
+
+
+def transform_hash(transform: Optional[Transform]) -> str:
+    """Equal for transforms of the same types and parameters."""
+    signature = json.dumps(_transform_signature(transform), sort_keys=True, default=repr)
+    return xxhash.xxh3_64_hexdigest(signature.encode())
+
+
+def chain_prefix_hashes(transforms: Sequence[ImageTransform]) -> list[str]:
+    """transform_hash of the chain of the first 1, 2, ... n transforms."""
+    return [
+        transform_hash(ChainedImageTransform(list(transforms[: i + 1])))
+        for i in range(len(transforms))
+    ]
+
+
 class IdentityTransform(ImageTransform):
     def get_parameters(self) -> Dict[str, Any]:
         return {}
@@ -87,6 +166,9 @@ class IdentityTransform(ImageTransform):
     def execute(self, input: Image, *input_args: Any) -> Image:
         return input.copy()
 
+    def execute_batch(self, inputs: ImageArrays, *input_args: Any) -> ImageArrays:
+        return _map_stacks(inputs, np.copy)
+
 
 class GaussianBlurTransform(ImageTransform):
     default_radius = 1
@@ -115,7 +197,21 @@ class GaussianBlurTransform(ImageTransform):
         }
 
     def execute(self, input: Image, *input_args: Any) -> Image:
-        return input.filter(ImageFilter.GaussianBlur(self._radius))
+        return _execute_as_batch(self, input, *input_args)
+
+    def execute_batch(self, inputs: ImageArrays, *input_args: Any) -> ImageArrays:
+        from scipy import ndimage
+
+        def blur(stack):
+            # blur rows and columns only, not across images or channels, with
+            # edges extended and rounding as PIL GaussianBlur
+            sigma = (0, self._radius, self._radius) + (0,) * (stack.ndim - 3)
+            blurred = ndimage.gaussian_filter(
+                stack.astype(np.float32), sigma=sigma, mode="nearest"
+            )
+            return blurred.round().clip(0, 255).astype(np.uint8)
+
+        return _map_stacks(inputs, blur)
 
 
 class InvertTransform(ImageTransform):
@@ -130,7 +226,10 @@ class InvertTransform(ImageTransform):
         return {}
 
     def execute(self, input: Image, *input_args: Any) -> Image:
-        return ImageOps.invert(input)
+        return _execute_as_batch(self, input, *input_args)
+
+    def execute_batch(self, inputs: ImageArrays, *input_args: Any) -> ImageArrays:
+        return _map_stacks(inputs, lambda stack: 255 - stack)
 
 
 class DownSampleTransform(ImageTransform):
@@ -145,8 +244,17 @@ class DownSampleTransform(ImageTransform):
         return {}
 
     def execute(self, input: Image, *input_args: Any) -> Image:
+        return _execute_as_batch(self, input, *input_args)
+
+    def execute_batch(self, inputs: ImageArrays, *input_args: Any) -> ImageArrays:
         cx = 2
-        return input.resize((input.size[0] // cx, input.size[1] // cx))
+
+        def downsample(array):
+            # PIL bicubic resize, a block mean is visibly softer
+            image = ImageModule.fromarray(array)
+            return np.asarray(image.resize((image.width // cx, image.height // cx)))
+
+        return _map_images(inputs, downsample)
 
 
 class TestTransform(ImageTransform):
@@ -1,6 +1,11 @@
 import os
+import sys
+import json
 import numpy as np
 import contextlib
+import sysconfig
+import importlib.machinery
+import importlib.util
 
 from PIL import Image as ImageModule
 from pathlib import Path
@@ -20,6 +25,13 @@ if "NRTK_TRANSFORM_DEFINITION" in os.environ:
 
 TRANSFORM_DEFINITIONS = load(TRANSFORM_FILE.read_text(), Loader=Loader)
 
+# Perturbers found to import or fail to, kept across runs in the same environment
+AVAILABILITY_FILE = (
+    Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+    / "nrtk-explorer"
+    / "perturber_availability.json"
+)
+
 __all__ = [
     "generate_transforms",
 ]
@@ -30,9 +42,14 @@ __all__ = [
 
 
 def generate_transforms():
+    """
+    Transform classes of the YAML definition, without importing their perturbers.
+    A perturber is imported when its transform is first instantiated, transforms
+    whose modules are missing or failed to import before are skipped.
+    """
     transforms = {}
     for k, v in TRANSFORM_DEFINITIONS.items():
-        with contextlib.suppress(ModuleNotFoundError):
+        if is_available(v.get("perturber")) and is_available(v.get("perturber_kwargs")):
             transforms[k] = MetaYamlPerturber(k, (), {}, v)
 
     return transforms
@@ -48,7 +65,81 @@ def get(name):
     import_path = ".".join(component_path[:-1])
     obj_name = component_path[-1]
     module = __import__(import_path, fromlist=[obj_name])
-    return getattr(module, obj_name)
+    try:
+        return getattr(module, obj_name)
+    except AttributeError as e:
+        raise ImportError(f"cannot import {obj_name} from {import_path}") from e
+
+
+# -----------------------------------------------------------------------------
+
+
+def module_exists(module_name):
+    """Finds the module without running the __init__ of its packages, unlike find_spec."""
+    top_level, *parts = module_name.split(".")
+    # no import for a top level name, and finds editable installs PathFinder misses
+    spec = importlib.util.find_spec(top_level)
+    for part in parts:
+        if spec is None or spec.submodule_search_locations is None:
+            # missing, or a module and the remaining parts are attributes
+            break
+        spec = importlib.machinery.PathFinder.find_spec(
+            f"{spec.name}.{part}", spec.submodule_search_locations
+        )
+    return spec is not None
+
+
+def _environment():
+    """Changes when packages are installed in or removed from the site-packages."""
+    paths = sysconfig.get_paths()
+    environment = [sys.prefix]
+    for site_packages in dict.fromkeys((paths["purelib"], paths["platlib"])):
+        with contextlib.suppress(OSError):
+            environment.append(str(Path(site_packages).stat().st_mtime_ns))
+    return ":".join(environment)
+
+
+class PerturberAvailability:
+    """Import outcome of each perturber path, saved while the environment is unchanged."""
+
+    def __init__(self, path=AVAILABILITY_FILE):
+        self.path = path
+        self.environment = _environment()
+        self.available = {}
+        with contextlib.suppress(OSError, ValueError):
+            saved = json.loads(self.path.read_text())
+            if saved.get("environment") == self.environment:
+                self.available = saved["perturbers"]
+
+    def get(self, name):
+        return self.available.get(name)
+
+    def set(self, name, available):
+        if self.available.get(name) == available:
+            return
+        self.available[name] = available
+        with contextlib.suppress(OSError):
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.path.write_text(
+                json.dumps({"environment": self.environment, "perturbers": self.available})
+            )
+
+
+availability = PerturberAvailability()
+
+
+def is_available(name):
+    """
+    Whether a perturber or kwargs path may be imported: False if it failed to
+    import before, or its module is missing. Dicts of kwargs are always available.
+    """
+    if not isinstance(name, str):
+        return True
+    available = availability.get(name)
+    if available is not None:
+        return available
+    module_name = name.rpartition(".")[0]
+    return module_exists(module_name)
 
 
 # -----------------------------------------------------------------------------
@@ -79,6 +170,9 @@ def set_value(obj, attr_path, value):
 def get_perturber_constructor(klass, kwargs):
     klass = get(klass)
 
+    if not callable(getattr(klass, "perturb", None)):
+        raise TypeError(f"{klass} is not a perturber, it has no perturb method")
+
     if isinstance(kwargs, str):
         kwargs = get(kwargs)
 
@@ -109,17 +203,27 @@ class MetaYamlPerturber(type):
         # add class variables
         setattr(cls, "description", config.get("description", {}))
         setattr(cls, "exec_args", config.get("exec_default_args", {}))
-        perturber_class, perturber_kwargs = get_perturber_constructor(
-            config.get("perturber"), config.get("perturber_kwargs", {})
-        )
-        setattr(cls, "perturber_class", perturber_class)
-        setattr(cls, "perturber_kwargs", perturber_kwargs)
+        # perturber imported on first instantiation
+        setattr(cls, "config", config)
+        setattr(cls, "perturber_class", None)
+        setattr(cls, "perturber_kwargs", None)
 
         # class methods
         setattr(cls, "__init__", MetaYamlPerturber.instance_init)
         setattr(cls, MetaYamlPerturber.get_parameters.__name__, MetaYamlPerturber.get_parameters)
         setattr(cls, MetaYamlPerturber.set_parameters.__name__, MetaYamlPerturber.set_parameters)
         setattr(cls, MetaYamlPerturber.execute.__name__, MetaYamlPerturber.execute)
+        setattr(cls, MetaYamlPerturber.execute_batch.__name__, MetaYamlPerturber.execute_batch)
+        setattr(
+            cls,
+            MetaYamlPerturber._update_perturber.__name__,
+            MetaYamlPerturber._update_perturber,
+        )
+        setattr(
+            cls,
+            MetaYamlPerturber.load_perturber.__name__,
+            classmethod(MetaYamlPerturber.load_perturber),
+        )
         setattr(
             cls,
             MetaYamlPerturber.get_parameters_description.__name__,
@@ -132,7 +236,23 @@ class MetaYamlPerturber(type):
 
     # Methods that will be defined on the dynamic YamlPerturber classes
 
+    def load_perturber(cls):
+        """Import the perturber, raises ImportError if unavailable."""
+        if cls.perturber_class is not None:
+            return
+        perturber = cls.config.get("perturber")
+        perturber_kwargs = cls.config.get("perturber_kwargs", {})
+        try:
+            cls.perturber_class, cls.perturber_kwargs = get_perturber_constructor(
+                perturber, perturber_kwargs
+            )
+        except ImportError:
+            availability.set(perturber, False)
+            raise
+        availability.set(perturber, True)
+
     def instance_init(self):
+        self.load_perturber()
         self._perturber = self.perturber_class(**self.perturber_kwargs)
 
     def get_parameters(self):
@@ -153,10 +273,7 @@ class MetaYamlPerturber(type):
     def get_parameters_description(cls):
         return cls.description
 
-    def execute(self, input, *input_args):
-        if len(input_args) == 0:
-            input_args = self.exec_args
-
+    def _update_perturber(self):
         if self.params_updated:
             new_params = self.get_parameters()
             for k, v in self.description.items():
@@ -167,7 +284,18 @@ class MetaYamlPerturber(type):
             self._perturber = self.perturber_class(**new_params)
             self.params_updated = False
 
-        input_array = np.asarray(input)
-        output_array, _ = self._perturber.perturb(image=input_array, **input_args)
+    def execute(self, input, *input_args):
+        return ImageModule.fromarray(self.execute_batch([np.asarray(input)], *input_args)[0])
+
+    def execute_batch(self, inputs, *input_args):
+        """Perturbers take one image at a time, but arrays are passed without PIL round trips."""
+        if len(input_args) == 0:
+            input_args = self.exec_args
+
+        self._update_perturber()
 
-        return ImageModule.fromarray(output_array)
+        outputs = []
+        for input in inputs:
+            output_array, _ = self._perturber.perturb(image=np.asarray(input), **input_args)
+            outputs.append(output_array)
+        return outputs
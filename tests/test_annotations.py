@@ -0,0 +1,35 @@
+import asyncio
+
+from PIL import Image
+
+from nrtk_explorer.app.images.annotations import DetectionAnnotations
+from nrtk_explorer.app.images.cache import LruCache, noop
+
+
+class CountingPredictor:
+    def __init__(self):
+        self.inferred = 0
+
+    async def infer(self, images):
+        self.inferred += len(images)
+        return {id: [{"label": "cat", "score": 1.0}] for id in images}
+
+
+def test_identical_images_are_predicted_once():
+    predictor = CountingPredictor()
+    by_content = LruCache(10)
+    original = DetectionAnnotations(noop, noop, by_content=by_content)
+    transformed = DetectionAnnotations(noop, noop, by_content=by_content)
+    image = Image.new("RGB", (8, 4), (1, 2, 3))
+    other = Image.new("RGB", (8, 4), (4, 5, 6))
+
+    asyncio.run(original.get_annotations(predictor, {"img_1": image, "img_2": image.copy()}))
+    assert predictor.inferred == 1
+
+    annotations = asyncio.run(
+        transformed.get_annotations(
+            predictor, {"transformed_img_1": image.copy(), "transformed_img_2": other}
+        )
+    )
+    assert predictor.inferred == 2
+    assert set(annotations) == {"transformed_img_1", "transformed_img_2"}
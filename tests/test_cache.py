@@ -1,6 +1,9 @@
 import unittest
 from unittest.mock import Mock
 
+import numpy as np
+from PIL import Image
+
 from nrtk_explorer.app.images.cache import LruCache
 
 
@@ -67,6 +70,59 @@ class TestLruCache(unittest.TestCase):
         on_clear_1.assert_called_once_with("key1")
         on_clear_2.assert_called_once_with("key1")
 
+    def test_max_bytes(self):
+        cache = LruCache(max_bytes=100)
+        cache.add_item("small", Image.new("RGB", (4, 4)))  # 48 bytes
+        cache.add_item("array", np.zeros(40, dtype=np.uint8))
+        self.assertEqual(cache.bytes, 88)
+        cache.add_item("large", Image.new("L", (8, 4)))  # 32 bytes
+        self.assertIsNone(cache.get_item("small"))
+        self.assertEqual(cache.bytes, 72)
+
+    def test_readd_array(self):
+        cache = LruCache(max_size=2)
+        array = np.zeros(4)
+        cache.add_item("array", array)
+        cache.add_item("array", array)
+        cache.add_item("array", np.ones(4))
+        np.testing.assert_array_equal(cache.get_item("array"), np.ones(4))
+
+    def test_item_larger_than_budget_is_kept_alone(self):
+        cache = LruCache(max_bytes=10, sizer=len)
+        cache.add_item("key1", "12345")
+        cache.add_item("key2", "123456789012")
+        self.assertIsNone(cache.get_item("key1"))
+        self.assertEqual(cache.get_item("key2"), "123456789012")
+
+    def test_lfu_keeps_frequently_accessed(self):
+        cache = LruCache(max_size=2, policy="lfu")
+        cache.add_item("key1", "value1")
+        cache.add_item("key2", "value2")
+        cache.get_item("key1")
+        cache.get_item("key2")
+        cache.get_item("key1")
+        cache.add_item("key3", "value3")
+        self.assertIsNone(cache.get_item("key2"))
+        self.assertEqual(cache.get_item("key1"), "value1")
+
+    def test_2q_resists_scans(self):
+        cache = LruCache(max_size=4, policy="2q")
+        cache.add_item("visible", "value")
+        cache.get_item("visible")
+        for i in range(10):
+            cache.add_item(f"scan{i}", "value")
+        self.assertEqual(cache.get_item("visible"), "value")
+
+    def test_stats(self):
+        cache = LruCache(max_size=1, sizer=len)
+        cache.add_item("key1", "value1")
+        cache.get_item("key1")
+        cache.get_item("key2")
+        cache.add_item("key2", "value2")
+        self.assertEqual(
+            cache.stats(), {"items": 1, "bytes": 6, "hits": 1, "misses": 1, "evictions": 1}
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,6 +1,8 @@
-from nrtk_explorer.library.dataset import get_dataset, CocoDataset
+from nrtk_explorer.library.dataset import get_dataset, typical_image_size, CocoDataset
 import nrtk_explorer.test_data
 
+import json
+import zipfile
 from pathlib import Path
 
 import pytest
@@ -21,6 +23,13 @@ def test_get_dataset(dataset_path):
     assert ds1 is ds2
 
 
+def test_typical_image_size(dataset_path):
+    ds = get_dataset(dataset_path)
+    width, height = typical_image_size(ds)
+    widths = sorted(image["width"] for image in ds.imgs.values())
+    assert widths[0] <= width <= widths[-1] and height > 0
+
+
 def test_get_dataset_empty():
     with pytest.raises(ValueError):
         get_dataset("nonexisting")
@@ -32,3 +41,68 @@ def test_DefaultDataset(dataset_path):
     assert len(ds.cats) > 0
     assert len(ds.anns) > 0
     assert ds.get_image(next(iter(ds.imgs.keys()))) is not None
+
+
+def test_image_annotations_index(dataset_path):
+    ds = get_dataset(dataset_path)
+    for image_id in ds.imgs.keys():
+        expected = [ann for ann in ds.anns.values() if ann["image_id"] == image_id]
+        annotations = ds.get_image_annotations(image_id)
+        assert sorted(ann["id"] for ann in annotations) == sorted(ann["id"] for ann in expected)
+        assert sorted(ds.get_image_category_ids(image_id)) == sorted(
+            ann["category_id"] for ann in expected
+        )
+
+    for cat_id in ds.cats.keys():
+        expected = {ann["image_id"] for ann in ds.anns.values() if ann["category_id"] == cat_id}
+        assert set(ds.cid_to_gids.get(cat_id, ())) == expected
+
+    assert ds.get_image_annotations(-1) == []
+
+
+def test_image_id_from_dataset_id(dataset_path):
+    ds = get_dataset(dataset_path)
+    for image_id in ds.imgs.keys():
+        assert ds.get_image_id(str(image_id)) == image_id
+
+    ds.imgs["img_a"] = {"id": "img_a"}  # Hugging Face datasets may have str ids
+    try:
+        assert ds.get_image_id("img_a") == "img_a"
+        assert ds.get_image_annotations(ds.get_image_id("img_a")) == []
+    finally:
+        del ds.imgs["img_a"]
+
+
+def test_get_thumbnail(dataset_path):
+    ds = get_dataset(dataset_path)
+    for image_id in ds.imgs.keys():
+        width, height = ds.get_image(image_id).size
+        thumbnail = ds.get_thumbnail(image_id, 64)
+        assert max(thumbnail.size) == 64
+        assert abs(thumbnail.width / thumbnail.height - width / height) < 0.1
+
+
+def test_image_source(dataset_path):
+    ds = get_dataset(dataset_path)
+    image_id = next(iter(ds.imgs.keys()))
+    source = ds.get_image_source(image_id)
+    assert source.format == "JPEG"
+    assert source.path == str(ds.get_image_fpath(image_id))
+
+
+def test_zip_backed_images(dataset_path, tmp_path):
+    coco = json.loads(Path(dataset_path).read_text())
+    with zipfile.ZipFile(tmp_path / "images.zip", "w") as archive:
+        for image in coco["images"]:
+            archive.write(Path(dataset_path).parent / image["file_name"], image["file_name"])
+            image["file_name"] = f"images.zip/{image['file_name']}"
+    zipped_path = tmp_path / "dataset.json"
+    zipped_path.write_text(json.dumps(coco))
+
+    ds = CocoDataset(str(zipped_path))
+    original = CocoDataset(dataset_path)
+    image_id = next(iter(ds.imgs.keys()))
+    assert ds.get_image(image_id).size == original.get_image(image_id).size
+    source = ds.get_image_source(image_id)
+    assert source.path is None
+    assert source.data == Path(original.get_image_fpath(image_id)).read_bytes()
@@ -0,0 +1,57 @@
+import numpy as np
+from PIL import Image
+
+from nrtk_explorer.library.frame_spill import FrameSpill
+
+
+def make_image(value, size=(8, 4)):
+    return Image.new("RGB", size, (value, value, value))
+
+
+def test_spilled_frames_are_mapped_back(tmp_path):
+    spill = FrameSpill(str(tmp_path))
+    image = make_image(7)
+    spill.put("dataset:transform:1", image)
+    assert np.array_equal(np.asarray(spill.get("dataset:transform:1")), np.asarray(image))
+
+    spill.flush()
+    assert list(tmp_path.glob("*.npy"))
+    assert np.array_equal(np.asarray(spill.get("dataset:transform:1")), np.asarray(image))
+    assert spill.get("dataset:other:1") is None
+    assert spill.stats()["hits"] == 2
+    spill.close()
+
+
+def test_disk_quota_removes_least_recently_used(tmp_path):
+    spill = FrameSpill(str(tmp_path))
+    spill.put("a", make_image(1))
+    spill.flush()
+    spill.max_size = int(spill.size * 2.5)
+
+    spill.put("b", make_image(2))
+    spill.flush()
+    spill.get("a")
+    spill.put("c", make_image(3))
+    spill.flush()
+
+    assert "a" in spill and "c" in spill and "b" not in spill
+    assert len(list(tmp_path.glob("*.npy"))) == 2
+    spill.close()
+
+
+def test_directory_is_reused_across_instances(tmp_path):
+    spill = FrameSpill(str(tmp_path))
+    spill.put("a", make_image(1))
+    spill.close()
+
+    spill = FrameSpill(str(tmp_path))
+    assert np.array_equal(np.asarray(spill.get("a")), np.asarray(make_image(1)))
+    spill.close()
+    assert tmp_path.exists()
+
+
+def test_temporary_directory_is_removed():
+    spill = FrameSpill()
+    spill.put("a", make_image(1))
+    spill.close()
+    assert not spill.directory.exists()
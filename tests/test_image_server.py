@@ -0,0 +1,121 @@
+import asyncio
+import io
+
+from aiohttp.test_utils import make_mocked_request
+from PIL import Image
+
+from nrtk_explorer.app.images.image_server import (
+    MAX_THUMBNAIL_SIZE,
+    EncodedImageCache,
+    SingleFlight,
+    compose_sprite,
+    encode_image,
+    etag_matches,
+    make_encoded_image,
+    make_response,
+    parse_image_query,
+)
+
+
+def test_single_flight_shares_computation():
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "image"
+
+    async def main():
+        flight = SingleFlight()
+        results = await asyncio.gather(*(flight.run("img_1", compute) for _ in range(3)))
+        assert results == ["image"] * 3
+        assert len(flight) == 0
+        await flight.run("img_1", compute)
+
+    asyncio.run(main())
+    assert len(calls) == 2
+
+
+def test_single_flight_cancels_abandoned_computation():
+    finished = []
+
+    async def compute():
+        await asyncio.sleep(10)
+        finished.append(1)
+
+    async def main():
+        flight = SingleFlight()
+        waiters = [asyncio.ensure_future(flight.run("img_1", compute)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        waiters[0].cancel()
+        await asyncio.sleep(0.01)
+        assert len(flight) == 1
+        waiters[1].cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        assert len(flight) == 0
+
+    asyncio.run(main())
+    assert finished == []
+
+
+def test_encoded_image_cache_is_bounded_by_bytes():
+    cache = EncodedImageCache(max_size=10)
+    cache.add(("a",), make_encoded_image(b"1234", "image/jpeg"))
+    cache.add(("b",), make_encoded_image(b"1234", "image/jpeg"))
+    cache.get(("a",))
+    cache.add(("c",), make_encoded_image(b"1234", "image/jpeg"))
+
+    assert cache.get(("b",)) is None
+    assert cache.get(("a",)) is not None
+    assert cache.size == 8
+
+
+def test_response_revalidation():
+    encoded = make_encoded_image(b"1234", "image/jpeg")
+
+    response = make_response(make_mocked_request("GET", "/"), encoded)
+    assert response.status == 200
+    assert response.headers["ETag"] == encoded.etag
+    assert "immutable" in response.headers["Cache-Control"]
+
+    request = make_mocked_request("GET", "/", headers={"If-None-Match": encoded.etag})
+    assert make_response(request, encoded).status == 304
+
+
+def test_etag_matches_whole_tags():
+    assert etag_matches('"abc"', '"abc"')
+    assert etag_matches('"x", W/"abc" ,"y"', '"abc"')
+    assert etag_matches("*", '"abc"')
+    assert not etag_matches("", '"abc"')
+    assert not etag_matches('"xabcx"', '"abc"')
+    assert not etag_matches('"a"', '"abc"')
+    assert not etag_matches('"abc"', '"ab"')
+
+
+def test_thumbnail_encoding():
+    image = Image.new("RGB", (640, 480))
+
+    body, content_type = encode_image(image, max_size=64, webp=True)
+    assert content_type == "image/webp"
+    assert Image.open(io.BytesIO(body)).size == (64, 48)
+
+    body, content_type = encode_image(image, webp=False)
+    assert content_type == "image/jpeg"
+    assert Image.open(io.BytesIO(body)).size == (640, 480)
+
+
+def test_parse_image_query():
+    request = make_mocked_request("GET", "/?max=100000", headers={"Accept": "image/webp,*/*"})
+    assert parse_image_query(request) == (MAX_THUMBNAIL_SIZE, True)
+    assert parse_image_query(make_mocked_request("GET", "/")) == (None, False)
+
+
+def test_compose_sprite():
+    id_to_image = {str(i): Image.new("RGB", (200, 100), (i, 0, 0)) for i in range(5)}
+
+    sprite, layout = compose_sprite(id_to_image, 50)
+
+    assert sprite.size == (150, 100)
+    assert layout["0"] == (0, 0, 50, 25)
+    assert layout["4"] == (50, 50, 50, 25)
+    assert sprite.getpixel((60, 60)) == (4, 0, 0)
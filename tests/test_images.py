@@ -0,0 +1,125 @@
+import asyncio
+import threading
+
+from PIL import Image
+from trame.app import get_server
+
+from nrtk_explorer.app.images.images import Images
+from nrtk_explorer.library.transforms import ChainedImageTransform, GaussianBlurTransform
+
+
+class Dataset:
+    def get_image(self, id):
+        return Image.new("RGB", (8, 4), (id, id, id))
+
+
+class CountingBlur(GaussianBlurTransform):
+    def __init__(self, radius):
+        super().__init__()
+        self.set_parameters({"radius": radius})
+        self.executed = 0
+
+    def execute_batch(self, inputs, *input_args):
+        self.executed += len(inputs)
+        return super().execute_batch(inputs, *input_args)
+
+
+def make_images(name):
+    server = get_server(name)
+    server.state.current_dataset = "dataset"
+    server.context.dataset = Dataset()
+    return Images(server)
+
+
+def test_changing_last_step_reuses_chain_prefix():
+    images = make_images("test_chain_prefix")
+    first, second = CountingBlur(1), CountingBlur(1)
+    images.set_transform(ChainedImageTransform([first, second, CountingBlur(1)]))
+    images.get_transformed_image("1")
+
+    last = CountingBlur(2)
+    images.set_transform(ChainedImageTransform([first, second, last]))
+    images.get_transformed_image("1")
+    assert (first.executed, second.executed, last.executed) == (1, 1, 1)
+
+    second.set_parameters({"radius": 3})
+    images.set_transform(ChainedImageTransform([first, second, last]))
+    images.get_transformed_image("1")
+    assert (first.executed, second.executed, last.executed) == (1, 2, 2)
+
+
+def test_same_transform_parameters_keep_transformed_images():
+    images = make_images("test_same_transform")
+    blur = CountingBlur(1)
+    assert images.set_transform(ChainedImageTransform([blur]))
+    images.get_transformed_image("1")
+
+    assert not images.set_transform(ChainedImageTransform([CountingBlur(1)]))
+    images.get_transformed_image("1")
+    assert blur.executed == 1
+
+    assert images.set_transform(ChainedImageTransform([CountingBlur(2)]))
+
+
+def test_transformed_images_are_transformed_in_one_batch():
+    images = make_images("test_transform_batch")
+    blur = CountingBlur(1)
+    calls = []
+    blur.execute_batch = lambda inputs: calls.append(len(inputs)) or inputs
+    images.set_transform(ChainedImageTransform([blur]))
+
+    id_to_image = images.get_transformed_images_without_cache_eviction(["1", "2", "3"])
+    assert list(id_to_image) == ["1", "2", "3"]
+    assert calls == [3]
+    images.get_transformed_images_without_cache_eviction(["1", "4"])
+    assert calls == [3, 1]
+
+
+def test_batch_and_single_requests_share_transforms():
+    images = make_images("test_transform_single_flight")
+    blur = CountingBlur(1)
+    images.set_transform(ChainedImageTransform([blur, CountingBlur(1)]))
+
+    async def main():
+        single = asyncio.ensure_future(images.get_transformed_image_async("1"))
+        batch = asyncio.ensure_future(images.get_transformed_images_async(["1", "2"]))
+        again = asyncio.ensure_future(images.get_transformed_images_async(["2", "1"]))
+        return await asyncio.gather(single, batch, again)
+
+    single, batch, again = asyncio.run(main())
+    assert blur.executed == 2
+    assert batch["1"] is single and again["1"] is single and again["2"] is batch["2"]
+
+
+class BlockingDataset(Dataset):
+    def __init__(self):
+        self.reading = threading.Event()
+        self.release = threading.Event()
+
+    def get_image(self, id):
+        self.reading.set()
+        self.release.wait(5)
+        return super().get_image(id)
+
+
+def test_images_of_a_replaced_dataset_are_not_cached():
+    images = make_images("test_dataset_swap")
+    dataset = BlockingDataset()
+    images.server.context.dataset = dataset
+    images.set_transform(ChainedImageTransform([CountingBlur(1), CountingBlur(1)]))
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        original = asyncio.ensure_future(images.get_image_async("1"))
+        transformed = asyncio.ensure_future(images.get_transformed_image_async("2"))
+        await loop.run_in_executor(None, dataset.reading.wait, 5)
+        images.clear_all()
+        dataset.release.set()
+        return await asyncio.gather(original, transformed)
+
+    original, transformed = asyncio.run(main())
+    assert original is not None and transformed is not None
+    assert len(images.original_images.cache) == 0
+    assert len(images.transformed_images.cache) == 0
+    assert len(images.transform_memo.cache) == 0
+    assert not images._original_hashes and not images._transformed_hashes
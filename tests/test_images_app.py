@@ -0,0 +1,81 @@
+import asyncio
+
+from PIL import Image
+from trame.app import get_server
+from wslink.websocket import NetworkMonitor
+
+from nrtk_explorer.app.features import images as images_feature
+from nrtk_explorer.app.features.images import ImagesApp
+from nrtk_explorer.app.images.image_ids import dataset_id_to_image_id, image_id_to_score_id
+from nrtk_explorer.app.images.images import Images
+from nrtk_explorer.app.images.stateful_annotations import make_stateful_predictor
+from nrtk_explorer.library.scoring import BoxArraysCache
+
+BOX = [0, 0, 4, 4]
+
+
+class Dataset:
+    def get_image(self, id):
+        return Image.new("RGB", (8, 4), (int(id), 0, 0))
+
+
+class GroundTruth:
+    def get_annotations(self, dataset_ids):
+        return {id: [{"bbox": BOX, "category_id": 1}] for id in dataset_ids}
+
+
+class Predictor:
+    def __init__(self):
+        self.inferred = 0
+
+    async def infer(self, images):
+        self.inferred += len(images)
+        return {id: [{"bbox": BOX, "category_id": 1, "score": 0.6}] for id in images}
+
+
+def make_app(name, dataset_ids):
+    server = get_server(name, client_type="vue3")
+    server.state.current_dataset = "dataset"
+    server.state.confidence_score_threshold = 0.5
+    server.context.dataset = Dataset()
+    app = ImagesApp(server, images=Images(server))
+    server.state.predictions_images_enabled = True
+    server.state.transform_enabled = False
+    server.state.user_selected_ids = dataset_ids
+    server.context.ground_truth_annotations = GroundTruth()
+    predictor = Predictor()
+    server.context.models = {
+        "model": {
+            "predictor": predictor,
+            "original_annotations": make_stateful_predictor(server, "model").annotations_factory,
+            "transformed_annotations": make_stateful_predictor(
+                server, "model_t"
+            ).annotations_factory,
+        }
+    }
+    server.controller.check_images_in_view.add(lambda: None)
+    # no clients connected
+    server.context.network_monitor = NetworkMonitor()
+    return server, app, predictor
+
+
+def test_rescore_scores_images_evicted_from_box_arrays(monkeypatch):
+    monkeypatch.setattr(images_feature, "IMAGE_UPDATE_BATCH_SIZE", 2)
+    dataset_ids = [str(i) for i in range(10)]
+    server, app, predictor = make_app("test_rescore_evicted", dataset_ids)
+    # ground truth and predictions of 2 images, a chunk
+    app._original_box_arrays = BoxArraysCache(max_size=4)
+
+    def scores():
+        return [
+            server.state[image_id_to_score_id(dataset_id_to_image_id(id), "model")]
+            for id in dataset_ids
+        ]
+
+    asyncio.run(app._update_all_images([]))
+    assert scores() == [1.0] * 10
+
+    # the predictions score below the new threshold
+    server.state.confidence_score_threshold = 0.7
+    asyncio.run(app._rescore_all_images())
+    assert scores() == [0.0] * 10
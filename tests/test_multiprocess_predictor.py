@@ -0,0 +1,214 @@
+import asyncio
+import os
+import queue
+import time
+
+import pytest
+
+from nrtk_explorer.library.multiprocess_predictor import (
+    Command,
+    ModelStatus,
+    MultiprocessPredictor,
+    _Readiness,
+    _drain_infer_requests,
+    _load_predictor,
+    _merge_infer_payloads,
+    _merge_stats,
+    _split_predictions,
+)
+
+
+def infer_msg(req_id, image_ids):
+    return {
+        "command": Command.INFER.value,
+        "req_id": req_id,
+        "payload": {"images": {image_id: f"image {image_id}" for image_id in image_ids}},
+    }
+
+
+def test_drain_merges_infer_requests():
+    request_queue = queue.Queue()
+    request_queue.put(infer_msg("b", ["img_1"]))
+    request_queue.put(infer_msg("c", ["img_2", "img_3"]))
+
+    batch, next_msg = _drain_infer_requests(request_queue, infer_msg("a", ["img_1"]), 0.1, 64)
+
+    assert [msg["req_id"] for msg in batch] == ["a", "b", "c"]
+    assert next_msg is None
+    assert request_queue.empty()
+
+
+def test_drain_stops_at_other_commands():
+    request_queue = queue.Queue()
+    reset = {"command": Command.RESET.value, "req_id": "reset", "payload": {}}
+    request_queue.put(reset)
+    request_queue.put(infer_msg("b", ["img_1"]))
+
+    batch, next_msg = _drain_infer_requests(request_queue, infer_msg("a", ["img_1"]), 0.1, 64)
+
+    assert [msg["req_id"] for msg in batch] == ["a"]
+    assert next_msg is reset
+    assert request_queue.qsize() == 1
+
+
+def test_drain_stops_at_max_images():
+    request_queue = queue.Queue()
+    request_queue.put(infer_msg("b", ["img_2", "img_3"]))
+    request_queue.put(infer_msg("c", ["img_4"]))
+
+    batch, next_msg = _drain_infer_requests(request_queue, infer_msg("a", ["img_1"]), 0.1, 3)
+
+    assert [msg["req_id"] for msg in batch] == ["a", "b"]
+    assert next_msg is None
+    assert request_queue.qsize() == 1
+
+
+def test_merge_and_split_keep_colliding_ids_apart():
+    batch = [infer_msg("a", ["img_1", "img_2"]), infer_msg("b", ["img_1"])]
+
+    images = _merge_infer_payloads(batch)
+    assert len(images) == 3
+
+    predictions = {key: [{"label": str(key)}] for key in images.keys()}
+    results = _split_predictions(batch, predictions)
+
+    assert results == {
+        "a": {"img_1": [{"label": "(0, 'img_1')"}], "img_2": [{"label": "(0, 'img_2')"}]},
+        "b": {"img_1": [{"label": "(1, 'img_1')"}]},
+    }
+
+
+def test_merge_stats_sums_worker_histograms():
+    merged = _merge_stats(
+        [
+            {"images_per_batch": {1: 2, 4: 1}, "requests_per_batch": {1: 3}},
+            {"images_per_batch": {4: 2}, "requests_per_batch": {1: 1, 2: 1}},
+        ]
+    )
+
+    assert merged == {
+        "images_per_batch": {1: 2, 4: 3},
+        "requests_per_batch": {1: 4, 2: 1},
+    }
+
+
+def test_model_is_ready_once_every_worker_is():
+    loop = asyncio.new_event_loop()
+    readiness = _Readiness(2, loop)
+
+    changed = readiness.worker_ready(
+        {"status": "OK", "result": {"load_seconds": 2.0, "warmup_seconds": 1.0}}
+    )
+    assert not changed and readiness.status == ModelStatus.LOADING
+    assert not readiness.future.done()
+
+    changed = readiness.worker_ready(
+        {"status": "OK", "result": {"load_seconds": 3.0, "warmup_seconds": 0.5}}
+    )
+    assert changed and readiness.status == ModelStatus.READY
+    assert (readiness.load_seconds, readiness.warmup_seconds) == (3.0, 1.0)
+    assert readiness.future.done()
+    loop.close()
+
+
+def test_model_fails_when_a_worker_does():
+    loop = asyncio.new_event_loop()
+    readiness = _Readiness(2, loop)
+
+    assert readiness.worker_ready({"status": "ERROR", "message": "no weights"})
+    assert readiness.status == ModelStatus.ERROR and readiness.message == "no weights"
+    assert readiness.future.done()
+    # later workers do not change the outcome
+    assert not readiness.worker_ready({"status": "OK", "result": {}})
+    loop.close()
+
+
+class FakePredictor:
+    def __init__(self, model_name, force_cpu, letterbox):
+        self.model_name = model_name
+        self.evaluated = []
+
+    def eval(self, images):
+        self.evaluated.extend(image.size for image in images.values())
+        return {id: [] for id in images}
+
+
+def test_load_predictor_warms_up():
+    predictor, timings = _load_predictor(FakePredictor, "model", False, False, (64, 32))
+    assert predictor.evaluated == [(64, 32)]
+    assert set(timings) == {"load_seconds", "warmup_seconds"}
+
+    predictor, _ = _load_predictor(FakePredictor, "model", False, False, None)
+    assert predictor.evaluated == []
+
+
+class StubPredictor:
+    """
+    Loads for a second when the model is "slow", fails to load a "broken" model.
+    Predicts the process id of the worker after a while, fails on "fail" images.
+    """
+
+    def __init__(self, model_name, force_cpu, letterbox):
+        if model_name == "broken":
+            raise ValueError("no weights")
+        if model_name == "slow":
+            time.sleep(1)
+        self.revision = None
+
+    def eval(self, images):
+        # keyed by (request index, image id) in workers
+        if any(image_id == "fail" for _, image_id in images):
+            raise ValueError("bad image")
+        time.sleep(0.1)
+        return {id: [os.getpid()] for id in images}
+
+
+def test_set_model_while_first_model_loads():
+    async def main():
+        predictor = MultiprocessPredictor(
+            "slow", num_workers=2, warmup_size=None, predictor_class=StubPredictor
+        )
+        try:
+            # the READY messages of the first model must not count for this one
+            response = await predictor.set_model("broken")
+            assert response["status"] == "ERROR"
+            assert predictor.status == ModelStatus.ERROR
+            with pytest.raises(RuntimeError):
+                await predictor.wait_ready()
+
+            await predictor.set_model("fast")
+            assert predictor.status == ModelStatus.READY
+            assert list(await predictor.infer({"img_1": "image"})) == ["img_1"]
+        finally:
+            await predictor.shutdown()
+
+    asyncio.run(main())
+
+
+def test_infer_spreads_over_workers():
+    async def main():
+        predictor = MultiprocessPredictor(
+            "fast", num_workers=2, batch_window=0, warmup_size=None, predictor_class=StubPredictor
+        )
+        try:
+            await predictor.wait_ready()
+            results = await asyncio.gather(
+                *(predictor.infer({f"img_{i}": "image"}) for i in range(4))
+            )
+            assert len({pid for result in results for [pid] in result.values()}) == 2
+            assert predictor._outstanding == [0, 0]
+
+            # failed and cancelled requests are not counted as outstanding anymore
+            assert await predictor.infer({"fail": "image", "img_1": "image"}) is None
+            assert predictor._outstanding == [0, 0]
+            cancelled = asyncio.ensure_future(predictor.infer({"img_1": "image"}))
+            await asyncio.sleep(0.05)
+            assert sum(predictor._outstanding) == 1
+            cancelled.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await cancelled
+            assert predictor._outstanding == [0, 0]
+        finally:
+            await predictor.shutdown()
+
+    asyncio.run(main())
@@ -0,0 +1,125 @@
+import asyncio
+
+import pytest
+
+from nrtk_explorer.library.pipeline import Stage, run_pipeline
+
+
+def test_items_go_through_stages_in_order():
+    outputs = []
+
+    async def double(item):
+        await asyncio.sleep(0)
+        return item * 2
+
+    async def collect(item):
+        outputs.append(item)
+
+    asyncio.run(
+        run_pipeline(
+            range(5), [Stage(double), Stage(lambda item: double(item + 1)), Stage(collect)]
+        )
+    )
+    assert outputs == [2, 6, 10, 14, 18]
+
+
+def test_stages_overlap_and_are_bounded():
+    events = []
+
+    async def main():
+        slow_done = asyncio.Event()
+
+        async def fast(item):
+            events.append(("fast", item))
+            return item
+
+        async def slow(item):
+            await slow_done.wait()
+            events.append(("slow", item))
+
+        task = asyncio.ensure_future(run_pipeline(range(10), [Stage(fast), Stage(slow)]))
+        for _ in range(20):
+            await asyncio.sleep(0)
+        # slow holds 1 item, 1 waits in its queue and fast blocks on putting the next
+        started = [item for stage, item in events if stage == "fast"]
+        assert started == [0, 1, 2]
+        slow_done.set()
+        await task
+
+    asyncio.run(main())
+    assert [item for stage, item in events if stage == "slow"] == list(range(10))
+
+
+def test_concurrent_stage_works_on_several_items():
+    running = 0
+    most_running = 0
+
+    async def load(item):
+        nonlocal running, most_running
+        running += 1
+        most_running = max(most_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return item
+
+    async def consume(item):
+        pass
+
+    asyncio.run(run_pipeline(range(6), [Stage(load, concurrency=3), Stage(consume)]))
+    assert most_running == 3
+
+
+def test_concurrent_stage_passes_items_on_in_order():
+    outputs = []
+
+    async def load(item):
+        # earlier items take longer, so they would be overtaken
+        await asyncio.sleep(0.01 * (4 - item))
+        return item
+
+    async def collect(item):
+        outputs.append(item)
+
+    asyncio.run(run_pipeline(range(4), [Stage(load, concurrency=4), Stage(collect)]))
+    assert outputs == [0, 1, 2, 3]
+
+
+def test_error_cancels_other_stages():
+    cancelled = []
+
+    async def fail(item):
+        if item == 2:
+            raise ValueError(item)
+        return item
+
+    async def wait(item):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(item)
+            raise
+
+    with pytest.raises(ValueError):
+        asyncio.run(run_pipeline(range(5), [Stage(fail), Stage(wait)]))
+    assert cancelled == [0]
+
+
+def test_cancelling_pipeline_cancels_stages():
+    cancelled = []
+
+    async def wait(item):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(item)
+            raise
+
+    async def main():
+        task = asyncio.ensure_future(run_pipeline(range(5), [Stage(wait, concurrency=2)]))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert sorted(cancelled) == [0, 1]
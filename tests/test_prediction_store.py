@@ -0,0 +1,48 @@
+from PIL import ExifTags, Image
+
+from nrtk_explorer.library.prediction_store import PredictionStore, content_hash
+
+PREDICTIONS = [{"score": 0.9, "label": "cat", "box": {"xmin": 1, "ymin": 2, "xmax": 3, "ymax": 4}}]
+
+
+def test_content_hash_depends_on_pixels():
+    image = Image.new("RGB", (8, 4), (1, 2, 3))
+
+    assert content_hash(image) == content_hash(image.copy())
+    assert content_hash(image) != content_hash(Image.new("RGB", (8, 4), (1, 2, 4)))
+    assert content_hash(image) != content_hash(Image.new("RGB", (4, 8), (1, 2, 3)))
+
+
+def test_content_hash_depends_on_exif_orientation():
+    image = Image.new("RGB", (8, 4), (1, 2, 3))
+    rotated = image.copy()
+    rotated.getexif()[ExifTags.Base.Orientation] = 6  # applied before inference
+
+    assert content_hash(rotated) != content_hash(image)
+
+
+def test_store_persists_across_instances(tmp_path):
+    path = str(tmp_path / "predictions.sqlite")
+    store = PredictionStore(path)
+    store.put_many("model@1", {"a": PREDICTIONS, "b": []})
+    store.close()
+
+    store = PredictionStore(path)
+    assert store.get_many("model@1", ["a", "b", "c"]) == {"a": PREDICTIONS, "b": []}
+    assert store.get_many("model@2", ["a"]) == {}
+    assert store.size > 0
+    store.close()
+
+
+def test_store_evicts_least_recently_used(tmp_path):
+    store = PredictionStore(str(tmp_path / "predictions.sqlite"))
+    store.put_many("model", {"a": PREDICTIONS})
+    store.max_size = int(store.size * 2.5)
+
+    store.put_many("model", {"b": PREDICTIONS})
+    store.get_many("model", ["a"])
+    store.put_many("model", {"c": PREDICTIONS})
+
+    assert set(store.get_many("model", ["a", "b", "c"])) == {"a", "c"}
+    assert store.size <= store.max_size
+    store.close()
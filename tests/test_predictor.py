@@ -1,5 +1,15 @@
+import timeit
+
 import pytest
-from nrtk_explorer.library.predictor import Predictor
+from PIL import Image
+from tabulate import tabulate
+from nrtk_explorer.library.predictor import (
+    Predictor,
+    letterbox,
+    letterbox_shape,
+    oriented_size,
+    unletterbox_predictions,
+)
 from nrtk_explorer.library.scoring import compute_score
 from nrtk_explorer.library.dataset import get_dataset
 from utils import get_images, DATASET
@@ -60,3 +70,47 @@ def test_scorer():
     image_count = len(sample.keys())
     assert len(predictions) == image_count
     assert len(score_output) == image_count
+
+
+def test_letterbox_shapes_are_shared():
+    shapes = {letterbox_shape(size) for size in [(640, 480), (1024, 768), (500, 375), (612, 612)]}
+    assert shapes == {(1184, 800), (800, 800)}
+    assert letterbox_shape((480, 640)) == (800, 1184)
+    assert letterbox_shape((4000, 100)) == (1312, 800)
+
+
+def test_unletterbox_predictions():
+    image = Image.new("RGB", (320, 200))
+    box = letterbox(image, letterbox_shape(image.size))
+    assert box.image.size == (1312, 800)
+    assert box.scale == 4
+
+    predictions = [
+        {"score": 0.5, "label": "cat", "box": {"xmin": 40, "ymin": 4, "xmax": 1200, "ymax": 790}}
+    ]
+    (prediction,) = unletterbox_predictions(predictions, box)
+    assert prediction["box"] == {"xmin": 10, "ymin": 1, "xmax": 300, "ymax": 198}
+    assert prediction["label"] == "cat"
+
+
+@pytest.mark.benchmark
+def test_letterbox_benchmark():
+    images = get_images()
+    table = []
+    for use_letterbox in [False, True]:
+        predictor = Predictor(
+            model_name="hustvl/yolos-tiny", force_cpu=True, letterbox=use_letterbox
+        )
+        predictor.eval(images)  # warm up
+        output = timeit.repeat(lambda: predictor.eval(images), number=1, repeat=3)
+        batches = len({oriented_size(image) for image in images.values()})
+        if use_letterbox:
+            batches = len(
+                {
+                    letterbox_shape(oriented_size(image), *predictor._letterbox_edges())
+                    for image in images.values()
+                }
+            )
+        table.append([use_letterbox, batches, len(images) / min(output)])
+
+    print(tabulate(table, headers=["Letterbox", "Batches", "Images/sec"], tablefmt="github"))
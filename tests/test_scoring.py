@@ -0,0 +1,240 @@
+import math
+import random
+import timeit
+
+import numpy as np
+import pytest
+from smqtk_image_io.bbox import AxisAlignedBoundingBox
+from tabulate import tabulate
+
+from nrtk_explorer.library.dataset import get_dataset
+from nrtk_explorer.library import scoring
+from nrtk_explorer.library.scoring import (
+    BoxArraysCache,
+    box_iou_scores,
+    compute_score,
+    sort_by_score,
+    threshold_box_arrays,
+    to_box_arrays,
+)
+from nrtk_explorer.library.scoring_utils import (
+    ClassAgnosticBoxUnionIoUScorer,
+    ClassAgnosticPixelwiseIoUScorer,
+    box_union_iou,
+)
+from utils import DATASET
+
+
+def random_detections(rng, count, width, height, integer=False):
+    detections = []
+    for _ in range(count):
+        x_1 = rng.uniform(0, width - 2)
+        y_1 = rng.uniform(0, height - 2)
+        x_2 = rng.uniform(x_1 + 1, width)
+        y_2 = rng.uniform(y_1 + 1, height)
+        if integer:
+            x_1, y_1, x_2, y_2 = int(x_1), int(y_1), int(x_2), int(y_2)
+        detections.append((AxisAlignedBoundingBox([x_1, y_1], [x_2, y_2]), {}))
+    return detections
+
+
+def random_samples(seed, samples, width, height, max_boxes=8):
+    rng = random.Random(seed)
+    actual = []
+    predicted = []
+    for i in range(samples):
+        integer = i % 2 == 0
+        actual.append(random_detections(rng, rng.randint(1, max_boxes), width, height, integer))
+        predicted.append(random_detections(rng, rng.randint(0, max_boxes), width, height, integer))
+    return actual, predicted
+
+
+@pytest.mark.parametrize("width,height", [(120, 80), (80, 120)])
+def test_box_union_matches_pixelwise(width, height):
+    actual, predicted = random_samples(0, 200, width, height)
+
+    expected = ClassAgnosticPixelwiseIoUScorer().score(actual, predicted)
+    scores = ClassAgnosticBoxUnionIoUScorer().score(actual, predicted)
+
+    assert len(scores) == len(expected)
+    for score, expected_score in zip(scores, expected):
+        assert score == pytest.approx(expected_score)
+
+
+def test_box_union_edge_cases():
+    scorer = ClassAgnosticBoxUnionIoUScorer()
+    box = (AxisAlignedBoundingBox([10, 10], [20, 20]), {})
+    inner = (AxisAlignedBoundingBox([12, 12], [14, 14]), {})
+    disjoint = (AxisAlignedBoundingBox([30, 30], [40, 40]), {})
+    empty = (AxisAlignedBoundingBox([5, 5], [5, 5]), {})
+
+    assert scorer.score([[box]], [[box]]) == [1.0]
+    assert scorer.score([[box]], [[]]) == [0.0]
+    assert scorer.score([[box]], [[disjoint]]) == [0.0]
+    assert scorer.score([[box, inner]], [[inner]]) == [pytest.approx(4 / 100)]
+    assert math.isnan(scorer.score([[empty]], [[empty]])[0])
+
+    with pytest.raises(ValueError):
+        scorer.score([[box]], [])
+    with pytest.raises(ValueError):
+        scorer.score([[]], [[box]])
+
+
+def test_dense_image_does_not_pad_chunk(monkeypatch):
+    rng = random.Random(4)
+    counts = [(2, 3), (5, 1), (300, 250), (12, 9)]
+    actual, predicted = zip(
+        *[
+            (random_detections(rng, a, 640, 480), random_detections(rng, p, 640, 480))
+            for a, p in counts
+        ]
+    )
+
+    def to_arrays(samples):
+        return to_box_arrays(
+            None,
+            [
+                [
+                    {"bbox": list(box.min_vertex) + list(box.deltas), "category_id": 1}
+                    for box, _ in image
+                ]
+                for image in samples
+            ],
+        )
+
+    padded_sizes = []
+    pad_boxes = scoring._pad_boxes
+    monkeypatch.setattr(
+        scoring,
+        "_pad_boxes",
+        lambda arrays, max_boxes: padded_sizes.append(max_boxes) or pad_boxes(arrays, max_boxes),
+    )
+    scores = box_iou_scores(to_arrays(actual), to_arrays(predicted))
+
+    assert max(padded_sizes) == 12
+    for score, image_actual, image_predicted in zip(scores, actual, predicted):
+        expected = box_union_iou(
+            to_arrays([image_actual]).boxes.astype(int),
+            to_arrays([image_predicted]).boxes.astype(int),
+        )
+        assert score == pytest.approx(expected)
+
+
+def random_predictions(rng, dataset, annotations, with_box=True):
+    predictions = []
+    for annotation in annotations:
+        x, y, w, h = annotation["bbox"]
+        dx, dy = rng.uniform(-20, 20), rng.uniform(-20, 20)
+        label = dataset.cats[annotation["category_id"]]["name"]
+        prediction = {
+            "label": label if rng.random() < 0.8 else "not-a-category",
+            "score": rng.random(),
+        }
+        if with_box:
+            prediction["box"] = {
+                "xmin": max(0, x + dx),
+                "ymin": max(0, y + dy),
+                "xmax": x + dx + w,
+                "ymax": y + dy + h,
+            }
+        predictions.append(prediction)
+    return predictions
+
+
+def reference_score(dataset, actual, predicted, score_threshold):
+    """Per image scoring through the pixel masks, as compute_score used to do."""
+    actual = [a for a in actual if a.get("score", 1.0) >= score_threshold]
+    predicted = [p for p in predicted if p.get("score", 1.0) >= score_threshold]
+    if len(actual) == 0:
+        return 1.0 if len(predicted) == 0 else 0.0
+
+    def category_id(annotation):
+        if "category_id" in annotation:
+            return annotation["category_id"]
+        cat = dataset.name_to_cat.get(annotation["label"])
+        return cat["id"] if cat else None
+
+    def box(annotation):
+        if "bbox" in annotation:
+            x, y, w, h = annotation["bbox"]
+            return AxisAlignedBoundingBox([x, y], [x + w, y + h])
+        bbox = annotation["box"]
+        return AxisAlignedBoundingBox([bbox["xmin"], bbox["ymin"]], [bbox["xmax"], bbox["ymax"]])
+
+    if any("bbox" not in a and "box" not in a for a in actual + predicted):
+        actual_ids = {category_id(a) for a in actual}
+        predicted_ids = {category_id(p) for p in predicted}
+        matching = sum(1 for i in predicted_ids if i in actual_ids and i is not None)
+        return matching / len(actual_ids | predicted_ids)
+
+    [score] = ClassAgnosticPixelwiseIoUScorer().score(
+        [[(box(a), a) for a in actual]], [[(box(p), p) for p in predicted]]
+    )
+    return score
+
+
+@pytest.mark.parametrize("with_box", [True, False])
+@pytest.mark.parametrize("score_threshold", [0.0, 0.5, 1.0])
+def test_compute_score_matches_reference(with_box, score_threshold):
+    rng = random.Random(2)
+    ds = get_dataset(DATASET)
+    actual = {f"img_{id}": ds.get_image_annotations(id) for id in ds.imgs.keys()}
+    predicted = {
+        key: random_predictions(rng, ds, annotations, with_box)
+        for key, annotations in actual.items()
+    }
+    # images without ground truth or without predictions
+    first, second = list(actual.keys())[:2]
+    actual[first] = []
+    predicted[second] = []
+
+    scores = dict(compute_score(ds, actual, predicted, score_threshold))
+
+    assert len(scores) == len(actual)
+    for key in actual.keys():
+        expected = reference_score(ds, actual[key], predicted[key], score_threshold)
+        assert scores[key.split("_")[-1]] == pytest.approx(expected)
+
+
+@pytest.mark.benchmark
+def test_box_union_benchmark():
+    table = []
+    for width, height in [(640, 480), (3840, 2160), (10000, 10000)]:
+        actual, predicted = random_samples(1, 20, width, height, max_boxes=30)
+        for scorer in [ClassAgnosticPixelwiseIoUScorer(), ClassAgnosticBoxUnionIoUScorer()]:
+            output = timeit.repeat(lambda: scorer.score(actual, predicted), number=1, repeat=3)
+            table.append([f"{width}x{height}", scorer.__class__.__name__, min(output) / 20])
+
+    print(tabulate(table, headers=["Frame", "Scorer", "ExecTime(sec)"], tablefmt="github"))
+
+
+@pytest.mark.parametrize("score_threshold", [0.0, 0.3, 0.7, 1.0])
+def test_box_arrays_cache_threshold(score_threshold):
+    rng = random.Random(3)
+    ds = get_dataset(DATASET)
+    predicted = {
+        id: random_predictions(rng, ds, ds.get_image_annotations(id)) for id in ds.imgs.keys()
+    }
+    ids = list(predicted.keys())
+
+    cache = BoxArraysCache()
+    cache.add(ds, predicted)
+    cached = cache.threshold(ids, score_threshold)
+    expected = sort_by_score(
+        threshold_box_arrays(to_box_arrays(ds, [predicted[id] for id in ids]), score_threshold)
+    )
+
+    np.testing.assert_array_equal(cached.offsets, expected.offsets)
+    np.testing.assert_array_equal(cached.scores, expected.scores)
+    np.testing.assert_array_equal(cached.boxes, expected.boxes)
+    np.testing.assert_array_equal(cached.category_ids, expected.category_ids)
+    assert (np.diff(cached.scores)[np.diff(cached.image_index) == 0] <= 0).all()
+
+
+def test_box_arrays_cache_drops_least_recently_used():
+    cache = BoxArraysCache(max_size=2)
+    annotations = [{"bbox": [0, 0, 2, 2], "category_id": 1}]
+    cache.add(None, {"a": annotations, "b": annotations})
+    cache.threshold(["a"], 0.5)
+    cache.add(None, {"c": annotations})
+    assert "a" in cache and "b" not in cache and "c" in cache
@@ -0,0 +1,130 @@
+import gc
+
+import numpy as np
+from PIL import ExifTags, Image, ImageOps
+
+from nrtk_explorer.library import shared_images
+from nrtk_explorer.library.shared_images import SharedImageArena, read_shared_images
+from utils import get_image
+
+
+def test_share_and_read():
+    arena = SharedImageArena(segment_size=1024 * 1024)
+    image = get_image().convert("RGB")
+    handle = arena.share("img_1", image)
+
+    shared = read_shared_images({"img_1": handle, "other": "not shared"})
+
+    assert shared["other"] == "not shared"
+    np.testing.assert_array_equal(np.asarray(shared["img_1"]), np.asarray(image))
+    arena.release(handle)
+    arena.close()
+
+
+def test_same_image_is_written_once():
+    arena = SharedImageArena()
+    image = Image.new("RGB", (8, 4), (1, 2, 3))
+
+    first = arena.share("img_1", image)
+    second = arena.share("img_1", image)
+    assert first == second
+
+    other = arena.share("img_1", Image.new("RGB", (8, 4), (4, 5, 6)))
+    assert other != first
+    assert np.asarray(read_shared_images({"img_1": other})["img_1"])[0, 0].tolist() == [4, 5, 6]
+
+    for handle in (first, second, other):
+        arena.release(handle)
+    arena.close()
+
+
+def test_frames_are_freed_with_their_images():
+    arena = SharedImageArena(segment_size=1024)
+    images = [Image.new("RGB", (16, 16), (i, i, i)) for i in range(4)]
+    handles = [arena.share(f"img_{i}", image) for i, image in enumerate(images)]
+    # each 768 bytes frame needs its own segment
+    assert len({handle.name for handle in handles}) == 4
+
+    for handle in handles:
+        arena.release(handle)
+    assert len(arena._blocks) == 4  # still published
+
+    del images
+    gc.collect()
+    assert len(arena._blocks) == 0
+    assert len(arena._segments) == 1
+    arena.close()
+
+
+def test_images_collected_while_locked_are_unpublished_later():
+    arena = SharedImageArena()
+    image = Image.new("RGB", (8, 8))
+    arena.release(arena.share("img_1", image))
+
+    # the finalizer runs while the lock is held, as when GC triggers in share()
+    with arena._lock:
+        del image
+        gc.collect()
+        assert len(arena._blocks) == 1
+
+    other = Image.new("RGB", (8, 8))
+    arena.release(arena.share("img_2", other))
+    assert list(arena._published) == ["img_2"]
+    assert len(arena._blocks) == 1
+    arena.close()
+
+
+def test_frames_in_use_outlive_eviction():
+    arena = SharedImageArena()
+    image = Image.new("RGB", (8, 8), (7, 8, 9))
+    handle = arena.share("img_1", image)
+
+    del image
+    gc.collect()
+    shared = read_shared_images({"img_1": handle})["img_1"]
+    assert np.asarray(shared)[0, 0].tolist() == [7, 8, 9]
+
+    arena.release(handle)
+    assert len(arena._blocks) == 0
+    arena.close()
+
+
+def test_exif_orientation_is_applied():
+    arena = SharedImageArena()
+    image = Image.new("RGB", (8, 4), (1, 2, 3))
+    image.putpixel((0, 0), (255, 0, 0))
+    exif = image.getexif()
+    exif[ExifTags.Base.Orientation] = 6  # rotated 90 degrees clockwise
+    image.info["exif"] = exif.tobytes()
+    handle = arena.share("img_1", image)
+
+    shared = read_shared_images({"img_1": handle})["img_1"]
+    expected = ImageOps.exif_transpose(image)
+    assert shared.size == (4, 8)
+    np.testing.assert_array_equal(np.asarray(shared), np.asarray(expected))
+    arena.release(handle)
+    arena.close()
+
+
+def test_full_shared_memory_falls_back(monkeypatch):
+    arena = SharedImageArena(segment_size=1024 * 1024)
+    monkeypatch.setattr(shared_images, "_shared_memory_free", lambda: 1000)
+    # a segment just large enough for a small frame
+    small = arena.share("small", Image.new("RGB", (8, 8)))
+    assert small is not None and arena._segments[0].size == 192
+
+    assert arena.share("large", Image.new("RGB", (32, 32))) is None
+    assert "large" not in arena._published
+    arena.release(small)
+    arena.close()
+
+
+def test_segments_are_unlinked_with_the_arena():
+    arena = SharedImageArena(segment_size=1024)
+    image = Image.new("RGB", (8, 8))
+    handle = arena.share("img_1", image)
+
+    # published frames keep the arena alive
+    del arena, image
+    gc.collect()
+    assert read_shared_images({"img_1": handle}) == {}
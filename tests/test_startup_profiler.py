@@ -0,0 +1,38 @@
+import importlib
+import sys
+import time
+
+from nrtk_explorer.library.startup_profiler import StartupProfiler
+
+
+def test_imports_and_steps_are_timed(tmp_path, monkeypatch):
+    (tmp_path / "slow_parent.py").write_text("import time\ntime.sleep(0.05)\nimport slow_child\n")
+    (tmp_path / "slow_child.py").write_text("import time\ntime.sleep(0.1)\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    profiler = StartupProfiler()
+    profiler.start()
+    try:
+        with profiler.measure("step"):
+            module = importlib.import_module("slow_parent")
+            time.sleep(0.01)
+    finally:
+        profiler.stop()
+        sys.modules.pop("slow_parent", None)
+        sys.modules.pop("slow_child", None)
+
+    parent_self, parent_cumulative = profiler.imports["slow_parent"]
+    child_self, child_cumulative = profiler.imports["slow_child"]
+    assert child_self >= 0.1 and child_cumulative >= 0.1
+    assert 0.05 <= parent_self < 0.1 and parent_cumulative >= 0.15
+    assert profiler.steps["step"] >= 0.16
+    # modules keep their own loader
+    assert type(module.__loader__).__name__ == "SourceFileLoader"
+    assert "slow_parent" in profiler.report()
+
+
+def test_measure_is_a_noop_until_started():
+    profiler = StartupProfiler()
+    with profiler.measure("step"):
+        pass
+    assert profiler.steps == {}
@@ -0,0 +1,54 @@
+import asyncio
+
+import numpy as np
+
+from nrtk_explorer.library.transform_executor import (
+    TransformExecutor,
+    _build_step,
+    serialize_transform,
+)
+from nrtk_explorer.library.transforms import (
+    ChainedImageTransform,
+    GaussianBlurTransform,
+    InvertTransform,
+)
+from nrtk_explorer.library.yaml_transforms import generate_transforms
+
+
+def test_serialized_transforms_are_rebuilt_with_their_parameters():
+    yaml_transforms = generate_transforms()
+    blur = GaussianBlurTransform()
+    blur.set_parameters({"radius": 3})
+    pybsm = yaml_transforms["nrtk_pybsm"]()
+    pybsm.set_parameters({"D": 0.25, "f": 4.0})
+
+    for step, spec in zip(
+        [blur, pybsm], serialize_transform(ChainedImageTransform([blur, pybsm]))
+    ):
+        rebuilt = _build_step(spec, lambda: yaml_transforms)
+        assert type(rebuilt) is type(step)
+        assert rebuilt.get_parameters() == step.get_parameters()
+
+
+def test_only_the_transformed_image_is_returned_unless_prefixes_are_asked():
+    blur = GaussianBlurTransform()
+    blur.set_parameters({"radius": 2})
+    chain = ChainedImageTransform([blur, InvertTransform()])
+    specs = serialize_transform(chain)
+    array = np.random.default_rng(0).integers(0, 256, (8, 6, 3), dtype=np.uint8)
+    executor = TransformExecutor(max_workers=2)
+
+    async def collect():
+        return await asyncio.gather(
+            executor.submit(specs, array), executor.submit(specs, array, with_prefixes=True)
+        )
+
+    try:
+        transformed, prefixes = asyncio.run(collect())
+    finally:
+        executor.shutdown()
+
+    assert len(transformed) == 1 and len(prefixes) == 2
+    assert np.array_equal(prefixes[0], blur.execute_batch([array])[0])
+    assert np.array_equal(transformed[0], chain.execute_batch([array])[0])
+    assert np.array_equal(prefixes[-1], transformed[0])
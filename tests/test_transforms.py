@@ -1,7 +1,25 @@
+import os
+import subprocess
+import sys
+import sysconfig
+
+import numpy as np
+from PIL import Image, ImageFilter, ImageOps
 from utils import get_image
 
+from nrtk_explorer.library.transforms import (
+    ChainedImageTransform,
+    DownSampleTransform,
+    GaussianBlurTransform,
+    IdentityTransform,
+    InvertTransform,
+    chain_prefix_hashes,
+    transform_hash,
+)
 from nrtk_explorer.library.yaml_transforms import (
+    PerturberAvailability,
     generate_transforms,
+    module_exists,
 )
 
 
@@ -17,3 +35,109 @@ def test_pybsm():
     pybsm = transforms["nrtk_pybsm"]()
     pybsm.set_parameters({"D": 0.25, "f": 4.0})
     pybsm.execute(get_image())
+
+
+def test_generate_transforms_does_not_import_perturbers():
+    code = (
+        "import sys\n"
+        "from nrtk_explorer.library.yaml_transforms import generate_transforms\n"
+        "transforms = generate_transforms()\n"
+        "assert 'fake' not in transforms and 'nrtk_diffusion' in transforms\n"
+        "assert not [name for name in sys.modules if name.startswith('nrtk.')]\n"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+def test_module_exists():
+    assert module_exists("nrtk.impls.perturb_image.photometric.blur")
+    assert module_exists("nrtk_explorer.library.nrtk_transforms.create_sample_sensor_and_scenario")
+    assert not module_exists("nrtk.does.not.exist")
+    assert not module_exists("no_such_package")
+
+
+def test_perturber_availability_is_saved(tmp_path):
+    path = tmp_path / "availability.json"
+    availability = PerturberAvailability(path)
+    availability.set("missing.Perturber", False)
+    assert PerturberAvailability(path).get("missing.Perturber") is False
+    assert PerturberAvailability(path).get("other.Perturber") is None
+
+
+def test_perturber_availability_is_reset_by_installs(tmp_path, monkeypatch):
+    site_packages = tmp_path / "site-packages"
+    site_packages.mkdir()
+    paths = {"purelib": str(site_packages), "platlib": str(site_packages)}
+    monkeypatch.setattr(sysconfig, "get_paths", lambda: paths)
+    path = tmp_path / "availability.json"
+    PerturberAvailability(path).set("missing.Perturber", False)
+    assert PerturberAvailability(path).get("missing.Perturber") is False
+
+    (site_packages / "missing").mkdir()
+    mtime_ns = site_packages.stat().st_mtime_ns + 1_000_000_000
+    os.utime(site_packages, ns=(mtime_ns, mtime_ns))
+    assert PerturberAvailability(path).get("missing.Perturber") is None
+
+
+def test_transform_hash():
+    def chain(radius):
+        blur = GaussianBlurTransform()
+        blur.set_parameters({"radius": radius})
+        return ChainedImageTransform([IdentityTransform(), blur])
+
+    assert transform_hash(chain(2)) == transform_hash(chain(2))
+    assert transform_hash(chain(2)) != transform_hash(chain(3))
+    assert transform_hash(chain(2)) != transform_hash(ChainedImageTransform([chain(2)]))
+    assert transform_hash(None) != transform_hash(ChainedImageTransform([]))
+
+
+def test_chain_prefix_hashes():
+    blur = GaussianBlurTransform()
+    identity = IdentityTransform()
+
+    hashes = chain_prefix_hashes([blur, identity])
+    assert hashes[-1] == transform_hash(ChainedImageTransform([blur, identity]))
+    assert hashes[0] == chain_prefix_hashes([blur, GaussianBlurTransform()])[0]
+    assert hashes[0] != hashes[1]
+
+
+def test_execute_batch_matches_execute():
+    rng = np.random.default_rng(0)
+    stack = rng.integers(0, 256, (3, 10, 12, 3), dtype=np.uint8)
+    images = [stack[0], rng.integers(0, 256, (7, 9, 3), dtype=np.uint8)]
+    blur = GaussianBlurTransform()
+    blur.set_parameters({"radius": 2})
+    chain = ChainedImageTransform([blur, InvertTransform(), DownSampleTransform()])
+
+    batch = chain.execute_batch(stack)
+    assert batch.shape == (3, 5, 6, 3)
+    for array, output in zip(stack, batch):
+        assert np.array_equal(np.asarray(chain.execute(Image.fromarray(array))), output)
+
+    outputs = chain.execute_batch(images)
+    assert [output.shape for output in outputs] == [(5, 6, 3), (3, 4, 3)]
+    assert np.array_equal(outputs[0], batch[0])
+
+
+def test_invert_batch_matches_pillow():
+    image = get_image().convert("RGB")
+    inverted = InvertTransform().execute_batch([np.asarray(image)])[0]
+    assert np.array_equal(inverted, np.asarray(ImageOps.invert(image)))
+
+
+def test_blur_batch_matches_pillow():
+    image = get_image().convert("RGB")
+    for radius in (1, 2, 5):
+        blur = GaussianBlurTransform()
+        blur.set_parameters({"radius": radius})
+        blurred = blur.execute_batch([np.asarray(image)])[0].astype(int)
+        expected = np.asarray(image.filter(ImageFilter.GaussianBlur(radius))).astype(int)
+        # a true gaussian versus PIL's box blur approximation, in 0-255 levels
+        difference = np.abs(blurred - expected)
+        assert difference.max() <= 12 and difference.mean() <= 0.5
+
+
+def test_downsample_batch_matches_pillow():
+    image = get_image().convert("RGB")
+    downsampled = DownSampleTransform().execute_batch(np.asarray(image)[np.newaxis])[0]
+    expected = image.resize((image.width // 2, image.height // 2))
+    assert np.array_equal(downsampled, np.asarray(expected))